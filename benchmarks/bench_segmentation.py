@@ -0,0 +1,63 @@
+"""
+Benchmark the per-source cost of cutting segmentation stamps out of a mosaic.
+
+This compares wrapping the full segmentation map in a ``galsim.Image`` for
+every source (as was done originally) with wrapping it only once and slicing
+the shared view. With the former, the per-source cost grows with the mosaic
+area, whereas it stays constant with the latter.
+
+Usage::
+
+    python benchmarks/bench_segmentation.py --sizes 1024,4096 --nsources 200
+"""
+
+import time
+from typing import Sequence
+
+import fire
+import galsim
+import numpy as np
+
+
+def _make_seg_map(size: int, nsources: int, rng: np.random.Generator) -> np.ndarray:
+    """Make a segmentation map with square footprints at random positions."""
+    # photutils stores the segmentation labels as int64 by default.
+    seg_map = np.zeros((size, size), dtype=np.int64)
+    for label, (x, y) in enumerate(rng.integers(8, size - 8, size=(nsources, 2)), start=1):
+        seg_map[y - 4 : y + 4, x - 4 : x + 4] = label  # noqa: E203
+    return seg_map
+
+
+def _stamp_bounds(size: int, nsources: int, rng: np.random.Generator) -> Sequence[galsim.BoundsI]:
+    corners = rng.integers(1, size - 64, size=(nsources, 2))
+    return [galsim.BoundsI(x, x + 63, y, y + 63) for x, y in corners]
+
+
+def time_per_source(seg_map: np.ndarray, stamps: Sequence[galsim.BoundsI], wrap_once: bool) -> float:
+    """Return the mean time in seconds to make the neighbor mask of a stamp."""
+    seg_image = galsim.Image(np.asarray(seg_map, dtype=np.int32))
+    start = time.perf_counter()
+    for n, bounds in enumerate(stamps, start=1):
+        if not wrap_once:
+            seg_image = galsim.Image(seg_map)
+        stamp = seg_image[bounds].array
+        _ = ~((stamp == n) | (stamp == 0))
+    return (time.perf_counter() - start) / len(stamps)
+
+
+def main(sizes: Sequence[int] = (1024, 2048, 4096, 8192), nsources: int = 200, seed: int = 1357):
+    """Print the per-source cost of both approaches for each mosaic size."""
+    if isinstance(sizes, int):
+        sizes = (sizes,)
+    rng = np.random.default_rng(seed)
+    print(f"{'size':>8} {'per-source wrap (ms)':>22} {'wrap once (ms)':>16}")
+    for size in sizes:
+        seg_map = _make_seg_map(size, nsources, rng)
+        stamps = _stamp_bounds(size, nsources, rng)
+        t_old = time_per_source(seg_map, stamps, wrap_once=False)
+        t_new = time_per_source(seg_map, stamps, wrap_once=True)
+        print(f"{size:>8} {1e3 * t_old:>22.4f} {1e3 * t_new:>16.4f}")
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
@@ -0,0 +1,144 @@
+"""
+Benchmark the pipeline end to end on synthetic mosaics of increasing size.
+
+For every mosaic size, the input products are generated with `synthetic.py`,
+and the pipeline is run in a fresh process, timing `load_all`, `measure` and
+`_make_catalog` separately. The throughput in sources per second, the mean
+per-source time of each stage of the measurement and the peak resident
+memory are reported. No network access is needed.
+
+Usage::
+
+    python benchmarks/run_benchmarks.py --sizes 512,1024 --output bench.json
+"""
+
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import time
+from typing import Any, Dict, Optional, Sequence
+
+import fire
+import numpy as np
+
+# The pipeline modules import each other as top-level modules.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "nirwl_metacal"))
+
+import synthetic  # noqa: E402
+
+
+def _peak_rss_mb() -> float:
+    """Return the peak resident memory of this process and children in MB."""
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    usage += resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return usage / 1024  # ru_maxrss is in kB on Linux.
+
+
+def bench_one(config_path: str, nproc: int = 1, memmap: bool = False) -> Dict[str, Any]:
+    """Run the pipeline on one set of products and return the timings.
+
+    This is meant to run in a fresh process, so that the peak memory
+    reflects this run alone.
+    """
+    from main import MetacalCatalogGenerator
+    from metacal_record import MetacalRecord
+    from writers import FitsCatalogWriter
+
+    generator = MetacalCatalogGenerator(config=config_path, nproc=nproc, memmap=memmap, profile=True)
+
+    start = time.perf_counter()
+    generator.load_all()
+    load_time = time.perf_counter() - start
+    generator.validate()
+
+    generator._setup_measurement()
+    indices = np.arange(len(generator.sep_cat))
+    with FitsCatalogWriter(generator.output_cat_path, MetacalRecord.dtypes(), indices) as writer:
+        start = time.perf_counter()
+        records = list(generator.measure(indices))
+        measure_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        generator._make_catalog(records, writer)
+        catalog_time = time.perf_counter() - start
+
+    assert generator.profile is not None
+    summary = generator.profile.summary()
+    return {
+        "nsources": len(indices),
+        "nproc": nproc,
+        "memmap": memmap,
+        "load_all_s": load_time,
+        "measure_s": measure_time,
+        "make_catalog_s": catalog_time,
+        "sources_per_s": len(indices) / measure_time,
+        "per_source_ms": {stage: 1e3 * stats["wall_mean"] for stage, stats in summary.items()},
+        "peak_rss_mb": _peak_rss_mb(),
+    }
+
+
+def main(
+    sizes: Sequence[int] = (512, 1024, 2048),
+    density: float = 400.0,
+    nproc: int = 1,
+    memmap: bool = False,
+    workdir: Optional[str] = None,
+    output: Optional[str] = None,
+    seed: int = 1357,
+):
+    """Run the benchmarks and print a summary table.
+
+    Parameters
+    ----------
+    sizes : Sequence[int], optional
+        The sides of the square mosaics, in pixels.
+    density : float, optional
+        The number of sources per million pixels.
+    nproc : int, optional
+        The number of processes to measure the sources with.
+    memmap : bool, optional
+        Memory-map the input images.
+    workdir : str, optional
+        The directory to write the products into. A temporary directory is
+        used if not given.
+    output : str, optional
+        A JSON file to write the results into.
+    seed : int, optional
+        The seed for the synthetic mosaics.
+    """
+    if isinstance(sizes, int):
+        sizes = (sizes,)
+    workdir = workdir or tempfile.mkdtemp(prefix="nirwl_metacal_bench_")
+
+    results = []
+    context = multiprocessing.get_context("spawn")
+    for size in sizes:
+        outdir = os.path.join(workdir, f"mosaic_{size}")
+        synthetic.make_synthetic_mosaic(outdir, size=size, density=density, seed=seed)
+        with context.Pool(1) as pool:
+            result = pool.apply(bench_one, (os.path.join(outdir, "config.yaml"), nproc, memmap))
+        result["size"] = size
+        results.append(result)
+
+    print(
+        f"{'size':>6} {'sources':>8} {'load_all (s)':>13} {'measure (s)':>12} {'catalog (s)':>12} "
+        f"{'sources/s':>10} {'ms/source':>10} {'peak RSS (MB)':>14}"
+    )
+    for result in results:
+        print(
+            f"{result['size']:>6} {result['nsources']:>8} {result['load_all_s']:>13.3f} "
+            f"{result['measure_s']:>12.3f} {result['make_catalog_s']:>12.3f} "
+            f"{result['sources_per_s']:>10.1f} "
+            f"{result['per_source_ms']['total']:>10.2f} {result['peak_rss_mb']:>14.1f}"
+        )
+
+    if output is not None:
+        with open(output, "w") as f:
+            json.dump(results, f, indent=1)
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
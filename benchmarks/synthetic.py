@@ -0,0 +1,159 @@
+"""
+Generate a synthetic mosaic and all the input products of the pipeline.
+
+The products mimic those of the HST NIR mosaics: a drizzled image with its
+weight and noise rms maps, a segmentation map, a SExtractor-like catalog and
+a cube with one PSF image per source. They are written to a directory along
+with a config file that the pipeline can be run with.
+
+Usage::
+
+    python benchmarks/synthetic.py --outdir /tmp/mosaic --size 2048
+"""
+
+import os
+from typing import Any, Dict
+
+import fire
+import galsim
+import numpy as np
+import yaml
+from astropy.io import fits
+
+PIXEL_SCALE = 0.06  # arcsec / pixel, typical of the drizzled WFC3/IR mosaics.
+NOISE_RMS = 0.01
+STAMP_SIZE = 64
+
+
+def _draw_psf(fwhm: float) -> galsim.GSObject:
+    return galsim.Moffat(beta=3.5, fwhm=fwhm)
+
+
+def make_synthetic_mosaic(
+    outdir: str,
+    size: int = 1024,
+    density: float = 400.0,
+    seed: int = 1357,
+    psf_fwhm: float = 0.18,
+    psf_size: int = 33,
+) -> Dict[str, Any]:
+    """
+    Write a synthetic mosaic and the corresponding input products.
+
+    Parameters
+    ----------
+    outdir : str
+        The directory to write the products into.
+    size : int, optional
+        The side of the square mosaic, in pixels.
+    density : float, optional
+        The number of sources per million pixels.
+    seed : int, optional
+        The seed for the random number generators.
+    psf_fwhm : float, optional
+        The mean FWHM of the PSF, in arcsec. It varies by a few percent across
+        the mosaic, so that the PSF images are not all identical.
+    psf_size : int, optional
+        The side of the PSF images, in pixels.
+
+    Returns
+    -------
+    config : dict
+        The config to run the pipeline on the products, which is also
+        written to ``outdir/config.yaml``.
+    """
+    os.makedirs(outdir, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    nsources = max(1, int(round(density * size**2 / 1e6)))
+
+    image = galsim.ImageF(size, size, scale=PIXEL_SCALE)
+    # The largest noiseless profile value so far, to assign pixels to sources.
+    peak = np.zeros((size, size), dtype=np.float32)
+    seg_map = np.zeros((size, size), dtype=np.int32)
+    psf_cube = np.empty((nsources, psf_size, psf_size), dtype=np.float32)
+
+    margin = STAMP_SIZE // 4
+    x = rng.uniform(margin, size - margin, nsources)
+    y = rng.uniform(margin, size - margin, nsources)
+    flux = 10 ** rng.uniform(0.0, 2.0, nsources)
+    hlr = rng.uniform(0.1, 0.5, nsources)
+    shear = rng.normal(0.0, 0.2, size=(nsources, 2)).clip(-0.6, 0.6)
+
+    for n in range(nsources):
+        psf = _draw_psf(psf_fwhm * (1 + 0.05 * np.sin(x[n] / size * np.pi) * np.cos(y[n] / size * np.pi)))
+        psf_cube[n] = psf.drawImage(nx=psf_size, ny=psf_size, scale=PIXEL_SCALE).array
+
+        galaxy = galsim.Exponential(half_light_radius=hlr[n], flux=flux[n])
+        galaxy = galaxy.shear(g1=shear[n, 0], g2=shear[n, 1])
+        stamp = galsim.Convolve(galaxy, psf).drawImage(
+            nx=STAMP_SIZE, ny=STAMP_SIZE, scale=PIXEL_SCALE, center=galsim.PositionD(x[n] + 1, y[n] + 1)
+        )
+        bounds = stamp.bounds & image.bounds
+        image[bounds] += stamp[bounds]
+
+        # Assign the pixels above the noise to the brightest source in them.
+        ys, xs = bounds.ymin - 1, bounds.xmin - 1
+        window = (slice(ys, ys + bounds.numpyShape()[0]), slice(xs, xs + bounds.numpyShape()[1]))
+        profile = stamp[bounds].array
+        footprint = (profile > NOISE_RMS) & (profile > peak[window])
+        peak[window][footprint] = profile[footprint]
+        seg_map[window][footprint] = n + 1
+
+    # Make sure that every source has a footprint, at least at its center.
+    missing = np.setdiff1d(np.arange(nsources), np.unique(seg_map) - 1)
+    seg_map[y[missing].astype(int), x[missing].astype(int)] = missing + 1
+
+    noise_rms = np.full((size, size), NOISE_RMS, dtype=np.float32)
+    image.addNoise(galsim.GaussianNoise(galsim.BaseDeviate(seed), sigma=NOISE_RMS))
+
+    paths = {
+        "drizzle_image": os.path.join(outdir, "drizzle_image.fits"),
+        "drizzle_weight": os.path.join(outdir, "drizzle_weight.fits"),
+        "noise_rms_map": os.path.join(outdir, "noise_rms.fits"),
+        "seg_map": os.path.join(outdir, "seg_map.fits"),
+        "sep_cat": os.path.join(outdir, "sep_cat.fits"),
+        "psf_images": os.path.join(outdir, "psf_images.fits"),
+    }
+    fits.PrimaryHDU(image.array).writeto(paths["drizzle_image"], overwrite=True)
+    fits.PrimaryHDU(noise_rms**-2).writeto(paths["drizzle_weight"], overwrite=True)
+    fits.PrimaryHDU(noise_rms).writeto(paths["noise_rms_map"], overwrite=True)
+    fits.PrimaryHDU(seg_map).writeto(paths["seg_map"], overwrite=True)
+    fits.HDUList([fits.PrimaryHDU(), fits.ImageHDU(psf_cube)]).writeto(paths["psf_images"], overwrite=True)
+
+    catalog = np.zeros(
+        nsources,
+        dtype=[
+            ("ID", "i4"),
+            ("X_IMAGE", "f8"),
+            ("Y_IMAGE", "f8"),
+            ("FLUX_AUTO", "f8"),
+            ("MAG_AUTO", "f8"),
+            ("FLUX_RADIUS", "f8"),
+        ],
+    )
+    catalog["ID"] = np.arange(1, nsources + 1)
+    catalog["X_IMAGE"], catalog["Y_IMAGE"] = x + 1, y + 1
+    catalog["FLUX_AUTO"] = flux
+    catalog["MAG_AUTO"] = 25.0 - 2.5 * np.log10(flux)
+    catalog["FLUX_RADIUS"] = hlr / PIXEL_SCALE
+    fits.BinTableHDU(catalog).writeto(paths["sep_cat"], overwrite=True)
+
+    config = {
+        "name": f"synthetic-{size}",
+        "inputs": paths,
+        "outputs": {"output_cat": os.path.join(outdir, "metacal.fits"), "overwrite": True},
+        "logging": {},
+        "measurement": {},
+    }
+    with open(os.path.join(outdir, "config.yaml"), "w") as f:
+        yaml.safe_dump(config, f)
+    return config
+
+
+def main(outdir: str, **kwargs):
+    """Write the products, see `make_synthetic_mosaic` for the options."""
+    make_synthetic_mosaic(outdir, **kwargs)
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
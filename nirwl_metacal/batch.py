@@ -0,0 +1,208 @@
+"""
+Module containing the driver that measures many mosaics with one worker pool
+"""
+
+from __future__ import annotations
+
+import glob
+import logging
+import multiprocessing
+import os
+import tempfile
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import TYPE_CHECKING, Any, Dict, Iterator, List, NamedTuple, Optional, Sequence, Tuple, Union
+
+import fire
+import numpy as np
+from main import MetacalCatalogGenerator
+
+if TYPE_CHECKING:
+    from writers import CatalogWriter
+
+__all__ = [
+    "run_batch",
+]
+
+logger = logging.getLogger(__name__)
+
+# The catalog generator of the field that a pool worker measured last. It is
+# replaced when the worker gets a chunk of another field.
+_worker_field: Optional[Tuple[str, MetacalCatalogGenerator]] = None
+
+
+def _measure_field_in_worker(
+    task: Tuple[str, Dict[str, Any], str, np.ndarray],
+) -> Tuple[np.ndarray, List[Dict[str, Any]]]:
+    """Measure a chunk of sources of a field in a pool worker.
+
+    The worker opens the inputs of a field, memory-mapped, the first time it
+    gets a chunk of that field. The footprints of the sources are read from
+    the file written by `_prepare_field`, instead of being found again from
+    the segmentation map in every worker.
+    """
+    global _worker_field
+    config, kwargs, footprints_path, indices = task
+    if _worker_field is None or _worker_field[0] != config:
+        _worker_field = None
+        catalog_generator = MetacalCatalogGenerator(config=config, **kwargs)
+        catalog_generator._setup_from_footprints(footprints_path)
+        _worker_field = (config, catalog_generator)
+    return _worker_field[1]._measure_chunk(indices)
+
+
+class _Field(NamedTuple):
+    """A field that is ready to be measured."""
+
+    config: str
+    catalog_generator: MetacalCatalogGenerator
+    writer: CatalogWriter
+    tasks: List[Tuple[str, Dict[str, Any], str, np.ndarray]]
+    num_sources: int
+    # The file that the footprints of the sources are shared through.
+    footprints_path: str
+
+
+def _expand_configs(configs: Union[str, Sequence[str]]) -> List[str]:
+    """Expand the glob patterns in a list of config files."""
+    if isinstance(configs, str):
+        configs = configs.split(",")
+    paths: List[str] = []
+    for pattern in configs:
+        matches = sorted(glob.glob(pattern))
+        if not matches:
+            raise FileNotFoundError(f"No config file matches {pattern}")
+        paths.extend(match for match in matches if match not in paths)
+    return paths
+
+
+def _prepare_field(config: str, nproc: int, kwargs: Dict[str, Any]) -> _Field:
+    """Load the inputs of a field, and plan the chunks to measure.
+
+    The footprints of the sources are written to a temporary file, which the
+    pool workers set up the measurement of the field from. It is removed if
+    the field cannot be prepared, and otherwise once it is measured.
+    """
+    catalog_generator = MetacalCatalogGenerator(config=config, nproc=nproc, memmap=True, **kwargs)
+    catalog_generator.setup()
+    fd, footprints_path = tempfile.mkstemp(prefix="footprints-", suffix=".pkl")
+    os.close(fd)
+    try:
+        catalog_generator._write_footprints(footprints_path)
+        indices = catalog_generator._selected_indices()
+        catalog_generator._check_output(catalog_generator.output_cat_path)
+        writer = catalog_generator._open_writer(catalog_generator.output_cat_path, indices)
+        todo = np.setdiff1d(indices, writer.measured_indices())
+    except BaseException:
+        os.remove(footprints_path)
+        raise
+    worker_kwargs = dict(kwargs, nproc=1, memmap=True, profile=catalog_generator.profile is not None)
+    tasks = (
+        [(config, worker_kwargs, footprints_path, chunk) for chunk in catalog_generator._plan_chunks(todo)]
+        if len(todo)
+        else []
+    )
+    return _Field(config, catalog_generator, writer, tasks, len(todo), footprints_path)
+
+
+def run_batch(
+    configs: Union[str, Sequence[str]],
+    nproc: Optional[int] = None,
+    overwrite: Optional[bool] = None,
+    resume: Optional[bool] = None,
+    check: bool = False,
+):
+    """
+    Measure the mosaics of many fields, each with its own config file.
+
+    One pool of worker processes is started for all the fields, so the
+    packages are imported only once. The inputs of the next field are loaded
+    while the current field is measured, and its sources are queued as soon
+    as they are ready, so that the workers do not wait between fields.
+
+    Parameters
+    ----------
+    configs : str or Sequence[str]
+        The config files of the fields, or glob patterns matching them, as a
+        list or a comma-separated string. At least one must be given.
+    nproc : int, optional
+        The number of worker processes. Defaults to the number of CPUs.
+    overwrite, resume : bool, optional
+        Override the corresponding options in the config files.
+    check : bool, optional
+        Check the inputs of all the fields from their FITS headers, see
+        `MetacalCatalogGenerator.check`, before measuring any of them.
+    """
+    paths = _expand_configs(configs)
+    if not paths:
+        raise ValueError("No config files are given")
+    if check:
+        for config in paths:
+            MetacalCatalogGenerator(config=config).check()
+    nproc = nproc or multiprocessing.cpu_count()
+    kwargs = {
+        name: value for name, value in (("overwrite", overwrite), ("resume", resume)) if value is not None
+    }
+    logger.info("Measuring %d fields with %d processes", len(paths), nproc)
+
+    summary = []
+    context = multiprocessing.get_context("fork")
+    with context.Pool(nproc) as pool, ThreadPoolExecutor(max_workers=1) as loader:
+        next_field: Optional[Future] = loader.submit(_prepare_field, paths[0], nproc, kwargs)
+        queued: Dict[int, Iterator] = {}
+
+        def queue_next(n: int):
+            """Queue the sources of the n-th field, if it is loaded."""
+            if n not in queued and next_field is not None and next_field.done():
+                queued[n] = pool.imap(_measure_field_in_worker, next_field.result().tasks)
+
+        try:
+            for n, config in enumerate(paths):
+                assert next_field is not None
+                field: _Field = next_field.result()
+                queue_next(n)
+                results = queued.pop(n)
+                next_field = (
+                    loader.submit(_prepare_field, paths[n + 1], nproc, kwargs) if n + 1 < len(paths) else None
+                )
+
+                def queue_ahead(results: Iterator) -> Iterator[np.ndarray]:
+                    for records in results:
+                        # Keep the workers busy with the next field as soon as
+                        # its inputs are loaded.
+                        queue_next(n + 1)
+                        yield records
+
+                logger.info(
+                    "Field %d of %d (%s): measuring %d sources", n + 1, len(paths), config, field.num_sources
+                )
+                start = time.perf_counter()
+                catalog_generator = field.catalog_generator
+                name = f"Field {n + 1} of {len(paths)}"
+                try:
+                    with field.writer, catalog_generator._tracking_progress(field.num_sources, name=name):
+                        catalog_generator._make_catalog(
+                            queue_ahead(catalog_generator._collect_chunks(results)), field.writer
+                        )
+                finally:
+                    # All the chunks of the field are measured, so no worker
+                    # needs its footprints anymore.
+                    os.remove(field.footprints_path)
+                elapsed = time.perf_counter() - start
+                catalog_generator._log_stats()
+                logger.info("Field %d of %d (%s) done in %.1f s", n + 1, len(paths), config, elapsed)
+                summary.append((config, field.num_sources, elapsed))
+        finally:
+            # A field that was loaded ahead, but is not measured because of
+            # an error.
+            if next_field is not None and not next_field.cancel() and next_field.exception() is None:
+                os.remove(next_field.result().footprints_path)
+
+    for config, num_sources, elapsed in summary:
+        rate = num_sources / elapsed if elapsed > 0 else 0.0
+        logger.info("%s: %d sources in %.1f s (%.1f sources/s)", config, num_sources, elapsed, rate)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(format="%(asctime)s %(levelname)s: %(message)s", level=logging.INFO)
+    fire.Fire(run_batch)
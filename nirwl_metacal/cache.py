@@ -0,0 +1,162 @@
+"""
+Module containing the on-disk cache of the records of measured sources
+
+The record of a source is stored under a hash of everything it depends on:
+the pixels of its image, weight, noise rms and neighbor mask stamps, its PSF
+image, the bounds of its stamp, its ID, which keys its random number
+streams, and a context with the measurement config and the seed. A rerun
+then only measures the sources whose inputs or config changed, and reads the
+others from the cache.
+
+The cache is a directory of small files, one per record, named by the hash
+and spread over 256 subdirectories, so that the worker processes can read
+and write it concurrently without locks. Its size is bounded by evicting the
+least recently used records, by modification time, which is updated at
+every hit.
+"""
+
+import hashlib
+import os
+from typing import Any, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+__all__ = [
+    "CACHE_VERSION",
+    "ResultCache",
+]
+
+# The version of the measurement, which is part of every key. It must be
+# increased when a change of the code changes the records.
+CACHE_VERSION = 1
+
+
+class ResultCache:
+    """
+    A content-addressed, size-bounded cache of the records of sources.
+
+    Parameters
+    ----------
+    directory : str
+        The directory of the cache. It is created if it does not exist, and
+        may be shared by the runs of different mosaics and configs.
+    max_bytes : int, optional
+        The maximum space on the disk that the cache may use, in bytes. It is
+        enforced by `evict`.
+    context : str, optional
+        The description of everything besides the inputs of a source that
+        its record depends on, e.g., the measurement config and the seed.
+    """
+
+    def __init__(self, directory: str, max_bytes: Optional[int] = None, context: str = ""):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        digest = hashlib.blake2b(f"{CACHE_VERSION}\n{context}".encode(), digest_size=20)
+        self._context = digest.digest()
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, source_id: int, bounds: Sequence[int], arrays: Sequence[Optional[np.ndarray]]) -> str:
+        """
+        Return the key of a source from its inputs.
+
+        Parameters
+        ----------
+        source_id : int
+            The ID of the source.
+        bounds : Sequence[int]
+            The (xmin, xmax, ymin, ymax) of the stamp of the source.
+        arrays : Sequence[np.ndarray or None]
+            The pixels that the record depends on, in a fixed order. None
+            stands for a missing array, e.g., a stamp without neighbors.
+        """
+        digest = hashlib.blake2b(self._context, digest_size=20)
+        digest.update(repr((int(source_id), tuple(map(int, bounds)))).encode())
+        for array in arrays:
+            if array is None:
+                digest.update(b"None")
+                continue
+            array = np.ascontiguousarray(array)
+            digest.update(repr((array.shape, array.dtype.str)).encode())
+            digest.update(array.data)
+        return digest.hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], key)
+
+    def get(self, key: str, dtype: np.dtype) -> Optional[Any]:
+        """Return the record stored under ``key``, or None if there is none."""
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            # Mark the record as recently used.
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        dtype = np.dtype(dtype)
+        if len(data) != dtype.itemsize:
+            # A record of another dtype, which the key should have prevented.
+            return None
+        return np.frombuffer(data, dtype=dtype)[0]
+
+    def put(self, key: str, record: Any):
+        """Store a record under ``key``, replacing any previous one."""
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(np.asarray(record).tobytes())
+        os.replace(tmp_path, path)
+
+    def _entries(self) -> Tuple[np.ndarray, np.ndarray, List[str]]:
+        """Return the modification times, sizes and paths of the records."""
+        mtimes: List[float] = []
+        sizes: List[int] = []
+        paths: List[str] = []
+        with os.scandir(self.directory) as subdirs:
+            for subdir in subdirs:
+                if not subdir.is_dir():
+                    continue
+                with os.scandir(subdir.path) as entries:
+                    for entry in entries:
+                        if entry.name.endswith(".tmp"):
+                            continue
+                        stat = entry.stat()
+                        mtimes.append(stat.st_mtime)
+                        # The space used on the disk, which is mostly that
+                        # of the blocks rather than of the small records.
+                        sizes.append(stat.st_blocks * 512 if hasattr(stat, "st_blocks") else stat.st_size)
+                        paths.append(entry.path)
+        return np.array(mtimes, dtype=np.float64), np.array(sizes, dtype=np.int64), paths
+
+    def usage(self) -> Tuple[int, int]:
+        """Return the number of records in the cache and their total size."""
+        _, sizes, _ = self._entries()
+        return len(sizes), int(sizes.sum())
+
+    def evict(self) -> Tuple[int, int]:
+        """
+        Remove the least recently used records until the cache fits.
+
+        Returns
+        -------
+        num_evicted, num_bytes : int
+            The number of records removed and their size in bytes.
+        """
+        if self.max_bytes is None:
+            return 0, 0
+        mtimes, sizes, paths = self._entries()
+        excess = int(sizes.sum()) - self.max_bytes
+        if excess <= 0:
+            return 0, 0
+        order = np.argsort(mtimes, kind="stable")
+        # Remove the oldest records until their total size covers the excess.
+        num_evicted = int(np.searchsorted(np.cumsum(sizes[order]), excess)) + 1
+        num_bytes = 0
+        for i in order[:num_evicted]:
+            try:
+                os.remove(paths[i])
+            except FileNotFoundError:
+                continue
+            num_bytes += int(sizes[i])
+        return num_evicted, num_bytes
@@ -0,0 +1,114 @@
+"""
+Module containing the readers for the input data products
+"""
+
+from typing import Optional
+
+import galsim
+import numpy as np
+from astropy.io import fits
+
+__all__ = [
+    "MosaicImage",
+    "PSFCube",
+    "read_image",
+]
+
+
+class MosaicImage:
+    """
+    A read-only, lazily loaded image of a mosaic.
+
+    This implements the subset of the `galsim.Image` interface that is used
+    during the measurement, without ever converting the full array. The array
+    is typically memory-mapped from a FITS file, in which case only the pixels
+    of the stamps that are cut out are read from the disk.
+
+    Parameters
+    ----------
+    array : np.ndarray
+        The (possibly memory-mapped and non-native byte order) pixel array.
+    xmin, ymin : int, optional
+        The coordinates of the lower left pixel, following GalSim.
+    dtype : np.dtype, optional
+        The dtype of the stamps. Defaults to the native byte order version of
+        the dtype of ``array``.
+    """
+
+    def __init__(self, array: np.ndarray, xmin: int = 1, ymin: int = 1, dtype: Optional[np.dtype] = None):
+        self._array = array
+        self.bounds = galsim.BoundsI(xmin, xmin + array.shape[1] - 1, ymin, ymin + array.shape[0] - 1)
+        self.dtype = np.dtype(dtype) if dtype is not None else array.dtype.newbyteorder("=")
+
+    @property
+    def array(self) -> np.ndarray:
+        """The underlying array, which must not be modified."""
+        return self._array
+
+    def __getitem__(self, bounds: galsim.BoundsI) -> galsim.Image:
+        """Return a copy of the stamp within ``bounds`` as a `galsim.Image`."""
+        if not self.bounds.includes(bounds):
+            raise galsim.GalSimBoundsError("Stamp is not inside the mosaic", bounds, self.bounds)
+        x0, x1 = bounds.xmin - self.bounds.xmin, bounds.xmax - self.bounds.xmin + 1
+        y0, y1 = bounds.ymin - self.bounds.ymin, bounds.ymax - self.bounds.ymin + 1
+        stamp = self._array[y0:y1, x0:x1]
+        return galsim.Image(np.array(stamp, dtype=self.dtype), xmin=bounds.xmin, ymin=bounds.ymin)
+
+
+class PSFCube:
+    """
+    A read-only, memory-mapped cube of PSF images, one per source.
+
+    The cube is opened without reading any of its planes, and the PSF image
+    of a source is read from the disk only when it is indexed.
+
+    Parameters
+    ----------
+    path : str
+        The path to the FITS file with the PSF cube.
+    hdu : int, optional
+        The index of the HDU with the PSF cube.
+    """
+
+    def __init__(self, path: str, hdu: int = 1):
+        with fits.open(path, memmap=True) as hdu_list:
+            assert hdu_list[hdu].is_image
+            # The memory map stays open for as long as the array is referenced.
+            self._cube = hdu_list[hdu].data
+        if self._cube is None or self._cube.ndim != 3:
+            raise ValueError(f"HDU {hdu} of {path} is not an image cube")
+        self.dtype = self._cube.dtype.newbyteorder("=")
+
+    def __len__(self) -> int:
+        return self._cube.shape[0]
+
+    def __getitem__(self, n: int) -> galsim.Image:
+        """Return a copy of the PSF image of the n-th source."""
+        return galsim.Image(np.array(self._cube[n], dtype=self.dtype))
+
+
+def read_image(path: str, hdu: int = 0, memmap: bool = False):
+    """Read an image from a FITS file.
+
+    Parameters
+    ----------
+    path : str
+        The path to the FITS file.
+    hdu : int, optional
+        The index of the image HDU.
+    memmap : bool, optional
+        Memory-map the image and return a `MosaicImage`, instead of reading
+        the full image into a `galsim.Image`.
+
+    Returns
+    -------
+    image : galsim.Image or MosaicImage
+        The image.
+    """
+    with fits.open(path, memmap=memmap) as hdu_list:
+        image_hdu = hdu_list[hdu]
+        assert image_hdu.is_image
+        if memmap:
+            # The memory map stays open for as long as the array is referenced.
+            return MosaicImage(image_hdu.data)
+        return galsim.Image(image_hdu.data)
@@ -1,21 +1,93 @@
+from __future__ import annotations
+
+import contextlib
+import glob
 import logging
+import multiprocessing
 import os
-from typing import Any, List, Mapping, Optional, Sequence
+import pickle
+import re
+import time
+import traceback
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Mapping,
+    Optional,
+    Sequence,
+    Tuple,
+    Union,
+    cast,
+)
 
 import fire
-import galsim
-# from .metacal import MetacalRecordGenerator
-import metacal
 import numpy as np
-import photutils
 import yaml
-from astropy.io import fits
-from metacal_record import MetacalRecord
+from metacal_record import FAILED_EXCEPTION, FAILED_TIMEOUT, MetacalRecord
+from profiling import Profile
+from progress import Progress
+from responses import SHEAR_TYPES, compute_responses, mean_response, selection_response, shear_field
+
+# The heavy packages, i.e., galsim, astropy and ngmix (through
+# metacal), are imported only where they are needed, so that, e.g., `check`
+# and `--help` start quickly.
+if TYPE_CHECKING:
+    import galsim
+    from astropy.io import fits
+    from loaders import MosaicImage, PSFCube
+    from cache import ResultCache
+    from metacal import MetacalRecordGenerator
+    from stamps import Footprints, Stamp
+    from writers import CatalogWriter
 
 __all__ = [
     "MetacalCatalogGenerator",
 ]
 
+# The measurement options that do not change the records, which are left out
+# of the keys of the result cache.
+_EXECUTION_OPTIONS = {
+    "nproc",
+    "tile_size",
+    "tile_overlap",
+    "batch_size",
+    "source_timeout",
+    "result_cache",
+    "result_cache_max_mb",
+}
+
+# The catalog generator whose inputs a pool worker measures from. This is set
+# by `_init_worker` in each worker process, and never in the parent process.
+_worker_catalog_generator: Optional["MetacalCatalogGenerator"] = None
+
+
+def _init_worker(catalog_generator: "MetacalCatalogGenerator"):
+    """Initialize a pool worker with the catalog generator.
+
+    Workers are forked, so the mosaic arrays of ``catalog_generator`` are
+    shared with the parent process copy-on-write and are never pickled.
+    """
+    global _worker_catalog_generator
+    _worker_catalog_generator = catalog_generator
+
+
+def _measure_in_worker(indices: np.ndarray) -> Tuple[np.ndarray, List[Dict[str, Any]]]:
+    """Measure a chunk of sources of the catalog in a pool worker.
+
+    The records of the chunk are returned as one structured array. The
+    diagnostics, e.g., PSF cache hits, are returned along with them, since
+    the parent process cannot see the state of the worker.
+    """
+    assert _worker_catalog_generator is not None
+    return _worker_catalog_generator._measure_chunk(indices)
+
 
 class MetacalCatalogGenerator:
     """
@@ -31,11 +103,21 @@ class MetacalCatalogGenerator:
         seg_map: Optional[str] = None,
         sep_cat: Optional[str] = None,
         psf_images: Optional[str] = None,
+        memmap: Optional[bool] = None,
         output_cat: Optional[str] = None,
         overwrite: Optional[bool] = None,
+        resume: Optional[bool] = None,
         log_file: Optional[str] = None,
         seed: Optional[int] = 1357,
         weight_fwhm=None,
+        nproc: Optional[int] = None,
+        tile_size: Optional[int] = None,
+        profile: Optional[Union[bool, str]] = None,
+        heartbeat: Optional[str] = None,
+        where: Optional[str] = None,
+        region: Optional[Sequence[float]] = None,
+        sky_region: Optional[Sequence[float]] = None,
+        result_cache: Optional[str] = None,
     ):
         _empty_config: Mapping[str, Any] = {"name": None, "inputs": {}, "measurement": {}, "logging": {}}
         self.config = self._parse_config(config) if config else _empty_config
@@ -59,17 +141,21 @@ class MetacalCatalogGenerator:
         self.seg_map_path = seg_map if seg_map else self.config.get("inputs", {}).get("seg_map")
         self.sep_cat_path = sep_cat if sep_cat else self.config.get("inputs", {}).get("sep_cat")
         self.psf_images_path = psf_images if psf_images else self.config.get("inputs", {}).get("psf_images")
+        self.memmap = memmap if memmap is not None else self.config.get("inputs", {}).get("memmap", False)
 
         self.output_cat_path = output_cat if output_cat else self.config.get("outputs", {}).get("output_cat")
         self.overwrite = (
             overwrite if overwrite is not None else self.config.get("outputs", {}).get("overwrite", False)
         )
 
+        self.resume = resume if resume is not None else self.config.get("outputs", {}).get("resume", False)
+        self.chunk_size: int = self.config.get("outputs", {}).get("chunk_size", 1000)
+        # The format of the output catalog, which is otherwise guessed from
+        # the extension of output_cat, see `writers.get_writer`.
+        self.output_format: Optional[str] = self.config.get("outputs", {}).get("format")
+
         if self.output_cat_path is None:
             raise ValueError("output_cat is required")
-        if self.overwrite is False:
-            if os.path.exists(self.output_cat_path):
-                raise FileExistsError(f"Output file {self.output_cat_path} already exists")
 
         for filepath in (
             "drizzle_image",
@@ -91,17 +177,72 @@ class MetacalCatalogGenerator:
                 )
 
         # Type hints only. These will be populated by the load_all method.
-        self.drizzle_image: galsim.Image
-        self.drizzle_weight: galsim.Image
-        self.noise_rms_map: galsim.Image
-        self.seg_map: photutils.SegmentationImage
+        # If memmap is True, the images are MosaicImage instances instead.
+        self.drizzle_image: Union[galsim.Image, MosaicImage]
+        self.drizzle_weight: Union[galsim.Image, MosaicImage]
+        self.noise_rms_map: Union[galsim.Image, MosaicImage]
+        # The labels and bounds of the segments, see `stamps.find_segments`.
+        self.segments: Optional[Tuple[np.ndarray, np.ndarray]]
+        self.seg_image: Union[galsim.Image, MosaicImage]
         self.sep_cat: fits.fitsrec.FITS_rec
-        self.psf_images: List[galsim.Image]
+        self.psf_images: PSFCube
+        self.mosaic_bounds: galsim.BoundsI
+        # Set up by `setup`, once the inputs are validated.
+        self.rec_gen: MetacalRecordGenerator
+        self.footprints: Footprints
+        # The (N, 4) (xmin, xmax, ymin, ymax) of the segments of the sources.
+        self.source_bboxes: np.ndarray
 
         self.seed = seed
         self.weight_fwhm = (
             weight_fwhm if weight_fwhm else self.config.get("measurement", {}).get("weight_fwhm")
         )
+        # Counts of events during the measurement, e.g., PSF cache hits.
+        self.stats: Counter = Counter()
+        # If profile is a path, the per-source timings are also written to it.
+        self.profile_path = profile if profile is not None else self.config.get("logging", {}).get("profile")
+        self.profile: Optional[Profile] = Profile() if self.profile_path else None
+        self.nproc: int = nproc if nproc else self.config.get("measurement", {}).get("nproc", 1)
+        if self.nproc < 1:
+            raise ValueError(f"nproc must be a positive integer, got {self.nproc}")
+
+        self.tile_size: Optional[int] = (
+            tile_size if tile_size else self.config.get("measurement", {}).get("tile_size")
+        )
+        self.tile_overlap: int = self.config.get("measurement", {}).get("tile_overlap", 256)
+        if self.tile_size and not self.memmap:
+            self.logger.info("Memory-mapping the inputs for the tiled mode")
+            self.memmap = True
+        # The metacal shear step, which the responses are computed with.
+        self.step: float = self.config.get("measurement", {}).get("step", 0.01)
+        # The measurement of a source is aborted after source_timeout seconds.
+        self.source_timeout: Optional[float] = self.config.get("measurement", {}).get("source_timeout")
+        # The progress is logged every progress_interval seconds, and written
+        # to the heartbeat JSON file if given.
+        self.progress_interval: float = self.config.get("logging", {}).get("progress_interval", 60.0)
+        self.heartbeat_path: Optional[str] = (
+            heartbeat if heartbeat else self.config.get("logging", {}).get("heartbeat")
+        )
+        self.progress: Optional[Progress] = None
+        self._stamp_sizes: Optional[np.ndarray] = None
+        # The records of the sources whose inputs and config are unchanged
+        # are read from this directory instead of being measured again.
+        self.result_cache_path: Optional[str] = (
+            result_cache if result_cache else self.config.get("measurement", {}).get("result_cache")
+        )
+        self.result_cache_max_mb: Optional[float] = self.config.get("measurement", {}).get(
+            "result_cache_max_mb", 4096
+        )
+        self.result_cache: Optional[ResultCache] = None
+        # Only the sources that match the selection are measured, see
+        # `selection.select_sources`.
+        self.where: Optional[str] = where if where else self.config.get("selection", {}).get("where")
+        self.region: Optional[Sequence[float]] = (
+            region if region is not None else self.config.get("selection", {}).get("region")
+        )
+        self.sky_region: Optional[Sequence[float]] = (
+            sky_region if sky_region is not None else self.config.get("selection", {}).get("sky_region")
+        )
 
     @staticmethod
     def _parse_config(config_path: str) -> Mapping[str, Any]:
@@ -146,99 +287,913 @@ class MetacalCatalogGenerator:
 
         """
         assert self.drizzle_image.array.shape == self.drizzle_weight.array.shape
-        assert self.drizzle_image.array.shape == self.seg_map.shape
+        assert self.drizzle_image.array.shape == self.seg_image.array.shape
         assert self.drizzle_image.array.shape == self.noise_rms_map.array.shape
         assert len(self.psf_images) == self.sep_cat.size
         self.logger.info("ALl is well")
 
-    def load_all(self):
-        hdu_list = None
-        for attr in (
-            "drizzle_image",
-            "drizzle_weight",
-            "noise_rms_map",
-        ):
-            try:
-                hdu_list = fits.open(getattr(self, attr + "_path"))
-                hdu = hdu_list[0]
-                assert hdu.is_image
-                setattr(self, attr, galsim.Image(hdu.data))
-            except (AssertionError, IndexError, IOError) as e:
-                self.logger.error(e)
-                raise e
-            finally:
-                if hdu_list is not None:
-                    hdu_list.close()
+    def check(self):
+        """
+        Check that the inputs are consistent, from their FITS headers only.
 
-        try:
-            hdu_list = fits.open(self.seg_map_path)
+        This is a quick preflight of `validate`, e.g., before submitting a
+        long run. No pixels are read and the measurement is not set up, so it
+        takes a fraction of a second even for the largest mosaics. All the
+        problems found are logged before raising.
+
+        Raises
+        ------
+        ValueError
+            If the inputs are inconsistent.
+        """
+        from astropy.io import fits
+
+        problems = []
+        shapes = {}
+        for name in ("drizzle_image", "drizzle_weight", "noise_rms_map", "seg_map"):
+            path = getattr(self, f"{name}_path")
+            header = fits.getheader(path, 0)
+            if header.get("NAXIS") != 2:
+                problems.append(f"{name} ({path}) is not a 2D image")
+                continue
+            shapes[name] = (header["NAXIS2"], header["NAXIS1"])
+        if len(set(shapes.values())) > 1:
+            problems.append(
+                "The images have different shapes: "
+                + ", ".join(f"{name} {shape}" for name, shape in shapes.items())
+            )
+
+        header = fits.getheader(self.sep_cat_path, 1)
+        num_sources = header["NAXIS2"] if header.get("XTENSION") == "BINTABLE" else None
+        if num_sources is None:
+            problems.append(f"HDU 1 of sep_cat ({self.sep_cat_path}) is not a binary table")
+
+        header = fits.getheader(self.psf_images_path, 1)
+        if header.get("NAXIS") != 3:
+            problems.append(f"HDU 1 of psf_images ({self.psf_images_path}) is not an image cube")
+        elif num_sources is not None and header["NAXIS3"] != num_sources:
+            problems.append(
+                f"There are {header['NAXIS3']} PSF images for the {num_sources} sources in sep_cat"
+            )
+
+        for problem in problems:
+            self.logger.error(problem)
+        if problems:
+            raise ValueError(f"Found {len(problems)} problems with the inputs of {self.config_path}")
+        self.logger.info(
+            "The inputs of %d sources in a %s mosaic are consistent", num_sources, shapes["drizzle_image"]
+        )
+
+    def load_all(self, segmentation: bool = True):
+        """
+        Read all the input products.
+
+        The products are read concurrently in a pool of threads, so that the
+        reads, which are mostly waiting on the (network) filesystem, overlap.
+        The number of threads is ``inputs.io_threads``, by default one per
+        product.
+
+        Parameters
+        ----------
+        segmentation : bool, optional
+            Also find the segments of the segmentation map, which scans the
+            whole map. They are only needed to find the footprints of the
+            sources, see `_setup_measurement`.
+        """
+        from loaders import PSFCube, read_image
+
+        readers: Dict[str, Callable[[], Any]] = {
+            "drizzle_image": lambda: read_image(self.drizzle_image_path, memmap=self.memmap),
+            "drizzle_weight": lambda: read_image(self.drizzle_weight_path, memmap=self.memmap),
+            "noise_rms_map": lambda: read_image(self.noise_rms_map_path, memmap=self.memmap),
+            "seg_map": lambda: self._read_seg_map(segmentation),
+            "psf_images": lambda: PSFCube(self.psf_images_path, hdu=1),
+            "sep_cat": self._read_sep_cat,
+        }
+        io_threads = self.config.get("inputs", {}).get("io_threads", len(readers))
+        with ThreadPoolExecutor(max_workers=io_threads) as executor:
+            futures = {attr: executor.submit(reader) for attr, reader in readers.items()}
+            for attr, future in futures.items():
+                try:
+                    value = future.result()
+                except Exception as e:
+                    self.logger.error(e)
+                    raise e
+                if attr == "seg_map":
+                    self.segments, self.seg_image = value
+                else:
+                    setattr(self, attr, value)
+        self.mosaic_bounds = self.drizzle_image.bounds
+
+    def _read_seg_map(
+        self, segmentation: bool = True
+    ) -> Tuple[Optional[Tuple[np.ndarray, np.ndarray]], Union[galsim.Image, MosaicImage]]:
+        """Read the segments of the segmentation map, and the image of it.
+
+        The segments are found block by block, so that a memory-mapped map
+        is never read whole. Without ``segmentation``, only the image to cut
+        stamps of is made, and the segments are None.
+        """
+        import galsim
+        from astropy.io import fits
+        from loaders import MosaicImage
+        from stamps import find_segments
+
+        with fits.open(self.seg_map_path, memmap=self.memmap) as hdu_list:
             hdu = hdu_list[0]
             assert hdu.is_image
-            self.seg_map = photutils.SegmentationImage(hdu.data)
-        except (AssertionError, IndexError, IOError) as e:
-            self.logger.error(e)
-            raise e
-        finally:
-            if hdu_list is not None:
-                hdu_list.close()
+            data = hdu.data
+        segments = find_segments(data) if segmentation else None
+        # Wrap the segmentation array in a galsim.Image only once, so that
+        # the per-source stamps are cut out of a shared view. GalSim does
+        # not support int64 images, so cast it once here if needed.
+        if self.memmap:
+            seg_image = MosaicImage(data, dtype=np.int32)
+        else:
+            seg_image = galsim.Image(np.asarray(data, dtype=np.int32))
+        return segments, seg_image
 
-        try:
-            self.psf_images = galsim.fits.readCube(self.psf_images_path, hdu=1)
-        except Exception as e:
-            self.logger.error(e)
-            raise e
+    def _read_sep_cat(self) -> fits.fitsrec.FITS_rec:
+        """Read the SExtractor catalog."""
+        from astropy.io import fits
 
-        try:
-            hdu_list = fits.open(self.sep_cat_path)
+        with fits.open(self.sep_cat_path) as hdu_list:
             hdu = hdu_list[1]
             assert not hdu.is_image
-            self.sep_cat = hdu.data
-        except (AssertionError, IndexError, IOError) as e:
-            self.logger.error(e)
-            raise e
-        finally:
-            if hdu_list is not None:
-                hdu_list.close()
+            return hdu.data
 
-    def _make_catalog(self, record_list: Sequence[MetacalRecord]):
-        """Make a catalog of metacal results"""
+    def _check_output(self, path: str):
+        """Check that the output catalog can be written to ``path``."""
+        if self.overwrite is False and self.resume is False:
+            if os.path.exists(path):
+                raise FileExistsError(f"Output file {path} already exists")
 
-        dtypes = record_list[0].dtypes()
-        recarray = np.rec.array(record_list, dtype=dtypes)
+    def _make_catalog(self, records: Iterable[np.ndarray], writer: CatalogWriter):
+        """Make a catalog of metacal results, writing the records in chunks
 
-        # cols = [fits.Column(name=k, array=recarray[k], format="K") for k, _ in dtypes]
-        # hdu = fits.BinTableHDU.from_columns(cols)
-        hdu = fits.BinTableHDU(data=recarray)
-        hdu.writeto(self.output_cat_path, overwrite=True)
+        The response columns are computed for each chunk in one pass, just
+        before it is written.
+        """
+
+        pending: List[np.ndarray] = []
+        num_pending = 0
+        for chunk in records:
+            pending.append(chunk)
+            num_pending += len(chunk)
+            if num_pending >= self.chunk_size:
+                merged = pending[0] if len(pending) == 1 else np.concatenate(pending)
+                writer.write(compute_responses(merged, step=self.step))
+                pending, num_pending = [], 0
+        if pending:
+            writer.write(compute_responses(np.concatenate(pending), step=self.step))
+
+    def _has_selection(self) -> bool:
+        """Return whether only some of the sources are to be measured."""
+        return bool(self.where) or self.region is not None or self.sky_region is not None
+
+    def _selected_indices(self) -> np.ndarray:
+        """Return the indices of the sources that match the selection."""
+        from selection import select_sources
+
+        if not self._has_selection():
+            return np.arange(len(self.sep_cat))
+        indices = select_sources(
+            self.sep_cat, where=self.where, region=self.region, sky_region=self.sky_region
+        )
+        self.logger.info("Selected %d of %d sources", len(indices), len(self.sep_cat))
+        return indices
+
+    def _source_bbox(self, n: int) -> galsim.BoundsI:
+        """Return the bounding box of the segment of the n-th source."""
+        import galsim
+
+        return galsim.BoundsI(*map(int, self.source_bboxes[n]))
+
+    def _source_bboxes(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """Return the corners of the bounding boxes of all the sources.
+
+        These are the (xmin, xmax, ymin, ymax) of the segments of the sources
+        in the segmentation map, as arrays, with the zero-based minima and
+        exclusive maxima of the bounding boxes of photutils.
+        """
+        assert self.segments is not None
+        labels, bounds = self.segments
+        ids = np.asarray(self.sep_cat["ID"], dtype=np.int64)
+        rows = np.minimum(np.searchsorted(labels, ids), len(labels) - 1)
+        if np.any(labels[rows] != ids):
+            raise ValueError("Some of the sources of the catalog are not in the segmentation map")
+        corners = bounds[rows] - [1, 0, 1, 0]
+        return corners[:, 0], corners[:, 1], corners[:, 2], corners[:, 3]
+
+    def _measure_source(
+        self, n: int, out: np.void, stamp: Optional[Stamp] = None, psf_image: Optional[galsim.Image] = None
+    ) -> np.void:
+        """Measure the n-th source of the SExtractor catalog into ``out``.
+
+        The ``stamp`` and ``psf_image`` of the source are cut and read here,
+        unless they were already, e.g., to look the source up in the cache.
+        """
+        if psf_image is None:
+            with self.rec_gen.timer.stage("psf"):
+                psf_image = self.psf_images[n]
+        return self.rec_gen.measure(
+            n,
+            self.drizzle_image,  # [bbox],
+            self.drizzle_weight,  # [bbox],
+            self.noise_rms_map,  # [bbox],
+            self.seg_image,  # [bbox],
+            self._source_bbox(n),
+            self.sep_cat[n],
+            psf_image,
+            mosaic_bounds=self.mosaic_bounds,
+            out=out,
+            footprints=self.footprints,
+            stamp=stamp,
+        )
+
+    def _measure_with_diagnostics(
+        self, n: int, out: np.void, stamp: Optional[Stamp] = None, psf_image: Optional[galsim.Image] = None
+    ) -> Dict[str, Any]:
+        """Measure the n-th source into ``out``, returning the diagnostics."""
+        start = time.perf_counter()
+        try:
+            with self.rec_gen.timer.stage("total"), self._time_limit():
+                self._measure_source(n, out, stamp=stamp, psf_image=psf_image)
+        except Exception as error:
+            self._fail_source(n, out, error)
+        return {
+            "stats": self.rec_gen.pop_stats(),
+            "timings": self.rec_gen.timer.pop(),
+            "seconds": time.perf_counter() - start,
+        }
+
+    def _time_limit(self, num_sources: int = 1):
+        """Return a context manager that limits the time to measure sources."""
+        if not self.source_timeout:
+            return contextlib.nullcontext()
+        import utils
+
+        return utils.time_limit(self.source_timeout * num_sources)
+
+    def _fail_source(self, n: int, out: np.void, error: Exception):
+        """
+        Record the failure of the measurement of the n-th source into ``out``.
+
+        The failure is logged with the end of its traceback, and the record
+        is filled with `MetacalRecord.fill_failed`, so that the run goes on.
+        """
+        import utils
+
+        failure = FAILED_TIMEOUT if isinstance(error, utils.TimeLimitExceeded) else FAILED_EXCEPTION
+        MetacalRecord.fill_failed(out, n, failure)
+        self.logger.error(
+            "Failed to measure source %d (ID %d):\n%s",
+            n,
+            self.sep_cat[n]["ID"],
+            "".join(traceback.format_exception(type(error), error, error.__traceback__, limit=-3)).rstrip(),
+        )
+
+    def _measure_chunk(self, indices: np.ndarray) -> Tuple[np.ndarray, List[Dict[str, Any]]]:
+        """
+        Measure a chunk of sources.
+
+        Every measurement writes its fields straight into its row of a
+        preallocated structured array, without intermediate objects.
 
-    def measure(self):
-        for n in range(0, len(self.sep_cat)):
-            sep_rec = self.sep_cat[n]
-            rec_id: int = sep_rec["ID"]  # type: ignore
-            bbox = self.seg_map.bbox[rec_id - 1]
-            bbox = galsim.BoundsI(xmin=bbox.ixmin, xmax=bbox.ixmax, ymin=bbox.iymin, ymax=bbox.iymax)
+        Returns
+        -------
+        records : np.ndarray
+            The records of the sources, with the dtype of
+            `MetacalRecord.dtypes`, in the order of ``indices``.
+        diagnostics : list [dict]
+            The measurement diagnostics of each source.
+        """
+        if self.result_cache is not None:
+            return self._measure_cached(indices)
+        return self._measure_sources(indices)
+
+    def _measure_sources(
+        self,
+        indices: np.ndarray,
+        stamps: Optional[Sequence[Stamp]] = None,
+        psf_images: Optional[Sequence[galsim.Image]] = None,
+    ) -> Tuple[np.ndarray, List[Dict[str, Any]]]:
+        """Measure a chunk of sources, in batches or one at a time.
 
-            rec = self.rec_gen.measure(
+        The ``stamps`` and ``psf_images`` of the sources may be given if they
+        were already cut and read, see `_measure_source`.
+        """
+        if self.rec_gen.batched:
+            return self._measure_batch(indices, stamps, psf_images)
+        records = MetacalRecord.empty(len(indices))
+        diagnostics = [
+            self._measure_with_diagnostics(
                 n,
-                self.drizzle_image,  # [bbox],
-                self.drizzle_weight,  # [bbox],
-                self.noise_rms_map,  # [bbox],
-                galsim.Image(self.seg_map.data),  # [bbox],
-                bbox,
-                sep_rec,
-                self.psf_images[n],
+                records[i],
+                stamp=None if stamps is None else stamps[i],
+                psf_image=None if psf_images is None else psf_images[i],
             )
-            yield rec
+            for i, n in enumerate(indices)
+        ]
+        return records, diagnostics
 
-    def run(self):
+    def _measure_cached(self, indices: np.ndarray) -> Tuple[np.ndarray, List[Dict[str, Any]]]:
         """
-        Run the metacal catalog generation
+        Measure a chunk of sources, reading their records from the cache.
+
+        Only the sources that are not in `result_cache` are measured, and
+        their records are then stored in it, unless their measurement failed,
+        e.g., because it timed out, which may not happen again. The stamps
+        and PSF images that the keys are computed from are reused to measure
+        the sources.
+        """
+        from stamps import cut_stamp
+
+        assert self.result_cache is not None
+        records = MetacalRecord.empty(len(indices))
+        diagnostics: List[Optional[Dict[str, Any]]] = []
+        keys, stamps, psf_images = [], [], []
+        for i, n in enumerate(indices):
+            start = time.perf_counter()
+            stamps.append(
+                cut_stamp(
+                    self.footprints.bounds(n),
+                    self.drizzle_image,
+                    self.drizzle_weight,
+                    self.noise_rms_map,
+                    self.seg_image,
+                    self.footprints.labels[n],
+                    has_neighbors=self.footprints.has_neighbors(n),
+                )
+            )
+            psf_images.append(self.psf_images[n])
+            keys.append(self._cache_key(n, stamps[-1], psf_images[-1]))
+            cached = self.result_cache.get(keys[-1], records.dtype)
+            if cached is None:
+                diagnostics.append(None)
+                continue
+            records[i] = cached
+            records[i]["index"] = n
+            diagnostics.append(
+                {"stats": Counter(result_cache_hits=1), "timings": {}, "seconds": time.perf_counter() - start}
+            )
+
+        missing = [i for i, source_diagnostics in enumerate(diagnostics) if source_diagnostics is None]
+        if missing:
+            measured, measured_diagnostics = self._measure_sources(
+                indices[missing], [stamps[i] for i in missing], [psf_images[i] for i in missing]
+            )
+            records[missing] = measured
+            for i, record, source_diagnostics in zip(missing, measured, measured_diagnostics):
+                source_diagnostics["stats"]["result_cache_misses"] += 1
+                diagnostics[i] = source_diagnostics
+                if record["flag_failure"] == 0:
+                    self.result_cache.put(keys[i], record)
+        return records, cast(List[Dict[str, Any]], diagnostics)
+
+    def _cache_key(self, n: int, stamp: Stamp, psf_image: galsim.Image) -> str:
+        """Return the key of the record of the n-th source in the cache.
+
+        This must be computed before the stamp is measured, which modifies
+        its image.
+        """
+        assert self.result_cache is not None
+        return self.result_cache.key(
+            self.footprints.labels[n],
+            self.footprints.stamp_bounds[n],
+            [stamp.image.array, stamp.weight.array, stamp.noise_rms, stamp.mask, psf_image.array],
+        )
+
+    def _measure_batch(
+        self,
+        indices: np.ndarray,
+        stamps: Optional[Sequence[Stamp]] = None,
+        psf_images: Optional[Sequence[galsim.Image]] = None,
+    ) -> Tuple[np.ndarray, List[Dict[str, Any]]]:
+        """
+        Measure a batch of sources whose stamps have the same shape at once.
+
+        The timings of the batch are shared evenly amongst its sources. If
+        the batch fails, its sources are measured again one at a time, so
+        that only the sources that fail alone are recorded as failed. Their
+        stamps are then cut again, since the measurement modifies them.
+        """
+        timer = self.rec_gen.timer
+        start = time.perf_counter()
+        try:
+            with timer.stage("total"), self._time_limit(len(indices)):
+                if psf_images is None:
+                    with timer.stage("psf"):
+                        psf_images = [self.psf_images[n] for n in indices]
+                records = self.rec_gen.measure_batch(
+                    indices,
+                    self.drizzle_image,
+                    self.drizzle_weight,
+                    self.noise_rms_map,
+                    self.seg_image,
+                    [self._source_bbox(n) for n in indices],
+                    psf_images,
+                    mosaic_bounds=self.mosaic_bounds,
+                    footprints=self.footprints,
+                    stamps=stamps,
+                )
+        except Exception as error:
+            if len(indices) > 1:
+                self.logger.warning(
+                    "Failed to measure a batch of %d sources, measuring them one at a time: %s",
+                    len(indices),
+                    error,
+                )
+                results = [self._measure_batch(source) for source in np.split(indices, len(indices))]
+                return (
+                    np.concatenate([records for records, _ in results]),
+                    [source_diagnostics for _, diagnostics in results for source_diagnostics in diagnostics],
+                )
+            records = MetacalRecord.empty(1)
+            self._fail_source(indices[0], records[0], error)
+        seconds = (time.perf_counter() - start) / len(indices)
+        stats, timings = self.rec_gen.pop_stats(), timer.pop()
+        if timings is not None:
+            timings = {
+                stage: [wall / len(indices), cpu / len(indices)] for stage, (wall, cpu) in timings.items()
+            }
+        diagnostics = [
+            {"stats": stats if i == 0 else Counter(), "timings": timings, "seconds": seconds}
+            for i in range(len(indices))
+        ]
+        return records, diagnostics
+
+    def _plan_batches(self, indices: np.ndarray) -> List[np.ndarray]:
+        """
+        Group the sources into batches by the shape of their stamps.
+
+        The batches have at most ``measurement.batch_size`` sources each, and
+        are ordered by the shape of the stamps.
+        """
+        batch_size = self.config["measurement"].get("batch_size", 64)
+        stamp_bounds = self.footprints.stamp_bounds[indices]
+        ny = stamp_bounds[:, 3] - stamp_bounds[:, 2] + 1
+        nx = stamp_bounds[:, 1] - stamp_bounds[:, 0] + 1
+        order = np.lexsort((nx, ny))
+        indices, ny, nx = indices[order], ny[order], nx[order]
+
+        batches = []
+        starts = np.flatnonzero(np.r_[True, (ny[1:] != ny[:-1]) | (nx[1:] != nx[:-1])])
+        for bucket in np.split(indices, starts[1:]):
+            batches.extend(np.split(bucket, np.arange(batch_size, len(bucket), batch_size)))
+        self.logger.info(
+            "Grouped %d sources into %d batches of %d stamp shapes", len(indices), len(batches), len(starts)
+        )
+        return batches
+
+    def _collect_diagnostics(self, n: int, diagnostics: Mapping[str, Any]):
+        """Add the measurement diagnostics of the n-th source to the run."""
+        self.stats.update(diagnostics["stats"])
+        if self.profile is not None:
+            self.profile.add(n, diagnostics["timings"])
+
+    def measure(self, indices: Optional[Sequence[int]] = None) -> Iterator[np.ndarray]:
+        """
+        Measure the sources in the catalog, yielding chunks of records.
+
+        Parameters
+        ----------
+        indices : Sequence[int], optional
+            The indices of the sources to measure. All the sources that match
+            the selection are measured if not given.
+
+        Yields
+        ------
+        records : np.ndarray
+            Structured arrays with the dtype of `MetacalRecord.dtypes`, with
+            the records of consecutive chunks of ``indices``.
+
+        Notes
+        -----
+        If ``nproc`` is larger than 1, the sources are distributed over a pool
+        of forked worker processes that share the input arrays read-only.
+        Since every source has its own random number streams, keyed by its
+        ID, the records do not depend on the number of processes, nor on the
+        order or the subset of the sources measured.
+
+        With more than one process, the sources with the largest stamps are
+        measured first, so that the workers finish together instead of
+        waiting for a few slow sources at the end. The chunks are then
+        ordered by the size of the stamps instead.
+
+        With ``measurement.batched``, the sources are grouped into batches by
+        the shape of their stamps, and each batch is measured at once, so the
+        chunks are ordered by the shape of the stamps instead.
+        """
+        indices = self._selected_indices() if indices is None else np.asarray(indices)
+        if len(indices) == 0:
+            return
+        # Report the progress of this call alone, unless it is part of a run.
+        with contextlib.ExitStack() as stack:
+            if self.progress is None:
+                stack.enter_context(self._tracking_progress(len(indices)))
+            chunks = self._plan_chunks(indices)
+
+            if self.nproc == 1:
+                results: Iterable[Tuple[np.ndarray, List[Dict[str, Any]]]] = map(self._measure_chunk, chunks)
+                yield from self._collect_chunks(results)
+                return
+
+            self.logger.info("Measuring %d sources with %d processes", len(indices), self.nproc)
+            context = multiprocessing.get_context("fork")
+            with context.Pool(self.nproc, initializer=_init_worker, initargs=(self,)) as pool:
+                yield from self._collect_chunks(pool.imap(_measure_in_worker, chunks))
+
+    def _plan_chunks(self, indices: np.ndarray) -> List[np.ndarray]:
+        """Split the sources to measure into the chunks given to a worker.
+
+        With more than one process, the most expensive chunks, i.e., those
+        with the largest stamps, come first.
+        """
+        if self.rec_gen.batched:
+            batches = self._plan_batches(indices)
+            if self.nproc > 1:
+                area = self._stamp_areas()
+                batches.sort(key=lambda batch: -area[batch].sum())
+            return batches
+        if self.nproc == 1:
+            chunksize = self.chunk_size
+        else:
+            chunksize = min(64, max(1, len(indices) // (4 * self.nproc)))
+            indices = indices[np.argsort(-self._stamp_areas()[indices], kind="stable")]
+        return np.split(indices, np.arange(chunksize, len(indices), chunksize))
+
+    def _stamp_areas(self) -> np.ndarray:
+        """Return the number of pixels in the stamp of every source."""
+        bounds = self.footprints.stamp_bounds
+        return (bounds[:, 1] - bounds[:, 0] + 1) * (bounds[:, 3] - bounds[:, 2] + 1)
+
+    def _collect_chunks(self, results: Iterable[Tuple[np.ndarray, List[Dict[str, Any]]]]):
+        """Collect the diagnostics of measured chunks, yielding the records."""
+        for records, diagnostics in results:
+            for n, source_diagnostics in zip(records["index"], diagnostics):
+                self._collect_diagnostics(n, source_diagnostics)
+            if self.progress is not None:
+                failed = np.zeros(len(records), dtype=bool)
+                for shear_type in SHEAR_TYPES:
+                    failed |= shear_field(records, "flag", shear_type) != 0
+                self.progress.update(
+                    self._source_stamp_sizes()[records["index"]],
+                    [source_diagnostics["seconds"] for source_diagnostics in diagnostics],
+                    failed,
+                )
+            yield records
+
+    def _source_stamp_sizes(self) -> np.ndarray:
+        """Return the side of the stamp of every source, in pixels."""
+        if self._stamp_sizes is None:
+            bounds = self.footprints.stamp_bounds
+            self._stamp_sizes = np.maximum(bounds[:, 1] - bounds[:, 0], bounds[:, 3] - bounds[:, 2]) + 1
+        return self._stamp_sizes
+
+    @contextlib.contextmanager
+    def _tracking_progress(self, total: int, name: Optional[str] = None) -> Iterator[Progress]:
+        """Report the progress of the measurement of ``total`` sources."""
+        self.progress = Progress(
+            total, interval=self.progress_interval, heartbeat=self.heartbeat_path, name=name
+        )
+        try:
+            yield self.progress
+        except BaseException:
+            self.progress.finish("failed")
+            raise
+        else:
+            self.progress.finish()
+        finally:
+            self.progress = None
+
+    def _log_stats(self):
+        """Log a summary of the diagnostics of the measurement."""
+        hits, misses = self.stats["psf_cache_hits"], self.stats["psf_cache_misses"]
+        if hits + misses > 0:
+            hit_rate = 100 * hits / (hits + misses)
+            self.logger.info("PSF cache: %d hits and %d misses (%.1f%% hit rate)", hits, misses, hit_rate)
+
+        if self.result_cache is not None:
+            hits, misses = self.stats["result_cache_hits"], self.stats["result_cache_misses"]
+            hit_rate = 100 * hits / (hits + misses) if hits + misses > 0 else 0.0
+            num_evicted, evicted_bytes = self.result_cache.evict()
+            num_records, num_bytes = self.result_cache.usage()
+            self.logger.info(
+                "Result cache: %d hits and %d misses (%.1f%% hit rate), evicted %d records (%.1f MB), "
+                "%d records (%.1f MB) in %s",
+                hits,
+                misses,
+                hit_rate,
+                num_evicted,
+                evicted_bytes / 2**20,
+                num_records,
+                num_bytes / 2**20,
+                self.result_cache.directory,
+            )
+
+        if self.profile is not None and self.profile.sources:
+            self.logger.info("Time spent in each stage of the measurement:\n%s", self.profile.table())
+            if isinstance(self.profile_path, str):
+                self.profile.write(self.profile_path)
+                self.logger.info("Wrote the profile to %s", self.profile_path)
+
+    def _plan_tiles(self) -> Tuple[List[Tuple[galsim.BoundsI, galsim.BoundsI]], np.ndarray]:
         """
+        Split the mosaic into tiles and assign every source to a tile.
+
+        Returns
+        -------
+        tiles : list [(galsim.BoundsI, galsim.BoundsI)]
+            The (core, tile) bounds of the tiles.
+        assignment : np.ndarray
+            The index of the tile that each source is measured in.
+        """
+        import galsim
+        import utils
+
+        assert self.tile_size is not None
+        tiles = utils.make_tiles(self.mosaic_bounds, self.tile_size, self.tile_overlap)
+        stamp_bounds = self.footprints.stamp_bounds
+        assignment = np.array(
+            [utils.assign_tile(galsim.BoundsI(*map(int, bounds)), tiles) for bounds in stamp_bounds],
+            dtype=int,
+        )
+        self.logger.info("Split the mosaic into %d tiles", len(tiles))
+        return tiles, assignment
+
+    @contextlib.contextmanager
+    def _tile_inputs(self, tile: galsim.BoundsI):
+        """Temporarily replace the memory-mapped inputs by copies of a tile."""
+        attrs = ("drizzle_image", "drizzle_weight", "noise_rms_map", "seg_image")
+        mosaic = {attr: getattr(self, attr) for attr in attrs}
+        try:
+            for attr in attrs:
+                setattr(self, attr, mosaic[attr][tile])
+            yield
+        finally:
+            for attr, value in mosaic.items():
+                setattr(self, attr, value)
+
+    def _measure_tiles(
+        self,
+        indices: np.ndarray,
+        tiles: Sequence[Tuple[galsim.BoundsI, galsim.BoundsI]],
+        assignment: np.ndarray,
+    ):
+        """Measure the sources tile by tile, yielding chunks of records."""
+        for t, (_, tile) in enumerate(tiles):
+            tile_indices = indices[assignment[indices] == t]
+            if len(tile_indices) == 0:
+                continue
+            self.logger.info("Measuring %d sources in tile %d: %s", len(tile_indices), t, tile)
+            with self._tile_inputs(tile):
+                yield from self.measure(tile_indices)
+
+    def setup(self):
+        """Load and validate the inputs, and set up the measurement."""
         self.load_all()
         self.validate()
-        self.rec_gen = metacal.MetacalRecordGenerator(self.config["measurement"])
-        rec_gen = self.measure()
-        self._make_catalog(list(rec_gen))
+        self._setup_measurement()
+
+    def _setup_measurement(
+        self, footprints: Optional[Footprints] = None, source_bboxes: Optional[np.ndarray] = None
+    ):
+        """Set up the measurement, and find the stamps of all the sources.
+
+        The ``footprints`` and ``source_bboxes`` already found by another
+        catalog generator of the same field may be given instead, e.g., in
+        the pool workers of `batch.run_batch`, see `_write_footprints`.
+        """
+        import metacal
+        from stamps import Footprints
+
+        self.rec_gen = metacal.MetacalRecordGenerator(
+            self.config["measurement"],
+            seed=self.seed,
+            weight_fwhm=self.weight_fwhm,
+            profile=self.profile is not None,
+        )
+        if footprints is not None and source_bboxes is not None:
+            self.footprints, self.source_bboxes = footprints, source_bboxes
+        else:
+            start = time.perf_counter()
+            self.source_bboxes = np.stack(self._source_bboxes(), axis=1)
+            assert self.segments is not None
+            segment_labels, segment_bounds = self.segments
+            self.footprints = Footprints(
+                labels=np.asarray(self.sep_cat["ID"]),
+                stamp_bounds=self.rec_gen.stamp_bounds_batch(*self.source_bboxes.T, self.mosaic_bounds),
+                segment_bounds=segment_bounds,
+                segment_labels=segment_labels,
+            )
+            self.logger.info(
+                "Found the stamps of %d sources, %d of which have neighbors, in %.1f s",
+                len(self.footprints),
+                sum(len(neighbors) > 0 for neighbors in self.footprints.neighbors),
+                time.perf_counter() - start,
+            )
+        if self.result_cache_path:
+            from cache import ResultCache
+
+            max_bytes = None if self.result_cache_max_mb is None else int(self.result_cache_max_mb * 2**20)
+            self.result_cache = ResultCache(self.result_cache_path, max_bytes, context=self._cache_context())
+
+    def _cache_context(self) -> str:
+        """
+        Return what the records depend on besides the inputs of the sources.
+
+        These are the measurement options, except those that only change how
+        the sources are distributed, the seed, the shear types, the record
+        dtype and the version of ngmix.
+        """
+        import metacal
+
+        measurement = {
+            name: value
+            for name, value in self.config["measurement"].items()
+            if name not in _EXECUTION_OPTIONS
+        }
+        return repr(
+            sorted(
+                {
+                    "measurement": repr(sorted(measurement.items())),
+                    "weight_fwhm": self.weight_fwhm,
+                    "seed": self.seed,
+                    "shear_types": SHEAR_TYPES,
+                    "dtypes": MetacalRecord.dtypes(),
+                    "ngmix": metacal.ngmix.__version__,
+                }.items()
+            )
+        )
+
+    def _write_footprints(self, path: str):
+        """Write the footprints of the sources found by `setup` to a file."""
+        with open(path, "wb") as f:
+            pickle.dump((self.footprints, self.source_bboxes), f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def _setup_from_footprints(self, path: str):
+        """
+        Load the inputs, and set up the measurement from written footprints.
+
+        This skips the validation, and the scan of the segmentation map to
+        find the footprints, which were done once by the catalog generator
+        that wrote them with `_write_footprints`.
+        """
+        self.load_all(segmentation=False)
+        with open(path, "rb") as f:
+            footprints, source_bboxes = pickle.load(f)
+        self._setup_measurement(footprints, source_bboxes)
+
+    def run(self, tile: Optional[int] = None, shard: Optional[str] = None):
+        """
+        Run the metacal catalog generation
+
+        Parameters
+        ----------
+        tile : int, optional
+            In the tiled mode, measure only the sources assigned to this tile
+            and write them to a part of the output catalog. The parts of all
+            the tiles are then combined into one catalog with `merge`.
+        shard : str, optional
+            Measure only the i-th of N shards of the catalog, given as "i/N",
+            and write them to a part of the output catalog. The i-th shard has
+            every N-th source, starting from the i-th, so that the shards can
+            be run independently on different nodes. The parts of all the
+            shards are then combined into one catalog with `merge`.
+        """
+        import utils
+        from writers import part_path
+
+        self.setup()
+        indices = self._selected_indices()
+        output_cat_path = self.output_cat_path
+        if self.tile_size:
+            tiles, assignment = self._plan_tiles()
+            if tile is not None:
+                if not 0 <= tile < len(tiles):
+                    raise ValueError(f"tile must be between 0 and {len(tiles) - 1}, got {tile}")
+                indices = indices[assignment[indices] == tile]
+                output_cat_path = part_path(self.output_cat_path, f"tile-{tile}")
+        elif tile is not None:
+            raise ValueError("tile can only be given in the tiled mode, i.e., with tile_size")
+        if shard is not None:
+            if tile is not None:
+                raise ValueError("tile and shard cannot both be given")
+            shard_index, num_shards = utils.parse_shard(shard)
+            indices = indices[shard_index::num_shards]
+            output_cat_path = part_path(self.output_cat_path, f"shard-{shard_index}-of-{num_shards}")
+            self.logger.info("Measuring %d sources in shard %d of %d", len(indices), shard_index, num_shards)
+        self._check_output(output_cat_path)
+
+        with self._open_writer(output_cat_path, indices) as writer:
+            measured = writer.measured_indices()
+            if len(measured):
+                self.logger.info("Skipping %d sources that are already measured", len(measured))
+            todo = np.setdiff1d(indices, measured)
+            rec_gen = self._measure_tiles(todo, tiles, assignment) if self.tile_size else self.measure(todo)
+            with self._tracking_progress(len(todo)):
+                self._make_catalog(rec_gen, writer)
+        self._log_stats()
+
+    def _open_writer(self, path: str, indices: np.ndarray) -> CatalogWriter:
+        """Open the writer of the output catalog, in the output format."""
+        from writers import get_writer
+
+        return get_writer(path, self.output_format)(path, MetacalRecord.dtypes(), indices, resume=self.resume)
+
+    def merge(self):
+        """
+        Merge the parts of the output catalog written by single-tile or
+        single-shard runs.
+
+        The merged catalog is ordered by the source index. It is an error if a
+        selected source is missing from the parts or is in more than one of
+        them, or if the parts of some shards are missing.
+        """
+        from astropy.io import fits
+        from writers import merge_catalogs, part_path
+
+        self._check_output(self.output_cat_path)
+        tile_parts = sorted(glob.glob(part_path(self.output_cat_path, "tile-*")))
+        shard_parts = sorted(glob.glob(part_path(self.output_cat_path, "shard-*-of-*")))
+        if shard_parts:
+            self._check_shards(shard_parts)
+        parts = tile_parts + shard_parts
+        if self._has_selection():
+            self.sep_cat = self._read_sep_cat()
+            indices = self._selected_indices()
+        else:
+            indices = np.arange(fits.getheader(self.sep_cat_path, 1)["NAXIS2"])
+        self.logger.info("Merging %d parts into %s", len(parts), self.output_cat_path)
+        merge_catalogs(parts, self.output_cat_path, MetacalRecord.dtypes(), indices, self.output_format)
+
+    def _check_shards(self, shard_parts: Sequence[str]):
+        """Check that the parts of all the shards of one sharding are there."""
+        root, ext = os.path.splitext(self.output_cat_path)
+        pattern = re.compile(re.escape(root) + r"\.shard-(\d+)-of-(\d+)" + re.escape(ext))
+        shards = set()
+        for path in shard_parts:
+            match = pattern.fullmatch(path)
+            if match is None:
+                raise ValueError(f"{path} is not a part of a shard of {self.output_cat_path}")
+            shards.add((int(match[1]), int(match[2])))
+        num_shards = {n for _, n in shards}
+        if len(num_shards) > 1:
+            raise ValueError(
+                f"The shards are from runs with different numbers of shards: {sorted(num_shards)}"
+            )
+        (total,) = num_shards
+        missing = sorted(set(range(total)) - {i for i, _ in shards})
+        if missing:
+            raise ValueError(f"The parts of shards {missing} of {total} are missing")
+
+    def responses(self, step: Optional[float] = None, snr_min: Optional[float] = None):
+        """
+        Recompute the responses of the output catalog, and log their means.
+
+        The response columns are recomputed in place from the raw
+        ellipticities measured on the sheared images, without refitting the
+        sources. The mean response and, if ``snr_min`` is given, the response
+        of the selection on the signal-to-noise ratio are logged.
+
+        Parameters
+        ----------
+        step : float, optional
+            The metacal shear step. Defaults to the ``measurement.step`` in
+            the config, i.e., the one the catalog was measured with.
+        snr_min : float, optional
+            The minimum signal-to-noise ratio of the selected sources.
+        """
+        from writers import get_writer
+
+        step = step if step is not None else self.step
+        writer_class = get_writer(self.output_cat_path, self.output_format)
+        data = writer_class.read(self.output_cat_path)
+        records = MetacalRecord.empty(len(data))
+        for name in records.dtype.names:
+            records[name] = data[name]
+        compute_responses(records, step=step)
+        writer_class.update(
+            self.output_cat_path, records, [name for name in records.dtype.names if name.startswith("R")]
+        )
+        self.logger.info("Recomputed the responses of %d sources with step %g", len(records), step)
+
+        def select(records: np.ndarray, shear_type: str) -> np.ndarray:
+            mask = shear_field(records, "flag", shear_type) == 0
+            if snr_min is not None:
+                mask &= shear_field(records, "snr", shear_type) > snr_min
+            return mask
+
+        self.logger.info(
+            "Mean response:\n%s", mean_response(records, step=step, mask=select(records, "noshear"))
+        )
+        if snr_min is not None:
+            self.logger.info(
+                "Selection response for snr > %g:\n%s",
+                snr_min,
+                selection_response(records, select, step=step),
+            )
 
 
 if __name__ == "__main__":
@@ -1,33 +1,151 @@
+import hashlib
 import logging
-from itertools import product
-from typing import NamedTuple, Sequence, Union
+from collections import Counter, OrderedDict
+from typing import Dict, List, NamedTuple, Optional, Sequence, Tuple, Union
 
 import galsim
+import moments
 import ngmix
 import numpy as np
 import utils
 from astropy.io import fits
 from astropy.table import Table
 from metacal_record import MetacalRecord
+from profiling import StageTimer
+from responses import SHEAR_TYPES
+from stamps import Stamp, cut_stamp
 
 __all__ = [
+    "CachedPSFRunner",
     "MetacalRecordGenerator",
 ]
 
 
+class CachedPSFRunner:
+    """
+    A PSF runner that reuses the fits of identical PSF images.
+
+    This wraps an `ngmix.runners.PSFRunner`, and caches its fits in a
+    least-recently-used cache keyed by a hash of the PSF pixels. Besides the
+    sources that share a PSF, this also saves refitting the reconvolution PSF,
+    which is the same for all the metacal shear types of a source.
+
+    Parameters
+    ----------
+    psf_runner : ngmix.runners.PSFRunner
+        The PSF runner to cache the fits of.
+    rng : np.random.RandomState
+        The random number generator used by the guesser of ``psf_runner``.
+        It is reseeded from the hash of the PSF pixels before every fit, so
+        that a fit depends only on the PSF image and not on which sources
+        were fit earlier.
+    maxsize : int, optional
+        The maximum number of PSF fits to cache.
+    stats : collections.Counter, optional
+        A counter to record the cache hits and misses in.
+    """
+
+    def __init__(
+        self,
+        psf_runner: ngmix.runners.PSFRunner,
+        rng: np.random.RandomState,
+        maxsize: int = 128,
+        stats: Optional[Counter] = None,
+    ):
+        self.psf_runner = psf_runner
+        self.rng = rng
+        self.maxsize = maxsize
+        self.stats = stats if stats is not None else Counter()
+        self._cache: OrderedDict = OrderedDict()
+
+    def __getattr__(self, name):
+        # Delegate the other attributes, e.g., the fitter, to the PSF runner.
+        if name == "psf_runner" or name.startswith("__"):
+            raise AttributeError(name)
+        return getattr(self.psf_runner, name)
+
+    @staticmethod
+    def _key(image: np.ndarray) -> bytes:
+        image = np.ascontiguousarray(image)
+        digest = hashlib.blake2b(image.tobytes(), digest_size=16)
+        digest.update(repr((image.shape, image.dtype.str)).encode())
+        return digest.digest()
+
+    def go(self, obs, set_result=True):
+        """Fit the PSF of ``obs``, or reuse the fit of an identical PSF."""
+        if not isinstance(obs, ngmix.Observation) or not set_result:
+            return self.psf_runner.go(obs=obs, set_result=set_result)
+
+        psf_obs = obs.psf
+        key = self._key(psf_obs.image)
+        if key in self._cache:
+            self.stats["psf_cache_hits"] += 1
+            self._cache.move_to_end(key)
+            result, gmix = self._cache[key]
+            psf_obs.meta["result"] = result
+            if gmix is not None:
+                psf_obs.set_gmix(gmix)
+            return result
+
+        self.stats["psf_cache_misses"] += 1
+        self.rng.seed(np.frombuffer(key, dtype=np.uint32))
+        result = self.psf_runner.go(obs=obs, set_result=set_result)
+        gmix = psf_obs.get_gmix() if psf_obs.has_gmix() else None
+        self._cache[key] = (result, gmix)
+        if len(self._cache) > self.maxsize:
+            self._cache.popitem(last=False)
+        return result
+
+
 class MetacalRecordGenerator:
     """
     A class that makes metacal measurement for a single source.
     """
 
-    def __init__(self, config, seed=1357, weight_fwhm=None):
+    def __init__(self, config, seed=1357, weight_fwhm=None, profile=False):
         self.config = config
         self.seed = seed
-        self.rng = np.random.RandomState(seed=self.seed)
-        self.galsim_rng = galsim.BaseDeviate(seed=seed)
-        self.boot = self._setup_metacal(self.rng, weight_fwhm)
+        # The generators are set to the streams of a source by `_reseed`.
+        # ngmix uses the legacy RandomState interface.
+        self.rng = np.random.RandomState(np.random.Philox(key=[self.seed, 0]))
+        self.noise_rng = np.random.Generator(np.random.Philox(key=[self.seed, 0]))
+        self.mask_neighbors = self.config.get("mask_neighbors", False)
+        self.stats: Counter = Counter()
+        self.timer = StageTimer(enabled=profile)
+        self.step = self.config.get("step", 0.01)
+        self.weight_fwhm = weight_fwhm
+        # Measure the moments of sources with stamps of the same shape at once.
+        self.batched = self.config.get("batched", False)
+        if self.batched and weight_fwhm is None:
+            raise ValueError("The batched measurement requires weight_fwhm")
+        if self.batched:
+            # Compile the moments now, so that the first source measured does
+            # not pay for it within its time limit. The pool workers inherit
+            # the compiled kernel.
+            moments.warm_up()
+        self.boot = self._setup_metacal(
+            self.rng,
+            weight_fwhm,
+            psf_cache_size=self.config.get("psf_cache_size", 128),
+            stats=self.stats,
+            step=self.step,
+        )
 
-    def measure(self, n, image, weight, noise_rms, seg_map, bbox, sep_record, psf_image) -> MetacalRecord:
+    def measure(
+        self,
+        n,
+        image,
+        weight,
+        noise_rms,
+        seg_map,
+        bbox,
+        sep_record,
+        psf_image,
+        mosaic_bounds=None,
+        out=None,
+        footprints=None,
+        stamp=None,
+    ) -> np.void:
         """
         Measure the metacal for a single source.
 
@@ -49,44 +167,333 @@ class MetacalRecordGenerator:
             The SExtractor record corresponding to the source.
         psf_image : galsim.Image
             The PSF image at the centroid of the source.
+        mosaic_bounds : galsim.BoundsI, optional
+            The bounds of the full mosaic. This must be given if ``image`` is
+            only a tile of the mosaic, so that the stamp is the same as it
+            would be in the full mosaic. Defaults to ``image.bounds``.
+        out : np.void, optional
+            A row of a structured array with the dtype of
+            `MetacalRecord.dtypes`, e.g., from `MetacalRecord.empty`, to
+            write the record into. A new one is allocated if not given.
+        footprints : stamps.Footprints, optional
+            The precomputed stamps and neighbors of the sources of the
+            catalog. Without them, the stamp bounds are computed from
+            ``bbox``, and the neighbors are looked for in every stamp.
+        stamp : stamps.Stamp, optional
+            The stamp of the source, if it was already cut out of the
+            mosaics, e.g., by `stamps.cut_stamp`. Its image is modified.
+
+        Returns
+        -------
+        record : np.void
+            The row that the record is written into.
 
         Notes
         -----
         The ``image``, ``weight``, ``noise_rms`` and ``seg_map`` are all views
-        and shared amongst different calls of `measure`.
+        and shared amongst different calls of `measure`. They may also be
+        memory-mapped `loaders.MosaicImage` instances, which are only read
+        within the expanded bounding box.
         A deep copy must be made before modifying any of them to avoid
         infering measurement of other sources.
+
+        The random number generators are reseeded from ``seed`` and the
+        ``ID`` of the source before measuring, so the record for a source
+        does not depend on which other sources were measured before it, or in
+        which process.
+        """
+        self._reseed(sep_record["ID"])
+
+        if stamp is None:
+            stamp = self._cut_stamp(
+                n, sep_record["ID"], image, weight, noise_rms, seg_map, bbox, mosaic_bounds, footprints
+            )
+        obs = self._make_stamp_observation(stamp, psf_image)
+        with self.timer.stage("metacal"):
+            resdict, _ = self.boot.go(obs)
+        with self.timer.stage("record"):
+            if out is None:
+                out = MetacalRecord.empty(1)[0]
+            self._make_record(n, resdict, out)
+        return out
+
+    def measure_batch(
+        self,
+        indices,
+        image,
+        weight,
+        noise_rms,
+        seg_map,
+        bboxes,
+        psf_images,
+        mosaic_bounds=None,
+        footprints=None,
+        stamps=None,
+    ) -> np.ndarray:
         """
+        Measure the metacal for a batch of sources with stamps of one shape.
+
+        The pixels of the neighbors in all the stamps are replaced by noise
+        at once, the metacal images are made for every source in turn, and
+        then the Gaussian-weighted moments of all of them are measured at
+        once with `moments.gauss_moments`, instead of one observation at a
+        time. This requires ``weight_fwhm``. The PSFs are not fit, since the
+        moments of the sources do not depend on them.
+
+        Parameters
+        ----------
+        indices : Sequence[int]
+            The indices of the sources.
+        image, weight, noise_rms, seg_map : galsim.Image
+            The mosaics, see `measure`.
+        bboxes : Sequence[galsim.BoundsI]
+            The minimal bounding boxes of the sources.
+        psf_images : Sequence[galsim.Image]
+            The PSF images of the sources.
+        mosaic_bounds : galsim.BoundsI, optional
+            The bounds of the full mosaic, see `measure`.
+        footprints : stamps.Footprints
+            The precomputed stamps and neighbors of the sources, which also
+            give the labels of the sources in ``seg_map``.
+        stamps : Sequence[stamps.Stamp], optional
+            The stamps of the sources, if they were already cut, see
+            `measure`.
+
+        Returns
+        -------
+        records : np.ndarray
+            The records of the sources, with the dtype of
+            `MetacalRecord.dtypes`.
+
+        Raises
+        ------
+        ValueError
+            If ``weight_fwhm`` or ``footprints`` are not given, or the stamps
+            of the sources do not all have the same shape.
+        """
+        if self.weight_fwhm is None:
+            raise ValueError("The batched measurement requires weight_fwhm")
+        if footprints is None:
+            raise ValueError("The batched measurement requires the footprints of the sources")
+
+        labels = footprints.labels[np.asarray(indices)]
+        if stamps is None:
+            stamps = [
+                self._cut_stamp(n, label, image, weight, noise_rms, seg_map, bbox, mosaic_bounds, footprints)
+                for n, label, bbox in zip(indices, labels, bboxes)
+            ]
+        if not self.mask_neighbors:
+            with self.timer.stage("noise"):
+                stamps = self._fill_noise_batch(labels, stamps)
+
+        stacks: Dict[str, Tuple[List[np.ndarray], List[np.ndarray], List[Tuple[float, ...]]]] = {
+            shear_type: ([], [], []) for shear_type in SHEAR_TYPES
+        }
+        for label, stamp, psf_image in zip(labels, stamps, psf_images):
+            self._reseed(label)
+            obs = self._make_stamp_observation(stamp, psf_image)
+            with self.timer.stage("metacal"):
+                obs_dict = ngmix.metacal.get_all_metacal(
+                    obs, step=self.step, rng=self.rng, types=list(SHEAR_TYPES)
+                )
+            for shear_type, (images, weights, jacobians) in stacks.items():
+                shear_obs = obs_dict[shear_type]
+                jac = shear_obs.jacobian
+                images.append(shear_obs.image)
+                weights.append(shear_obs.weight)
+                jacobians.append(
+                    (*jac.get_cen(), jac.get_dvdrow(), jac.get_dvdcol(), jac.get_dudrow(), jac.get_dudcol())
+                )
+
+        if len({stamp.shape for stamp in stacks["noshear"][0]}) > 1:
+            raise ValueError("The stamps of a batch must all have the same shape")
+
+        records = MetacalRecord.empty(len(indices))
+        with self.timer.stage("moments"):
+            results = {
+                shear_type: moments.gauss_moments(
+                    np.stack(images), np.stack(weights), np.array(jacobians), self.weight_fwhm
+                )
+                for shear_type, (images, weights, jacobians) in stacks.items()
+            }
+        with self.timer.stage("record"):
+            records["index"] = indices
+            noshear = results["noshear"]
+            records["e1"], records["e2"] = noshear["e1"], noshear["e2"]
+            records["e1err"], records["e2err"] = noshear["e1err"], noshear["e2err"]
+            records["snr"] = noshear["s2n"]
+            for shear_type, result in results.items():
+                records[f"flag_{shear_type}"] = result["flags"]
+                if shear_type != "noshear":
+                    records[f"e1_{shear_type}"] = result["e1"]
+                    records[f"e2_{shear_type}"] = result["e2"]
+                    records[f"snr_{shear_type}"] = result["s2n"]
+        return records
+
+    def _cut_stamp(
+        self, n, label, image, weight, noise_rms, seg_map, bbox, mosaic_bounds=None, footprints=None
+    ) -> Stamp:
+        """Cut out the postage stamps of a source.
+
+        With the precomputed ``footprints``, the stamp bounds are looked up,
+        and the sources without neighbors skip the mask.
+        """
+        timer = self.timer
         ## Modfiy the bbox
+        with timer.stage("bbox"):
+            if footprints is not None:
+                expanded_bbox = footprints.bounds(n)
+            else:
+                expanded_bbox = self.stamp_bounds(
+                    bbox, image.bounds if mosaic_bounds is None else mosaic_bounds
+                )
+        with timer.stage("stamp"):
+            return cut_stamp(
+                expanded_bbox,
+                image,
+                weight,
+                noise_rms,
+                seg_map,
+                label,
+                has_neighbors=footprints is None or footprints.has_neighbors(n),
+            )
+
+    def _fill_noise_batch(self, labels: Sequence[int], stamps: Sequence[Stamp]) -> List[Stamp]:
+        """Replace the pixels of the neighbors in stamps of one shape at once.
+
+        The noise of each stamp is drawn from the noise stream of its source,
+        as in `_make_stamp_observation`. The filled stamps are returned
+        without a mask, and with their images in a new stack.
+        """
+        filled = [i for i, stamp in enumerate(stamps) if stamp.mask is not None]
+        if not filled:
+            return list(stamps)
+        images = np.stack([stamps[i].image.array for i in filled])
+        noise_rngs = []
+        for i in filled:
+            noise_rng = np.random.Generator(np.random.Philox(key=[self.seed, 0]))
+            noise_rng.bit_generator.state = utils.philox_state((self.seed, int(labels[i])), stream=1)
+            noise_rngs.append(noise_rng)
+        utils.fill_noise(
+            images,
+            np.stack([stamps[i].noise_rms for i in filled]),
+            np.stack([stamps[i].mask for i in filled]),
+            noise_rngs,
+        )
+        stamps = list(stamps)
+        for i, filled_image in zip(filled, images):
+            bounds = stamps[i].image.bounds
+            image = galsim.Image(filled_image, xmin=bounds.xmin, ymin=bounds.ymin)
+            stamps[i] = stamps[i]._replace(image=image, mask=None)
+        return stamps
+
+    def _make_stamp_observation(self, stamp: Stamp, psf_image) -> ngmix.Observation:
+        """Make the observation of the postage stamp of a source.
+
+        The pixels of the neighbors are masked or replaced by noise, which
+        modifies the image of the stamp.
+        """
+        timer = self.timer
+        im, wt, mask = stamp.image, stamp.weight, stamp.mask
+        if mask is not None:
+            with timer.stage("noise"):
+                if self.mask_neighbors:
+                    ## Mask the pixels belonging to other sources.
+                    wt = wt.copy()
+                    wt.array[mask] = 0.0
+                    im.array[mask] = 0.0
+                else:
+                    ## Replace the pixels of other sources with noise.
+                    utils.fill_noise(im.array, stamp.noise_rms, mask, self.noise_rng)
+
+        with timer.stage("observation"):
+            obs = self._make_ngmix_observation(im, wt, psf_image)
+        return obs
+
+    def stamp_bounds(self, bbox: galsim.BoundsI, mosaic_bounds: galsim.BoundsI) -> galsim.BoundsI:
+        """Return the bounds of the postage stamp of a source.
+
+        Parameters
+        ----------
+        bbox : galsim.BoundsI
+            A minimal bounding box for the source.
+        mosaic_bounds : galsim.BoundsI
+            The bounds of the full mosaic.
+
+        Returns
+        -------
+        expanded_bbox : galsim.BoundsI
+            The expanded bounding box, clipped to the mosaic.
+        """
         center = None
         expanded_bbox = utils.expand_bbox(
             bbox,
-            mosaic_bbox=image.bounds,
+            mosaic_bbox=mosaic_bounds,
             center=center,
-            min_size=self.config.get("minimum_stamp_size", 32),
+            min_size=self.config.get("minimum_stamp_size") or 32,
+        )
+        return expanded_bbox & mosaic_bounds
+
+    def stamp_bounds_batch(self, xmin, xmax, ymin, ymax, mosaic_bounds: galsim.BoundsI) -> np.ndarray:
+        """Return the bounds of the postage stamps of many sources at once.
+
+        This is the vectorized equivalent of `stamp_bounds`.
+
+        Parameters
+        ----------
+        xmin, xmax, ymin, ymax : np.ndarray
+            The inclusive corners of the minimal bounding boxes.
+        mosaic_bounds : galsim.BoundsI
+            The bounds of the full mosaic.
+
+        Returns
+        -------
+        stamp_bounds : np.ndarray
+            The (xmin, xmax, ymin, ymax) of the stamps, clipped to the mosaic,
+            as an array of shape (N, 4).
+        """
+        xmin, xmax, ymin, ymax = utils.expand_bboxes(
+            xmin, xmax, ymin, ymax, mosaic_bounds, min_size=self.config.get("minimum_stamp_size") or 32
+        )
+        return np.stack(
+            [
+                np.maximum(xmin, mosaic_bounds.xmin),
+                np.minimum(xmax, mosaic_bounds.xmax),
+                np.maximum(ymin, mosaic_bounds.ymin),
+                np.minimum(ymax, mosaic_bounds.ymax),
+            ],
+            axis=1,
         )
-        expanded_bbox &= image.bounds
-        ## Make a deep copy of the image
-        im = image[expanded_bbox].copy()
-        ## Replace the pixels belonging to other sources with noise.
-        noise_im = self._make_noise_image(noise_rms[expanded_bbox])
-        mask = ~((seg_map[expanded_bbox].array == n) | (seg_map[expanded_bbox].array == 0))
-        im.array[mask] = noise_im.array[mask]
-
-        obs = self._make_ngmix_observation(im, weight[expanded_bbox], psf_image)
-        resdict, _ = self.boot.go(obs)
-        record = self._make_record(n, resdict)
-        return record
+
+    def _reseed(self, source_id: int):
+        """Reseed the random number generators uniquely for a source.
+
+        The generators are counter-based Philox streams keyed by the seed and
+        the ID of the source, one for the fits and one for the noise. They
+        are reset in place, since the bootstrapper and the guessers hold
+        references to them, which is much cheaper than seeding new ones.
+        """
+        key = (self.seed, int(source_id))
+        self.rng.set_state({**utils.philox_state(key, stream=0), "has_gauss": 0, "gauss": 0.0})
+        self.noise_rng.bit_generator.state = utils.philox_state(key, stream=1)
+
+    def pop_stats(self) -> Counter:
+        """Return counts of events, e.g., PSF cache hits, and reset them."""
+        stats = self.stats.copy()
+        self.stats.clear()
+        return stats
 
     @staticmethod
-    def _setup_metacal(rng, weight_fwhm=None):
+    def _setup_metacal(rng, weight_fwhm=None, psf_cache_size=0, stats=None, step=0.01):
+        # The PSF fits are cached only if they do not draw from the shared rng.
+        psf_rng = np.random.RandomState() if psf_cache_size > 0 else rng
         if weight_fwhm is None:
             fitter = ngmix.admom.AdmomFitter()
             psf_fitter = ngmix.admom.AdmomFitter()
             # guesser = ngmix.guessers.TFluxGuesser(rng, T=0.5, flux=100.0)
             # psf_guesser = ngmix.guessers.GMixCoellipPSF(rng, ngauss=1, guess_from_moms=True)
             guesser = ngmix.guessers.GMixPSFGuesser(rng, ngauss=1, guess_from_moms=True)
-            psf_guesser = ngmix.guessers.GMixPSFGuesser(rng, ngauss=1, guess_from_moms=True)
+            psf_guesser = ngmix.guessers.GMixPSFGuesser(psf_rng, ngauss=1, guess_from_moms=True)
         else:
             fitter = ngmix.gaussmom.GaussMomFitter(weight_fwhm=weight_fwhm)
             psf_fitter = ngmix.gaussmom.GaussMomFitter(weight_fwhm=weight_fwhm)
@@ -94,13 +501,16 @@ class MetacalRecordGenerator:
 
         # these "runners" run the measurement code on observations
         psf_runner = ngmix.runners.PSFRunner(fitter=psf_fitter, guesser=psf_guesser, ntry=2)
+        if psf_cache_size > 0:
+            psf_runner = CachedPSFRunner(psf_runner, psf_rng, maxsize=psf_cache_size, stats=stats)
         runner = ngmix.runners.Runner(fitter=fitter, guesser=guesser)
 
         boot = ngmix.metacal.MetacalBootstrapper(
             runner=runner,
             psf_runner=psf_runner,
             rng=rng,
-            types=["noshear", "1p", "1m", "2p", "2m"],
+            types=list(SHEAR_TYPES),
+            step=step,
         )
 
         return boot
@@ -124,58 +534,27 @@ class MetacalRecordGenerator:
         )
         return obs
 
-    def _make_noise_image(self, noise_rms: galsim.Image) -> galsim.Image:
-        noise_generator = galsim.GaussianNoise(self.galsim_rng, sigma=1.0)
-        noise_img = galsim.Image(bounds=noise_rms.bounds)
-        noise_img.addNoise(noise_generator)
-        noise_img *= noise_rms
-        return noise_img
+    def _make_record(self, record_index, resdict, record):
+        """Write the fields of the record into the structured row ``record``.
 
-    def _make_record(self, record_index, resdict) -> MetacalRecord:
-        record = {"index": record_index}
+        Only the raw measurements on each of the sheared images are stored.
+        The response columns are computed from them for a whole chunk of
+        records at once by `responses.compute_responses`.
+        """
+        record["index"] = record_index
         record["e1"] = resdict["noshear"]["e1"]
         record["e2"] = resdict["noshear"]["e2"]
         record["e1err"] = resdict["noshear"]["e1err"]
         record["e2err"] = resdict["noshear"]["e2err"]
         record["snr"] = resdict["noshear"]["s2n"]
 
-        for a, b in product((1, 2), (1, 2)):
-            record[f"R{a}{b}_p"] = (resdict[f"{b}p"][f"e{a}"] - resdict["noshear"][f"e{a}"]) / 0.01
-            record[f"R{a}{b}_m"] = (-resdict[f"{b}m"][f"e{a}"] + resdict["noshear"][f"e{a}"]) / 0.01
-            record[f"R{a}{b}"] = 0.5 * (record[f"R{a}{b}_p"] + record[f"R{a}{b}_m"])
-
-        R11_p = (resdict["1p"]["e1"] - resdict["noshear"]["e1"]) / 0.01
-        R11_m = (resdict["noshear"]["e1"] - resdict["1m"]["e1"]) / 0.01
-        R11 = 0.5 * (R11_p + R11_m)
-        record["R11_p"] = R11_p
-        record["R11_m"] = R11_m
-        record["R11"] = R11
-
-        R22_p = (resdict["2p"]["e2"] - resdict["noshear"]["e2"]) / 0.01
-        R22_m = (resdict["noshear"]["e2"] - resdict["2m"]["e2"]) / 0.01
-        R22 = 0.5 * (R22_p + R22_m)
-        record["R22_p"] = R22_p
-        record["R22_m"] = R22_m
-        record["R22"] = R22
-
-        R12_p = (resdict["2p"]["e1"] - resdict["noshear"]["e1"]) / 0.01
-        R12_m = (resdict["noshear"]["e1"] - resdict["2m"]["e1"]) / 0.01
-        R12 = 0.5 * (R12_p + R12_m)
-        record["R12_p"] = R12_p
-        record["R12_m"] = R12_m
-        record["R12"] = R12
-
-        R21_p = (resdict["1p"]["e2"] - resdict["noshear"]["e2"]) / 0.01
-        R21_m = (resdict["noshear"]["e2"] - resdict["1m"]["e2"]) / 0.01
-        R21 = 0.5 * (R21_p + R21_m)
-        record["R21_p"] = R21_p
-        record["R21_m"] = R21_m
-        record["R21"] = R21
+        for shear_type in ("1p", "1m", "2p", "2m"):
+            record[f"e1_{shear_type}"] = resdict[shear_type]["e1"]
+            record[f"e2_{shear_type}"] = resdict[shear_type]["e2"]
+            record[f"snr_{shear_type}"] = resdict[shear_type]["s2n"]
 
         record["flag_noshear"] = resdict["noshear"]["flags"]
         record["flag_1p"] = resdict["1p"]["flags"]
         record["flag_1m"] = resdict["1m"]["flags"]
         record["flag_2p"] = resdict["2p"]["flags"]
         record["flag_2m"] = resdict["2m"]["flags"]
-
-        return MetacalRecord(**record)
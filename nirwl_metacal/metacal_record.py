@@ -1,6 +1,16 @@
 from typing import NamedTuple
 
-__all__ = ["MetacalRecord"]
+import numpy as np
+
+__all__ = ["FAILED", "FAILED_EXCEPTION", "FAILED_TIMEOUT", "MetacalRecord"]
+
+# The values of the flag_failure column of the sources whose measurement
+# failed, by an exception or by running out of time.
+FAILED_EXCEPTION = 2**0
+FAILED_TIMEOUT = 2**1
+# The flag set in the flag columns of every shear type of those sources, on a
+# bit that ngmix does not use.
+FAILED = 2**30
 
 
 class MetacalRecord(NamedTuple):
@@ -12,6 +22,22 @@ class MetacalRecord(NamedTuple):
     e2err: float
     snr: float
 
+    e1_1p: float
+    e2_1p: float
+    snr_1p: float
+
+    e1_1m: float
+    e2_1m: float
+    snr_1m: float
+
+    e1_2p: float
+    e2_2p: float
+    snr_2p: float
+
+    e1_2m: float
+    e2_2m: float
+    snr_2m: float
+
     R11_p: float
     R11_m: float
     R11: float
@@ -33,6 +59,7 @@ class MetacalRecord(NamedTuple):
     flag_1m: int
     flag_2p: int
     flag_2m: int
+    flag_failure: int
 
     @classmethod
     def dtypes(cls) -> list:
@@ -43,6 +70,18 @@ class MetacalRecord(NamedTuple):
             ("e1err", "f4"),
             ("e2err", "f4"),
             ("snr", "f4"),
+            ("e1_1p", "f4"),
+            ("e2_1p", "f4"),
+            ("snr_1p", "f4"),
+            ("e1_1m", "f4"),
+            ("e2_1m", "f4"),
+            ("snr_1m", "f4"),
+            ("e1_2p", "f4"),
+            ("e2_2p", "f4"),
+            ("snr_2p", "f4"),
+            ("e1_2m", "f4"),
+            ("e2_2m", "f4"),
+            ("snr_2m", "f4"),
             ("R11_p", "f4"),
             ("R11_m", "f4"),
             ("R11", "f4"),
@@ -60,4 +99,32 @@ class MetacalRecord(NamedTuple):
             ("flag_1m", "i4"),
             ("flag_2p", "i4"),
             ("flag_2m", "i4"),
+            ("flag_failure", "i4"),
         ]
+
+    @classmethod
+    def empty(cls, size: int) -> np.ndarray:
+        """Return a structured array to fill with ``size`` records in place.
+
+        The ``index`` of the rows is set to -1 until they are filled.
+        """
+        records = np.zeros(size, dtype=cls.dtypes())
+        records["index"] = -1
+        return records
+
+    @classmethod
+    def fill_failed(cls, record: np.ndarray, index: int, failure: int = FAILED_EXCEPTION) -> np.ndarray:
+        """Fill a record, or an array of records, of failed measurements.
+
+        The measurements are set to NaN and the flags of every shear type to
+        `FAILED`, so that the records are never selected, and ``failure`` is
+        stored in ``flag_failure``.
+        """
+        for name, dtype in cls.dtypes():
+            if dtype == "f4":
+                record[name] = np.nan
+            elif name.startswith("flag_"):
+                record[name] = FAILED
+        record["index"] = index
+        record["flag_failure"] = failure
+        return record
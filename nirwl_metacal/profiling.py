@@ -0,0 +1,128 @@
+"""
+Module containing the opt-in timing instrumentation of the measurement
+"""
+
+import contextlib
+import json
+import time
+from collections import defaultdict
+from typing import Any, Dict, List, Mapping, Optional
+
+import numpy as np
+
+__all__ = [
+    "Profile",
+    "StageTimer",
+]
+
+_NULL_CONTEXT = contextlib.nullcontext()
+
+
+class StageTimer:
+    """
+    Time the stages of the measurement of a source.
+
+    The wall-clock and CPU times of every stage are accumulated until they
+    are popped, typically once per source. When disabled, `stage` returns a
+    shared no-op context manager, so the instrumentation costs next to
+    nothing.
+
+    Parameters
+    ----------
+    enabled : bool, optional
+        Whether to time the stages.
+    """
+
+    def __init__(self, enabled: bool = False):
+        self.enabled = enabled
+        self._timings: Dict[str, List[float]] = defaultdict(lambda: [0.0, 0.0])
+
+    def stage(self, name: str):
+        """Return a context manager that times the stage ``name``."""
+        if not self.enabled:
+            return _NULL_CONTEXT
+        return self._time(name)
+
+    @contextlib.contextmanager
+    def _time(self, name: str):
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            timing = self._timings[name]
+            timing[0] += time.perf_counter() - wall
+            timing[1] += time.process_time() - cpu
+
+    def pop(self) -> Optional[Dict[str, List[float]]]:
+        """Return the [wall, cpu] times of each stage so far, and reset them.
+
+        Returns None if the timer is disabled.
+        """
+        if not self.enabled:
+            return None
+        timings = dict(self._timings)
+        self._timings.clear()
+        return timings
+
+
+class Profile:
+    """
+    Collect the per-source timings of a run and summarize them.
+
+    The timings may come from different processes, each with their own
+    `StageTimer`.
+    """
+
+    def __init__(self):
+        self.sources: List[Dict[str, Any]] = []
+        self._wall: Dict[str, List[float]] = defaultdict(list)
+        self._cpu: Dict[str, List[float]] = defaultdict(list)
+
+    def add(self, index: int, timings: Mapping[str, List[float]], **extra):
+        """Add the stage timings of a source, and any extra information."""
+        self.sources.append({"index": int(index), "timings": dict(timings), **extra})
+        for name, (wall, cpu) in timings.items():
+            self._wall[name].append(wall)
+            self._cpu[name].append(cpu)
+
+    def summary(self) -> Dict[str, Dict[str, Any]]:
+        """Return the statistics and histogram of the wall time per stage."""
+        summary = {}
+        for name, wall in self._wall.items():
+            wall_times, cpu_times = np.array(wall), np.array(self._cpu[name])
+            counts, edges = np.histogram(np.log10(np.maximum(wall_times, 1e-7)), bins=20)
+            summary[name] = {
+                "count": len(wall_times),
+                "wall_total": float(wall_times.sum()),
+                "cpu_total": float(cpu_times.sum()),
+                "wall_mean": float(wall_times.mean()),
+                "wall_p50": float(np.percentile(wall_times, 50)),
+                "wall_p90": float(np.percentile(wall_times, 90)),
+                "wall_p99": float(np.percentile(wall_times, 99)),
+                "wall_max": float(wall_times.max()),
+                "wall_histogram": {"log10_edges": edges.tolist(), "counts": counts.tolist()},
+            }
+        return summary
+
+    def table(self) -> str:
+        """Return the summary as a table, with the per-source times in ms."""
+        summary = self.summary()
+        stage_total = sum(stats["wall_total"] for name, stats in summary.items() if name != "total")
+        lines = [
+            f"{'stage':<12} {'count':>8} {'wall (s)':>10} {'cpu (s)':>10} {'share':>7} "
+            + " ".join(f"{key:>9}" for key in ("mean", "p50", "p90", "p99", "max"))
+        ]
+        for name, stats in sorted(summary.items(), key=lambda item: -item[1]["wall_total"]):
+            share = stats["wall_total"] / stage_total if stage_total > 0 else 0.0
+            times = [1e3 * stats[f"wall_{key}"] for key in ("mean", "p50", "p90", "p99", "max")]
+            lines.append(
+                f"{name:<12} {stats['count']:>8d} {stats['wall_total']:>10.2f} {stats['cpu_total']:>10.2f} "
+                + (f"{share:>7.1%} " if name != "total" else f"{'':>7} ")
+                + " ".join(f"{t:>9.3f}" for t in times)
+            )
+        return "\n".join(lines)
+
+    def write(self, path: str):
+        """Write the summary and the per-source timings to a JSON file."""
+        with open(path, "w") as f:
+            json.dump({"stages": self.summary(), "sources": self.sources}, f, indent=1)
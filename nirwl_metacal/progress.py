@@ -0,0 +1,167 @@
+"""
+Module containing the periodic reporting of the progress of a run
+"""
+
+import json
+import logging
+import os
+import time
+from collections import defaultdict
+from typing import Any, Callable, Dict, List, Optional
+
+import numpy as np
+
+__all__ = [
+    "Progress",
+    "format_duration",
+]
+
+logger = logging.getLogger(__name__)
+
+
+def format_duration(seconds: Optional[float]) -> str:
+    """Format a duration in seconds as, e.g., ``1h02m03s``."""
+    if seconds is None or not np.isfinite(seconds):
+        return "?"
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return f"{hours}h{minutes:02d}m{seconds:02d}s"
+    if minutes:
+        return f"{minutes}m{seconds:02d}s"
+    return f"{seconds}s"
+
+
+class Progress:
+    """
+    Track the progress of a run, and report it periodically.
+
+    Every ``interval`` seconds, the number of sources measured so far, the
+    throughput, the number of failures and the estimated time left are
+    logged, along with the throughput per stamp size. The same status is
+    also written to a small JSON file if ``heartbeat`` is given, so that a
+    job monitor can poll it.
+
+    The sources are counted as their records are collected, so the progress
+    is the same whether they were measured in this process or in a pool of
+    workers.
+
+    Parameters
+    ----------
+    total : int
+        The number of sources to measure.
+    interval : float, optional
+        The minimum time between two reports, in seconds.
+    heartbeat : str, optional
+        The JSON file to write the status to at every report. It is replaced
+        atomically, so it is never read half-written.
+    name : str, optional
+        The name of the run, e.g., the field, shown in the reports.
+    clock : callable, optional
+        The monotonic clock to measure the elapsed time with.
+    """
+
+    def __init__(
+        self,
+        total: int,
+        interval: float = 60.0,
+        heartbeat: Optional[str] = None,
+        name: Optional[str] = None,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.total = int(total)
+        self.interval = interval
+        self.heartbeat = heartbeat
+        self.name = name
+        self.done = 0
+        self.failed = 0
+        self.state = "running"
+        self._clock = clock
+        self._start = clock()
+        self._last_report = self._start
+        # The number of sources and the time spent measuring them, per size.
+        self._by_size: Dict[int, List[float]] = defaultdict(lambda: [0, 0.0])
+
+    def update(self, stamp_sizes: np.ndarray, seconds: np.ndarray, failed: np.ndarray):
+        """
+        Add a chunk of measured sources, and report if it is time to.
+
+        Parameters
+        ----------
+        stamp_sizes : np.ndarray
+            The side of the stamp of each source, in pixels.
+        seconds : np.ndarray
+            The time spent measuring each source, in seconds.
+        failed : np.ndarray
+            Whether the measurement of each source failed.
+        """
+        stamp_sizes = np.asarray(stamp_sizes)
+        seconds = np.asarray(seconds, dtype=np.float64)
+        self.done += len(stamp_sizes)
+        self.failed += int(np.count_nonzero(failed))
+        for size in np.unique(stamp_sizes):
+            in_size = stamp_sizes == size
+            totals = self._by_size[int(size)]
+            totals[0] += int(np.count_nonzero(in_size))
+            totals[1] += float(seconds[in_size].sum())
+        if self._clock() - self._last_report >= self.interval:
+            self.report()
+
+    def status(self) -> Dict[str, Any]:
+        """Return the status of the run as a JSON-serializable dict."""
+        elapsed = self._clock() - self._start
+        rate = self.done / elapsed if elapsed > 0 else 0.0
+        eta = (self.total - self.done) / rate if rate > 0 and self.state == "running" else None
+        return {
+            "name": self.name,
+            "state": self.state,
+            "pid": os.getpid(),
+            "time": time.time(),
+            "total": self.total,
+            "done": self.done,
+            "failed": self.failed,
+            "elapsed_s": elapsed,
+            "sources_per_s": rate,
+            "eta_s": eta,
+            # The sources per second of one process, for each stamp size.
+            "stamp_sizes": {
+                str(size): {"count": count, "sources_per_s": count / seconds if seconds > 0 else None}
+                for size, (count, seconds) in sorted(self._by_size.items())
+            },
+        }
+
+    def report(self):
+        """Log the status, and write it to the heartbeat file."""
+        self._last_report = self._clock()
+        status = self.status()
+        percent = 100 * self.done / self.total if self.total else 100.0
+        logger.info(
+            "%s%d/%d sources measured (%.1f%%) in %s, %.1f sources/s, %d failed, %s",
+            f"{self.name}: " if self.name else "",
+            self.done,
+            self.total,
+            percent,
+            format_duration(status["elapsed_s"]),
+            status["sources_per_s"],
+            self.failed,
+            f"{format_duration(status['eta_s'])} left" if self.state == "running" else self.state,
+        )
+        if status["stamp_sizes"]:
+            logger.info(
+                "Sources/s per process by stamp size: %s",
+                ", ".join(
+                    f"{size}: {stats['sources_per_s']:.1f} ({stats['count']})"
+                    for size, stats in status["stamp_sizes"].items()
+                    if stats["sources_per_s"] is not None
+                ),
+            )
+        if self.heartbeat is not None:
+            tmp_path = f"{self.heartbeat}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(status, f, indent=1)
+            os.replace(tmp_path, self.heartbeat)
+
+    def finish(self, state: str = "done"):
+        """Mark the run as ``done`` or ``failed``, and report."""
+        self.state = state
+        self.report()
@@ -0,0 +1,126 @@
+"""
+Module containing the vectorized computation of the metacal responses
+"""
+
+from itertools import product
+from typing import Callable, Optional
+
+import numpy as np
+
+__all__ = [
+    "SHEAR_TYPES",
+    "compute_responses",
+    "mean_response",
+    "selection_response",
+    "shear_field",
+]
+
+SHEAR_TYPES = ("noshear", "1p", "1m", "2p", "2m")
+
+
+def shear_field(records: np.ndarray, name: str, shear_type: str) -> np.ndarray:
+    """Return the column ``name`` measured on the image of a shear type.
+
+    The columns measured on the unsheared image have no suffix, e.g., ``e1``,
+    and those measured on the sheared images have the shear type as a suffix,
+    e.g., ``e1_1p``.
+    """
+    if name == "flag":
+        return records[f"flag_{shear_type}"]
+    return records[name] if shear_type == "noshear" else records[f"{name}_{shear_type}"]
+
+
+def compute_responses(records: np.ndarray, step: float = 0.01) -> np.ndarray:
+    """
+    Compute the response columns of a catalog from the raw ellipticities.
+
+    The ``R{a}{b}_p``, ``R{a}{b}_m`` and ``R{a}{b}`` columns are computed in
+    place for all the records at once from the ``e{a}`` measured on the
+    unsheared image and on the images sheared by ``+step`` and ``-step``
+    along the component ``b``.
+
+    Parameters
+    ----------
+    records : np.ndarray
+        A structured array with the dtype of `MetacalRecord.dtypes`.
+    step : float, optional
+        The shear applied to make the sheared images.
+
+    Returns
+    -------
+    records : np.ndarray
+        The same array, with the response columns filled in.
+    """
+    for a, b in product((1, 2), (1, 2)):
+        e = records[f"e{a}"].astype(np.float64)
+        r_p = (shear_field(records, f"e{a}", f"{b}p") - e) / step
+        r_m = (e - shear_field(records, f"e{a}", f"{b}m")) / step
+        records[f"R{a}{b}_p"] = r_p
+        records[f"R{a}{b}_m"] = r_m
+        records[f"R{a}{b}"] = 0.5 * (r_p + r_m)
+    return records
+
+
+def mean_response(records: np.ndarray, step: float = 0.01, mask: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    Return the mean shear response matrix of a catalog.
+
+    Parameters
+    ----------
+    records : np.ndarray
+        A structured array with the dtype of `MetacalRecord.dtypes`.
+    step : float, optional
+        The shear applied to make the sheared images.
+    mask : np.ndarray, optional
+        The boolean mask of the records to average over, e.g., those that
+        pass a selection on the unsheared measurements. All the records are
+        averaged over if not given.
+
+    Returns
+    -------
+    response : np.ndarray
+        The 2x2 matrix of the mean responses.
+    """
+    if mask is not None:
+        records = records[mask]
+    response = np.empty((2, 2))
+    for a, b in product((1, 2), (1, 2)):
+        e_p = shear_field(records, f"e{a}", f"{b}p").astype(np.float64)
+        e_m = shear_field(records, f"e{a}", f"{b}m").astype(np.float64)
+        response[a - 1, b - 1] = np.mean(e_p - e_m) / (2 * step)
+    return response
+
+
+def selection_response(
+    records: np.ndarray, select: Callable[[np.ndarray, str], np.ndarray], step: float = 0.01
+) -> np.ndarray:
+    """
+    Return the response matrix of a selection of the catalog.
+
+    The selection is made with the quantities measured on each of the sheared
+    images in turn, and the response is the change in the mean unsheared
+    ellipticity of the selected records.
+
+    Parameters
+    ----------
+    records : np.ndarray
+        A structured array with the dtype of `MetacalRecord.dtypes`.
+    select : callable
+        A function of the records and a shear type, returning the boolean
+        mask of the records selected with the quantities measured on the
+        image of that shear type, e.g., using `shear_field`.
+    step : float, optional
+        The shear applied to make the sheared images.
+
+    Returns
+    -------
+    response : np.ndarray
+        The 2x2 matrix of the selection responses.
+    """
+    response = np.empty((2, 2))
+    for a, b in product((1, 2), (1, 2)):
+        e = records[f"e{a}"].astype(np.float64)
+        e_p = np.mean(e[select(records, f"{b}p")])
+        e_m = np.mean(e[select(records, f"{b}m")])
+        response[a - 1, b - 1] = (e_p - e_m) / (2 * step)
+    return response
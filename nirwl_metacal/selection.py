@@ -0,0 +1,195 @@
+"""
+Module containing the selection of the sources to measure
+
+A selection is a boolean expression over the columns of the SExtractor
+catalog, e.g., ``(MAG_AUTO < 24) & (FLUX_RADIUS > 1.5)``, a box in pixel
+coordinates, a circle on the sky, or any combination of them. Only the rows
+of the catalog that match all of them are measured.
+
+The expressions are parsed and evaluated on the columns with numpy, without
+`eval`, so only comparisons, arithmetic, the logical operators and a few
+numpy functions are allowed.
+"""
+
+import ast
+import operator
+from typing import Any, Callable, Dict, Optional, Sequence
+
+import numpy as np
+
+__all__ = [
+    "evaluate",
+    "select_sources",
+]
+
+# The pixel and sky coordinates of the sources in the catalog.
+PIXEL_COLUMNS = ("X_IMAGE", "Y_IMAGE")
+SKY_COLUMNS = ("ALPHA_J2000", "DELTA_J2000")
+
+_BINARY_OPERATORS: Dict[type, Callable[[Any, Any], Any]] = {
+    ast.Add: operator.add,
+    ast.Sub: operator.sub,
+    ast.Mult: operator.mul,
+    ast.Div: operator.truediv,
+    ast.Mod: operator.mod,
+    ast.Pow: operator.pow,
+    ast.BitAnd: np.logical_and,
+    ast.BitOr: np.logical_or,
+    ast.BitXor: np.logical_xor,
+}
+_UNARY_OPERATORS: Dict[type, Callable[[Any], Any]] = {
+    ast.USub: operator.neg,
+    ast.UAdd: operator.pos,
+    ast.Not: np.logical_not,
+    ast.Invert: np.logical_not,
+}
+_COMPARISONS: Dict[type, Callable[[Any, Any], Any]] = {
+    ast.Lt: operator.lt,
+    ast.LtE: operator.le,
+    ast.Gt: operator.gt,
+    ast.GtE: operator.ge,
+    ast.Eq: operator.eq,
+    ast.NotEq: operator.ne,
+}
+_FUNCTIONS: Dict[str, Callable[..., Any]] = {
+    "abs": np.abs,
+    "sqrt": np.sqrt,
+    "log": np.log,
+    "log10": np.log10,
+    "exp": np.exp,
+    "hypot": np.hypot,
+    "isfinite": np.isfinite,
+    "isnan": np.isnan,
+}
+
+
+def _column(catalog: np.ndarray, name: str) -> np.ndarray:
+    """Return a column of the catalog, matching its name case-insensitively."""
+    names = {column.upper(): column for column in catalog.dtype.names}
+    if name.upper() not in names:
+        raise ValueError(f"The catalog has no column {name}. Its columns are {', '.join(names.values())}")
+    return np.asarray(catalog[names[name.upper()]])
+
+
+def evaluate(expression: str, catalog: np.ndarray) -> np.ndarray:
+    """
+    Evaluate a boolean expression over the columns of a catalog.
+
+    Parameters
+    ----------
+    expression : str
+        The expression, with the column names as variables, e.g.,
+        ``(MAG_AUTO < 24) and FLUX_RADIUS > 1.5``. Comparisons may be
+        chained, and ``and``, ``or`` and ``not`` work element-wise like ``&``,
+        ``|`` and ``~``.
+    catalog : np.ndarray
+        The catalog, as a structured array or a FITS table.
+
+    Returns
+    -------
+    selected : np.ndarray
+        Whether each row of the catalog matches the expression.
+    """
+    expression = expression.strip()
+    try:
+        tree = ast.parse(expression, mode="eval")
+    except SyntaxError as e:
+        raise ValueError(f"Invalid selection {expression!r}: {e.msg}") from None
+
+    def visit(node: ast.AST) -> Any:
+        if isinstance(node, ast.Expression):
+            return visit(node.body)
+        if isinstance(node, ast.Constant) and isinstance(node.value, (bool, int, float)):
+            return node.value
+        if isinstance(node, ast.Name):
+            return _column(catalog, node.id)
+        if isinstance(node, ast.BoolOp):
+            combine = np.logical_and if isinstance(node.op, ast.And) else np.logical_or
+            result = visit(node.values[0])
+            for value in node.values[1:]:
+                result = combine(result, visit(value))
+            return result
+        if isinstance(node, ast.BinOp) and type(node.op) in _BINARY_OPERATORS:
+            return _BINARY_OPERATORS[type(node.op)](visit(node.left), visit(node.right))
+        if isinstance(node, ast.UnaryOp) and type(node.op) in _UNARY_OPERATORS:
+            return _UNARY_OPERATORS[type(node.op)](visit(node.operand))
+        if isinstance(node, ast.Compare) and all(type(op) in _COMPARISONS for op in node.ops):
+            left = visit(node.left)
+            result = True
+            for op, comparator in zip(node.ops, node.comparators):
+                right = visit(comparator)
+                result = np.logical_and(result, _COMPARISONS[type(op)](left, right))
+                left = right
+            return result
+        if (
+            isinstance(node, ast.Call)
+            and isinstance(node.func, ast.Name)
+            and node.func.id in _FUNCTIONS
+            and not node.keywords
+        ):
+            return _FUNCTIONS[node.func.id](*map(visit, node.args))
+        raise ValueError(
+            f"Unsupported {ast.get_source_segment(expression, node)!r} in the selection {expression!r}"
+        )
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        selected = np.asarray(visit(tree))
+    if selected.dtype != bool:
+        raise ValueError(f"The selection {expression!r} is not a boolean expression")
+    return np.broadcast_to(selected, (len(catalog),)).copy()
+
+
+def _in_sky_circle(ra: np.ndarray, dec: np.ndarray, center_ra: float, center_dec: float, radius: float):
+    """Return whether the positions, in degrees, are within a sky circle."""
+    ra, dec, center_ra, center_dec = map(np.radians, (ra, dec, center_ra, center_dec))
+    # The haversine formula, which is accurate at small separations.
+    hav = (
+        np.sin((dec - center_dec) / 2) ** 2
+        + np.cos(dec) * np.cos(center_dec) * np.sin((ra - center_ra) / 2) ** 2
+    )
+    return 2 * np.arcsin(np.sqrt(np.clip(hav, 0.0, 1.0))) <= np.radians(radius)
+
+
+def select_sources(
+    catalog: np.ndarray,
+    where: Optional[str] = None,
+    region: Optional[Sequence[float]] = None,
+    sky_region: Optional[Sequence[float]] = None,
+) -> np.ndarray:
+    """
+    Return the indices of the sources of a catalog that match a selection.
+
+    Parameters
+    ----------
+    catalog : np.ndarray
+        The SExtractor catalog, as a structured array or a FITS table.
+    where : str, optional
+        A boolean expression over the columns of the catalog, see `evaluate`.
+    region : Sequence[float], optional
+        The (xmin, xmax, ymin, ymax) of a box in pixel coordinates, which the
+        ``X_IMAGE`` and ``Y_IMAGE`` of the sources must be in.
+    sky_region : Sequence[float], optional
+        The (ra, dec, radius) of a circle on the sky, in degrees, which the
+        ``ALPHA_J2000`` and ``DELTA_J2000`` of the sources must be in.
+
+    Returns
+    -------
+    indices : np.ndarray
+        The sorted indices of the selected sources. All the sources are
+        selected if no selection is given.
+    """
+    selected = np.ones(len(catalog), dtype=bool)
+    if where:
+        selected &= evaluate(where, catalog)
+    if region is not None:
+        if len(region) != 4:
+            raise ValueError(f"region must be (xmin, xmax, ymin, ymax), got {region}")
+        xmin, xmax, ymin, ymax = map(float, region)
+        x, y = (_column(catalog, name) for name in PIXEL_COLUMNS)
+        selected &= (x >= xmin) & (x <= xmax) & (y >= ymin) & (y <= ymax)
+    if sky_region is not None:
+        if len(sky_region) != 3:
+            raise ValueError(f"sky_region must be (ra, dec, radius), got {sky_region}")
+        ra, dec = (_column(catalog, name) for name in SKY_COLUMNS)
+        selected &= _in_sky_circle(ra, dec, *map(float, sky_region))
+    return np.flatnonzero(selected)
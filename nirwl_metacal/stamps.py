@@ -0,0 +1,247 @@
+"""
+Module containing the extraction of the postage stamps of the sources
+
+The stamps of all the sources, and the segments of the neighbors that fall in
+each of them, are found once per catalog from the bounding boxes of the
+segmentation map, which are found block by block, so that the map does not
+have to fit in memory. The aligned cutouts of the image, weight, noise rms and
+segmentation maps of a source are then made in one step, and the neighbor
+mask is only computed for the stamps that have neighbors in them.
+"""
+
+from typing import List, NamedTuple, Optional, Tuple
+
+import galsim
+import numpy as np
+
+__all__ = [
+    "Footprints",
+    "Stamp",
+    "cut_stamp",
+    "find_segments",
+]
+
+
+class Stamp(NamedTuple):
+    """The aligned cutouts of the mosaics around a source."""
+
+    # A copy of the image, which may be modified.
+    image: galsim.Image
+    # The weight, which may be a view of the mosaic and must not be modified.
+    weight: galsim.Image
+    # The noise rms, which may also be a view of the mosaic.
+    noise_rms: np.ndarray
+    # The pixels of the neighbors, or None if there are none in the stamp.
+    mask: Optional[np.ndarray]
+
+
+def find_segments(seg_map: np.ndarray, block_pixels: int = 2**20) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Find the bounding boxes of the segments of a segmentation map.
+
+    The map is read in blocks of rows, e.g., from a memory map, and the
+    bounds of the segments in each block are merged into those of the
+    previous blocks, so that only one block is in memory at a time.
+
+    Parameters
+    ----------
+    seg_map : np.ndarray
+        The segmentation map, whose non-zero pixels are the labels of the
+        segments.
+    block_pixels : int, optional
+        The approximate number of pixels in a block.
+
+    Returns
+    -------
+    labels : np.ndarray
+        The sorted labels of the segments.
+    bounds : np.ndarray
+        The (M, 4) one-based inclusive (xmin, xmax, ymin, ymax) of the
+        segments, as in GalSim.
+    """
+    ny, nx = seg_map.shape
+    block_rows = max(1, block_pixels // max(nx, 1))
+    # The bounds of the segments by label, in zero-based pixel indices.
+    lower = np.zeros((2, 0), dtype=np.int64)
+    upper = np.zeros((2, 0), dtype=np.int64)
+    for y0 in range(0, ny, block_rows):
+        y1 = min(y0 + block_rows, ny)
+        block = np.asarray(seg_map[y0:y1])
+        rows, cols = np.nonzero(block)
+        if len(rows) == 0:
+            continue
+        labels = block[rows, cols].astype(np.int64)
+        if labels.min() < 0:
+            raise ValueError("The segmentation map has negative labels")
+        if labels.max() >= lower.shape[1]:
+            size = labels.max() + 1 - lower.shape[1]
+            lower = np.concatenate([lower, np.full((2, size), np.iinfo(np.int64).max)], axis=1)
+            upper = np.concatenate([upper, np.full((2, size), -1)], axis=1)
+        for axis, pixels in enumerate((cols, rows + y0)):
+            np.minimum.at(lower[axis], labels, pixels)
+            np.maximum.at(upper[axis], labels, pixels)
+    labels = np.flatnonzero(upper[0] >= 0)
+    bounds = np.stack([lower[0, labels], upper[0, labels], lower[1, labels], upper[1, labels]], axis=1)
+    return labels, bounds + 1
+
+
+def _cells(bounds: np.ndarray, cell_size: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Return the (owner, cx, cy) of the square cells covered by the bounds."""
+    cx0, cx1, cy0, cy1 = (bounds // cell_size).T
+    nx = cx1 - cx0 + 1
+    counts = nx * (cy1 - cy0 + 1)
+    owner = np.repeat(np.arange(len(bounds)), counts)
+    # The position of each cell amongst the cells of its owner.
+    offset = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    return owner, cx0[owner] + offset % nx[owner], cy0[owner] + offset // nx[owner]
+
+
+def _overlapping(bounds: np.ndarray, segment_bounds: np.ndarray, cell_size: int = 64) -> List[np.ndarray]:
+    """Return the indices of the segments that overlap each of the bounds.
+
+    The bounds and the segments are bucketed into square cells of
+    ``cell_size`` pixels, and only the segments that share a cell with a
+    stamp are compared with it, all at once.
+    """
+    segment, seg_cx, seg_cy = _cells(segment_bounds, cell_size)
+    stamp, cx, cy = _cells(bounds, cell_size)
+    width = max(seg_cy.max(initial=0), cy.max(initial=0)) + 1
+    seg_keys = seg_cx * width + seg_cy
+    order = np.argsort(seg_keys, kind="stable")
+    segment, seg_keys = segment[order], seg_keys[order]
+
+    # Pair every cell of a stamp with the segments in that cell.
+    keys = cx * width + cy
+    lo, hi = np.searchsorted(seg_keys, keys, "left"), np.searchsorted(seg_keys, keys, "right")
+    counts = hi - lo
+    stamp = np.repeat(stamp, counts)
+    segment = segment[np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts - lo, counts)]
+
+    sx0, sx1, sy0, sy1 = segment_bounds[segment].T
+    xmin, xmax, ymin, ymax = bounds[stamp].T
+    overlap = (sx0 <= xmax) & (sx1 >= xmin) & (sy0 <= ymax) & (sy1 >= ymin)
+    # A segment and a stamp may share several cells.
+    pairs = np.unique(stamp[overlap] * len(segment_bounds) + segment[overlap])
+    stamp, segment = np.divmod(pairs, len(segment_bounds))
+    return np.split(segment, np.searchsorted(stamp, np.arange(1, len(bounds))))
+
+
+class Footprints:
+    """
+    The stamps of the sources, and the neighbors in each of them.
+
+    The neighbors of a source are the other segments whose bounding boxes
+    overlap its stamp. A source without neighbors has no pixels to mask.
+
+    Parameters
+    ----------
+    labels : np.ndarray
+        The label of each source in the segmentation map.
+    stamp_bounds : np.ndarray
+        The (N, 4) inclusive (xmin, xmax, ymin, ymax) of the stamps of the
+        sources, e.g., from `MetacalRecordGenerator.stamp_bounds_batch`.
+    segment_bounds : np.ndarray
+        The (M, 4) inclusive (xmin, xmax, ymin, ymax) of all the segments in
+        the map, in the same coordinates as the stamps.
+    segment_labels : np.ndarray
+        The labels of the segments.
+    """
+
+    def __init__(
+        self,
+        labels: np.ndarray,
+        stamp_bounds: np.ndarray,
+        segment_bounds: np.ndarray,
+        segment_labels: np.ndarray,
+    ):
+        self.labels = np.asarray(labels, dtype=np.int64)
+        self.stamp_bounds = np.asarray(stamp_bounds, dtype=np.int64).reshape(-1, 4)
+        segment_labels = np.asarray(segment_labels, dtype=np.int64)
+        self.neighbors: List[np.ndarray] = [
+            segment_labels[overlapping][segment_labels[overlapping] != label]
+            for label, overlapping in zip(
+                self.labels,
+                _overlapping(self.stamp_bounds, np.asarray(segment_bounds, dtype=np.int64).reshape(-1, 4)),
+            )
+        ]
+
+    @classmethod
+    def from_segmentation(
+        cls, seg_map: np.ndarray, labels: np.ndarray, stamp_bounds: np.ndarray
+    ) -> "Footprints":
+        """Find the footprints of the sources in a segmentation map.
+
+        The segments are found with `find_segments`, in the one-based
+        inclusive bounds of GalSim, which the stamp bounds are given in.
+        """
+        segment_labels, segment_bounds = find_segments(seg_map)
+        return cls(labels, stamp_bounds, segment_bounds, segment_labels)
+
+    def __len__(self) -> int:
+        return len(self.labels)
+
+    def bounds(self, n: int) -> galsim.BoundsI:
+        """Return the bounds of the stamp of the n-th source."""
+        return galsim.BoundsI(*map(int, self.stamp_bounds[n]))
+
+    def has_neighbors(self, n: int) -> bool:
+        """Return whether other segments overlap the stamp of source n."""
+        return len(self.neighbors[n]) > 0
+
+
+def cut_stamp(
+    bounds: galsim.BoundsI,
+    image,
+    weight,
+    noise_rms,
+    seg_map,
+    label: int,
+    has_neighbors: bool = True,
+) -> Stamp:
+    """
+    Cut out the aligned stamps of a source from the mosaics at once.
+
+    The mosaics, or tiles of them, must all have the same bounds. The pixel
+    slices are computed once for all of them. Only the image is copied; the
+    other stamps are views, unless their byte order has to be converted.
+
+    Parameters
+    ----------
+    bounds : galsim.BoundsI
+        The bounds of the stamp.
+    image, weight, noise_rms, seg_map : galsim.Image or loaders.MosaicImage
+        The mosaics.
+    label : int
+        The label of the source in the segmentation map.
+    has_neighbors : bool, optional
+        Whether other segments may overlap the stamp, see
+        `Footprints.has_neighbors`. If not, the mask is not computed.
+
+    Returns
+    -------
+    stamp : Stamp
+        The cutouts of the source.
+    """
+    origin = image.bounds
+    if not origin.includes(bounds):
+        raise galsim.GalSimBoundsError("Stamp is not inside the mosaic", bounds, origin)
+    window = (
+        slice(bounds.ymin - origin.ymin, bounds.ymax - origin.ymin + 1),
+        slice(bounds.xmin - origin.xmin, bounds.xmax - origin.xmin + 1),
+    )
+
+    def cutout(mosaic, copy: bool = False) -> np.ndarray:
+        array = mosaic.array[window]
+        dtype = array.dtype.newbyteorder("=")
+        return np.array(array, dtype=dtype) if copy else np.asarray(array, dtype=dtype)
+
+    mask = None
+    if has_neighbors:
+        seg = seg_map.array[window]
+        mask = (seg != 0) & (seg != label)
+    return Stamp(
+        image=galsim.Image(cutout(image, copy=True), xmin=bounds.xmin, ymin=bounds.ymin),
+        weight=galsim.Image(cutout(weight), xmin=bounds.xmin, ymin=bounds.ymin),
+        noise_rms=cutout(noise_rms),
+        mask=mask,
+    )
@@ -2,7 +2,11 @@
 Module containing various stand-alone utility functions
 """
 
-from typing import Optional
+import contextlib
+import math
+import signal
+import threading
+from typing import Any, Dict, List, Optional, Sequence, Tuple, Union
 
 import galsim
 import numpy as np
@@ -16,6 +20,12 @@ def expand_bbox(
 ) -> galsim.Bounds:
     """
     Expand the bounding box to be a power of 2.
+
+    The expanded bounding box is the smallest square of 2**k pixels on a side
+    around the center that includes ``bbox``. It is grown further until it is
+    larger than ``min_size``, as long as it stays within the mosaic, and is
+    finally shifted into the mosaic if it sticks out of it.
+    See `expand_bboxes` to expand many bounding boxes at once.
     """
     if center is None:
         center: galsim.PositionD = bbox.center
@@ -26,39 +36,252 @@ def expand_bbox(
         if not mosaic_bbox.includes(center):
             raise RuntimeError("%s is not inside in %s" % (center, mosaic_bbox))
 
-    # left_pad, right_pad, top_pad, bottom_pad = (min_size - 1) // 2
-    ix = int(np.round(center.x))
-    iy = int(np.round(center.y))
+    # The expanded bounding box starts as a 2x2 box around the center, and
+    # doubles in size about it, i.e., it is (x0 - 2**k + 1, x0 + 2**k).
+    x0, y0 = math.floor(center.x), math.floor(center.y)
 
-    pad = min_size // 2
-    # expanded_bbox = galsim.BoundsI(ix - pad, ix + pad - 1, iy - pad, iy + pad - 1)
+    # The smallest size that includes the entire footprint.
+    need = max(x0 + 1 - bbox.xmin, bbox.xmax - x0, y0 + 1 - bbox.ymin, bbox.ymax - y0)
+    k = _ceil_log2(math.ceil(need))
 
-    # Initialize the expanded_bbox as a 4x4 box around the center.
-    expanded_bbox = galsim.BoundsI(
-        ix - (center.x < ix), ix + (center.x >= ix), iy - (center.y < iy), iy + (center.y >= iy)
+    # The size must be larger than min_size, unless it then falls outside of
+    # the mosaic.
+    room = min(
+        x0 + 1 - mosaic_bbox.xmin, mosaic_bbox.xmax - x0, y0 + 1 - mosaic_bbox.ymin, mosaic_bbox.ymax - y0
     )
+    k = max(k, min(min_size.bit_length() - 1, max(room, 0).bit_length()))
+
+    half = 2**k
+    xmin, xmax = x0 - half + 1, x0 + half
+    ymin, ymax = y0 - half + 1, y0 + half
 
-    # Grow the bounding box until it includes the entire footprint.
-    while not expanded_bbox.includes(bbox):
-        expanded_bbox = expanded_bbox.expand(2)
+    # If the expanded_bbox falls outside of the mosaic, then move it inside.
+    if not (mosaic_bbox.xmin <= xmin and xmax <= mosaic_bbox.xmax):
+        xmin, xmax = map(int, _shift_into(xmin, xmax, mosaic_bbox.xmin, mosaic_bbox.xmax))
+    if not (mosaic_bbox.ymin <= ymin and ymax <= mosaic_bbox.ymax):
+        ymin, ymax = map(int, _shift_into(ymin, ymax, mosaic_bbox.ymin, mosaic_bbox.ymax))
+    expanded_bbox = galsim.BoundsI(xmin, xmax, ymin, ymax)
 
-    # Grow the bounding box further if it is smaller than 32x32 pixels
-    # and does not fall outside of the mosaic.
-    while expanded_bbox.area() <= min_size**2 and mosaic_bbox.includes(expanded_bbox):
-        expanded_bbox = expanded_bbox.expand(2)
+    return expanded_bbox
 
-    # If the while loop exited because the expanded_bbox grew outside of the
-    # mosaic, then move the bbox.
-    if not mosaic_bbox.includes(expanded_bbox):
-        common_bbox = expanded_bbox & mosaic_bbox
-        center_shift = common_bbox.center - expanded_bbox.center
-        expanded_bbox = expanded_bbox.shift(2 * center_shift)
 
-    # Check if this falls outside the full mosaic image
+def _ceil_log2(n: int) -> int:
+    """Return the smallest k such that 2**k >= n."""
+    return max(n - 1, 0).bit_length()
 
-    # while (expanded_bbox.xmin > bbox.xmin) or (expanded_bbox.xmax < bbox.xmax):
-    #     expanded_bbox = expanded_bbox.withBorder(dx=pad, dy=0)
-    # while (expanded_bbox.ymin > bbox.ymin) or (expanded_bbox.ymax < bbox.ymax):
-    #     expanded_bbox = expanded_bbox.withBorder(dx=0, dy=pad)
 
-    return expanded_bbox
+def _shift_into(lo, hi, mosaic_lo, mosaic_hi):
+    """Shift the range [lo, hi] to within [mosaic_lo, mosaic_hi].
+
+    The range is centered on the mosaic if it is larger than the mosaic.
+    This works with both integers and arrays.
+    """
+    left = np.maximum(mosaic_lo - lo, 0)
+    right = np.maximum(hi - mosaic_hi, 0)
+    shift = np.where((left > 0) & (right > 0), (left - right) // 2, left - right)
+    return lo + shift, hi + shift
+
+
+def expand_bboxes(
+    xmin: np.ndarray,
+    xmax: np.ndarray,
+    ymin: np.ndarray,
+    ymax: np.ndarray,
+    mosaic_bbox: galsim.BoundsI,
+    min_size: int = 32,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Expand many integer bounding boxes to be powers of 2 at once.
+
+    This is the vectorized equivalent of calling `expand_bbox` on
+    ``galsim.BoundsI(xmin[i], xmax[i], ymin[i], ymax[i])`` for every i, with
+    the default center, e.g., for all the segments of a segmentation map.
+
+    Parameters
+    ----------
+    xmin, xmax, ymin, ymax : np.ndarray
+        The inclusive corners of the bounding boxes.
+    mosaic_bbox : galsim.BoundsI
+        The bounds of the mosaic.
+    min_size : int, optional
+        The size that the expanded bounding boxes should be larger than.
+
+    Returns
+    -------
+    xmin, xmax, ymin, ymax : np.ndarray
+        The corners of the expanded bounding boxes.
+    """
+    xmin, xmax, ymin, ymax = (np.asarray(corner, dtype=np.int64) for corner in (xmin, xmax, ymin, ymax))
+    # The center of a galsim.BoundsI, i.e., rounded up and to the right.
+    x0 = xmin + (xmax - xmin + 1) // 2
+    y0 = ymin + (ymax - ymin + 1) // 2
+
+    need = np.max([x0 + 1 - xmin, xmax - x0, y0 + 1 - ymin, ymax - y0], axis=0)
+    # np.frexp(n)[1] is the bit length of the non-negative integer n.
+    k = np.frexp(np.maximum(need - 1, 0))[1]
+    room = np.min(
+        [x0 + 1 - mosaic_bbox.xmin, mosaic_bbox.xmax - x0, y0 + 1 - mosaic_bbox.ymin, mosaic_bbox.ymax - y0],
+        axis=0,
+    )
+    k = np.maximum(k, np.minimum(min_size.bit_length() - 1, np.frexp(np.maximum(room, 0))[1]))
+
+    half = np.left_shift(1, k, dtype=np.int64)
+    new_xmin, new_xmax = _shift_into(x0 - half + 1, x0 + half, mosaic_bbox.xmin, mosaic_bbox.xmax)
+    new_ymin, new_ymax = _shift_into(y0 - half + 1, y0 + half, mosaic_bbox.ymin, mosaic_bbox.ymax)
+    return new_xmin, new_xmax, new_ymin, new_ymax
+
+
+def make_tiles(
+    mosaic_bbox: galsim.BoundsI,
+    tile_size: int,
+    overlap: int = 0,
+) -> List[Tuple[galsim.BoundsI, galsim.BoundsI]]:
+    """
+    Split the mosaic into a grid of overlapping tiles.
+
+    The mosaic is first split into non-overlapping square cores of side
+    ``tile_size`` (smaller along the top and right edges), and each core is
+    padded by ``overlap`` pixels on every side to make the tile.
+
+    Returns
+    -------
+    tiles : list [(galsim.BoundsI, galsim.BoundsI)]
+        The (core, tile) bounds, in row-major order.
+    """
+    if tile_size < 1 or overlap < 0:
+        raise ValueError("tile_size must be positive and overlap must be non-negative")
+
+    tiles = []
+    for ymin in range(mosaic_bbox.ymin, mosaic_bbox.ymax + 1, tile_size):
+        for xmin in range(mosaic_bbox.xmin, mosaic_bbox.xmax + 1, tile_size):
+            core = galsim.BoundsI(xmin, xmin + tile_size - 1, ymin, ymin + tile_size - 1) & mosaic_bbox
+            tiles.append((core, core.withBorder(overlap) & mosaic_bbox))
+    return tiles
+
+
+def parse_shard(shard: str) -> Tuple[int, int]:
+    """
+    Parse a shard given as "i/N" into its index and the number of shards.
+
+    Raises
+    ------
+    ValueError
+        If the shard is not of the form "i/N", with 0 <= i < N.
+    """
+    index, sep, total = str(shard).partition("/")
+    try:
+        shard_index, num_shards = int(index), int(total)
+    except ValueError:
+        shard_index, num_shards = -1, 0
+    if not sep or not 0 <= shard_index < num_shards:
+        raise ValueError(f"shard must be of the form i/N with 0 <= i < N, got {shard}")
+    return shard_index, num_shards
+
+
+class TimeLimitExceeded(TimeoutError):
+    """Raised when a block of code runs longer than its `time_limit`."""
+
+
+@contextlib.contextmanager
+def time_limit(seconds: Optional[float]):
+    """
+    Raise `TimeLimitExceeded` if the block runs longer than ``seconds``.
+
+    The limit is enforced with a SIGALRM timer, so it only works in the main
+    thread of a process, e.g., of a pool worker, and it cannot interrupt a
+    compiled function until it returns to Python. No limit is set if
+    ``seconds`` is None or if this is not the main thread.
+    """
+    if not seconds or threading.current_thread() is not threading.main_thread():
+        yield
+        return
+
+    def _raise(signum, frame):
+        raise TimeLimitExceeded(f"Ran longer than {seconds} s")
+
+    handler = signal.signal(signal.SIGALRM, _raise)
+    signal.setitimer(signal.ITIMER_REAL, seconds)
+    try:
+        yield
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, handler)
+
+
+def assign_tile(
+    stamp_bbox: galsim.BoundsI,
+    tiles: Sequence[Tuple[galsim.BoundsI, galsim.BoundsI]],
+) -> int:
+    """
+    Find the tile in which a postage stamp is to be measured.
+
+    This is the tile whose core contains the center of the stamp, provided
+    the tile contains the full stamp. Otherwise, it is the first tile that
+    contains the full stamp.
+
+    Raises
+    ------
+    ValueError
+        If no tile contains the full stamp, in which case the overlap between
+        the tiles must be increased.
+    """
+    for n, (core, tile) in enumerate(tiles):
+        if core.includes(stamp_bbox.center) and tile.includes(stamp_bbox):
+            return n
+    for n, (_, tile) in enumerate(tiles):
+        if tile.includes(stamp_bbox):
+            return n
+    raise ValueError("No tile contains the stamp %s. Increase the tile overlap." % stamp_bbox)
+
+
+def philox_state(key: Sequence[int], stream: int = 0) -> Dict[str, Any]:
+    """Return the state of a Philox generator at the start of a stream.
+
+    Philox is counter-based, so a stream is fully set by its 128-bit key and
+    its counter, without any setup. The ``stream`` is the highest word of
+    the counter, so the streams of a key never overlap in practice.
+    """
+    return {
+        "bit_generator": "Philox",
+        "state": {
+            "counter": np.array([0, 0, 0, stream], dtype=np.uint64),
+            "key": np.array(key, dtype=np.uint64),
+        },
+        "buffer": np.zeros(4, dtype=np.uint64),
+        "buffer_pos": 4,
+        "has_uint32": 0,
+        "uinteger": 0,
+    }
+
+
+def fill_noise(
+    images: np.ndarray,
+    noise_rms: np.ndarray,
+    masks: np.ndarray,
+    rngs: Union[np.random.Generator, Sequence[np.random.Generator]],
+):
+    """
+    Replace the masked pixels of one or more stamps with Gaussian noise.
+
+    Only the masked pixels are drawn, and the pixels of all the stamps are
+    filled in one vectorized assignment. The images are modified in place.
+
+    Parameters
+    ----------
+    images : np.ndarray
+        A single stamp, or a stack of stamps of the same shape.
+    noise_rms : np.ndarray
+        The noise rms of the stamps, with the same shape as ``images``.
+    masks : np.ndarray
+        The boolean mask of the pixels to replace, of the same shape.
+    rngs : np.random.Generator or Sequence[np.random.Generator]
+        The random number generator of each stamp, so that the noise in a
+        stamp does not depend on the other stamps in the stack.
+    """
+    if images.ndim == 2:
+        images, noise_rms, masks, rngs = images[None], noise_rms[None], masks[None], [rngs]
+    counts = np.count_nonzero(masks.reshape(len(masks), -1), axis=1)
+    if not counts.any():
+        return
+    noise = np.concatenate([rng.standard_normal(count) for rng, count in zip(rngs, counts)])
+    images[masks] = noise * noise_rms[masks]
@@ -0,0 +1,596 @@
+"""
+Module containing the writers for the output catalog
+
+The catalog can be written as a FITS binary table, or in the column-oriented
+HDF5 and Parquet formats, which let the downstream tools read only the
+columns they need. The HDF5 and Parquet writers need the optional h5py and
+pyarrow packages.
+"""
+
+import abc
+import glob
+import logging
+import os
+from typing import Dict, List, Optional, Sequence, Type
+
+import numpy as np
+from astropy.io import fits
+
+__all__ = [
+    "CatalogWriter",
+    "FitsCatalogWriter",
+    "Hdf5CatalogWriter",
+    "ParquetCatalogWriter",
+    "get_writer",
+    "merge_catalogs",
+    "part_path",
+    "read_catalog",
+]
+
+logger = logging.getLogger(__name__)
+
+
+class CatalogWriter(abc.ABC):
+    """
+    The interface of the writers of the output catalog.
+
+    A writer is opened for the sorted ``indices`` of the sources to be
+    measured, and the chunks of records are written as they come, in any
+    order. The catalog on disk must stay readable between chunks, so that an
+    interrupted run can be resumed from it.
+
+    Parameters
+    ----------
+    path : str
+        The path to the output catalog.
+    dtypes : list
+        The dtype of the records, e.g., from `MetacalRecord.dtypes`.
+        It must contain an integer ``index`` field.
+    indices : Sequence[int]
+        The sorted indices of the sources that will be written.
+    resume : bool, optional
+        Reuse the catalog at ``path`` if it exists, instead of starting a new
+        one.
+    """
+
+    @abc.abstractmethod
+    def __init__(self, path: str, dtypes: list, indices: Sequence[int], resume: bool = False):
+        """Open the catalog, see the parameters of the class."""
+
+    @abc.abstractmethod
+    def measured_indices(self) -> np.ndarray:
+        """Return the indices of the sources already in the catalog."""
+
+    @abc.abstractmethod
+    def write(self, records: np.ndarray):
+        """Write a chunk of records, with the dtype of the writer."""
+
+    @abc.abstractmethod
+    def close(self):
+        """Write the remaining records and close the catalog."""
+
+    @classmethod
+    @abc.abstractmethod
+    def read(cls, path: str) -> np.ndarray:
+        """Return the records written into a catalog, ordered by index."""
+
+    @classmethod
+    @abc.abstractmethod
+    def update(cls, path: str, records: np.ndarray, names: Sequence[str]):
+        """Overwrite the columns ``names`` of the records in a catalog.
+
+        The records must all be in the catalog already, e.g., from `read`.
+        """
+
+    def _rows(self, records: np.ndarray) -> np.ndarray:
+        """Return the rows of the records in the preallocated catalog."""
+        indices: np.ndarray = self.indices  # type: ignore[attr-defined]
+        rows = np.searchsorted(indices, records["index"])
+        if np.any(indices[np.minimum(rows, len(indices) - 1)] != records["index"]):
+            raise ValueError("Some of the records do not belong to this catalog")
+        return rows
+
+    def __enter__(self) -> "CatalogWriter":
+        return self
+
+    def __exit__(self, *exc_info) -> Optional[bool]:
+        self.close()
+        return None
+
+
+def _written_rows(written_indices: np.ndarray, records: np.ndarray) -> np.ndarray:
+    """Return the rows of a catalog that the records were written into."""
+    rows = np.flatnonzero(written_indices >= 0)
+    rows = rows[np.argsort(written_indices[rows], kind="stable")]
+    positions = np.searchsorted(written_indices[rows], records["index"])
+    if np.any(written_indices[rows][np.minimum(positions, len(rows) - 1)] != records["index"]):
+        raise ValueError("Some of the records are not in the catalog")
+    return rows[positions]
+
+
+class FitsCatalogWriter(CatalogWriter):
+    """
+    Write a catalog incrementally into a preallocated FITS binary table.
+
+    The table is allocated on disk with one row per source to be measured,
+    with the ``index`` column set to -1 for the rows that have not been
+    written yet. Chunks of records are written into their rows in place and
+    flushed to disk, so a partially written catalog is always valid, and an
+    interrupted run can be resumed from it.
+
+    Parameters
+    ----------
+    path : str
+        The path to the output catalog.
+    dtypes : list
+        The dtype of the records, e.g., from `MetacalRecord.dtypes`.
+        It must contain an integer ``index`` field.
+    indices : Sequence[int]
+        The sorted indices of the sources that will be written. The record
+        with ``index == indices[i]`` is written into the i-th row.
+    resume : bool, optional
+        Reuse the catalog at ``path`` if it exists, instead of allocating a
+        new one.
+    """
+
+    def __init__(self, path: str, dtypes: list, indices: Sequence[int], resume: bool = False):
+        self.path = path
+        self.dtype = np.dtype(dtypes)
+        self.indices = np.asarray(indices, dtype=np.int64)
+
+        if resume and os.path.exists(path):
+            logger.info("Resuming from the partial catalog %s", path)
+        else:
+            self._allocate()
+
+        self._hdu_list = fits.open(self.path, mode="update", memmap=True)
+        self._data = self._hdu_list[1].data
+        self._validate()
+
+    def _allocate(self):
+        """Write an empty table with a row for every index."""
+        data = np.zeros(len(self.indices), dtype=self.dtype)
+        data["index"] = -1
+        fits.BinTableHDU(data=data).writeto(self.path, overwrite=True)
+
+    def _validate(self):
+        """Check that the catalog on disk is compatible with this writer."""
+        if self._data.dtype.names != self.dtype.names:
+            self.close()
+            raise ValueError(f"The columns in {self.path} do not match the records to be written")
+        if len(self._data) != len(self.indices):
+            self.close()
+            raise ValueError(
+                f"{self.path} has {len(self._data)} rows, but {len(self.indices)} sources are to be measured"
+            )
+        written = self._data["index"]
+        if np.any((written >= 0) & (written != self.indices)):
+            self.close()
+            raise ValueError(f"The rows in {self.path} are not in the expected order")
+
+    def measured_indices(self) -> np.ndarray:
+        """Return the indices of the sources already in the catalog."""
+        written = np.asarray(self._data["index"])
+        return self.indices[written >= 0]
+
+    def write(self, records: np.ndarray):
+        """Write a chunk of records into their rows and flush them to disk.
+
+        Parameters
+        ----------
+        records : np.ndarray
+            A structured array with the dtype of the writer.
+        """
+        rows = self._rows(records)
+        for name in self.dtype.names:
+            self._data[name][rows] = records[name]
+        self._hdu_list.flush()
+
+    def close(self):
+        """Flush the remaining records and close the catalog."""
+        self._hdu_list.close()
+
+    @classmethod
+    def read(cls, path: str) -> np.ndarray:
+        """Return the records written into a catalog, ordered by index."""
+        data = fits.getdata(path, 1)
+        written = data["index"] >= 0
+        records = np.zeros(np.count_nonzero(written), dtype=data.dtype.newbyteorder("="))
+        for name in records.dtype.names:
+            records[name] = data[name][written]
+        return records
+
+    @classmethod
+    def update(cls, path: str, records: np.ndarray, names: Sequence[str]):
+        """Overwrite the columns ``names`` of the records in place."""
+        with fits.open(path, mode="update", memmap=True) as hdu_list:
+            data = hdu_list[1].data
+            rows = _written_rows(np.asarray(data["index"]), records)
+            for name in names:
+                data[name][rows] = records[name]
+
+
+class Hdf5CatalogWriter(CatalogWriter):
+    """
+    Write a catalog incrementally into preallocated HDF5 datasets.
+
+    Every column is a separate one-dimensional dataset at the root of the
+    file, e.g., ``catalog["e1"]``, stored in compressed chunks, so that a
+    column is read without reading the others. As in `FitsCatalogWriter`,
+    there is one row per source to be measured, and the rows that have not
+    been written yet have an ``index`` of -1.
+
+    Parameters
+    ----------
+    path, dtypes, indices, resume
+        See `CatalogWriter`.
+    chunk_rows : int, optional
+        The number of rows in a chunk of the datasets.
+    compression : str, optional
+        The HDF5 compression filter of the datasets.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        dtypes: list,
+        indices: Sequence[int],
+        resume: bool = False,
+        chunk_rows: int = 65536,
+        compression: str = "gzip",
+    ):
+        try:
+            import h5py
+        except ImportError as error:
+            raise ImportError("Writing HDF5 catalogs requires h5py") from error
+
+        self.path = path
+        self.dtype = np.dtype(dtypes)
+        self.indices = np.asarray(indices, dtype=np.int64)
+
+        if resume and os.path.exists(path):
+            logger.info("Resuming from the partial catalog %s", path)
+            self._file = h5py.File(path, "r+")
+        else:
+            self._file = h5py.File(path, "w")
+            self._allocate(chunk_rows, compression)
+        self._validate()
+
+    def _allocate(self, chunk_rows: int, compression: str):
+        """Create an empty dataset with a row for every index per column."""
+        self._file.attrs["columns"] = list(self.dtype.names)
+        for name in self.dtype.names:
+            self._file.create_dataset(
+                name,
+                shape=(len(self.indices),),
+                dtype=self.dtype[name],
+                chunks=(max(1, min(chunk_rows, len(self.indices))),),
+                compression=compression,
+                shuffle=True,
+                fillvalue=-1 if name == "index" else 0,
+            )
+        self._file.flush()
+
+    def _validate(self):
+        """Check that the catalog on disk is compatible with this writer."""
+        if tuple(self._file.attrs.get("columns", ())) != self.dtype.names:
+            self.close()
+            raise ValueError(f"The columns in {self.path} do not match the records to be written")
+        if len(self._file["index"]) != len(self.indices):
+            self.close()
+            raise ValueError(
+                f"{self.path} has {len(self._file['index'])} rows, "
+                f"but {len(self.indices)} sources are to be measured"
+            )
+        written = self._file["index"][:]
+        if np.any((written >= 0) & (written != self.indices)):
+            self.close()
+            raise ValueError(f"The rows in {self.path} are not in the expected order")
+
+    def measured_indices(self) -> np.ndarray:
+        """Return the indices of the sources already in the catalog."""
+        return self.indices[self._file["index"][:] >= 0]
+
+    def write(self, records: np.ndarray):
+        """Write a chunk of records into their rows and flush them to disk."""
+        rows = self._rows(records)
+        order = np.argsort(rows)
+        rows, records = rows[order], records[order]
+        # A chunk of consecutive sources is written as a slice, which is much
+        # faster than a selection of rows.
+        if len(rows) and rows[-1] - rows[0] + 1 == len(rows):
+            selection = slice(int(rows[0]), int(rows[-1]) + 1)
+        else:
+            selection = rows
+        for name in self.dtype.names:
+            self._file[name][selection] = records[name]
+        self._file.flush()
+
+    def close(self):
+        """Flush the remaining records and close the catalog."""
+        self._file.close()
+
+    @classmethod
+    def read(cls, path: str) -> np.ndarray:
+        """Return the records written into a catalog, ordered by index."""
+        import h5py
+
+        with h5py.File(path, "r") as f:
+            names = list(f.attrs["columns"])
+            written = f["index"][:] >= 0
+            records = np.zeros(np.count_nonzero(written), dtype=[(name, f[name].dtype) for name in names])
+            for name in names:
+                records[name] = f[name][:][written]
+        return records
+
+    @classmethod
+    def update(cls, path: str, records: np.ndarray, names: Sequence[str]):
+        """Overwrite the columns ``names`` of the records in place."""
+        import h5py
+
+        with h5py.File(path, "r+") as f:
+            rows = _written_rows(f["index"][:], records)
+            order = np.argsort(rows)
+            for name in names:
+                column = f[name][:]
+                column[rows[order]] = records[name][order]
+                f[name][:] = column
+
+
+class ParquetCatalogWriter(CatalogWriter):
+    """
+    Write a catalog incrementally into a Parquet file.
+
+    Since a Parquet file is only readable once its footer is written, every
+    chunk of records is written as a complete file of its own next to the
+    catalog, e.g., ``catalog.parquet.chunk-000003``, as soon as it comes.
+    When the writer is closed, the catalog and the chunks are combined into
+    the catalog, sorted by index like the FITS and HDF5 catalogs, and the
+    chunks are removed. Only the measured sources are in the catalog.
+
+    If a run is killed before the writer is closed, the chunks stay on the
+    disk. A resumed run reads the measured sources from both the catalog and
+    the chunks, and combines all of them when it is closed.
+
+    Parameters
+    ----------
+    path, dtypes, indices, resume
+        See `CatalogWriter`.
+    compression : str, optional
+        The Parquet compression codec.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        dtypes: list,
+        indices: Sequence[int],
+        resume: bool = False,
+        compression: str = "zstd",
+    ):
+        try:
+            import pyarrow as pa
+        except ImportError as error:
+            raise ImportError("Writing Parquet catalogs requires pyarrow") from error
+
+        self.path = path
+        self.dtype = np.dtype(dtypes)
+        self.indices = np.asarray(indices, dtype=np.int64)
+        self.compression = compression
+        self._schema = pa.schema([(name, pa.from_numpy_dtype(self.dtype[name])) for name in self.dtype.names])
+        self._measured = [np.zeros(0, dtype=np.int64)]
+        self._chunk_paths = self._find_chunks(path)
+
+        if not resume:
+            # Drop the chunks of a previous run, which is not resumed.
+            for chunk_path in self._chunk_paths:
+                os.remove(chunk_path)
+            self._chunk_paths = []
+            self._has_catalog = False
+            return
+
+        self._has_catalog = os.path.exists(path)
+        if self._has_catalog:
+            logger.info("Resuming from the catalog %s", path)
+            self._measured.append(self._read_indices(path))
+        for chunk_path in list(self._chunk_paths):
+            measured = self._read_indices(chunk_path)
+            if self._has_catalog and np.all(np.isin(measured, self._measured[1])):
+                # A chunk that was combined into the catalog, but not removed.
+                os.remove(chunk_path)
+                self._chunk_paths.remove(chunk_path)
+                continue
+            self._measured.append(measured)
+        if len(self._chunk_paths):
+            logger.info("Resuming from %d chunks of %s", len(self._chunk_paths), path)
+        measured = np.concatenate(self._measured)
+        if not np.all(np.isin(measured, self.indices)):
+            raise ValueError(f"{self.path} has sources that are not to be measured")
+        if len(np.unique(measured)) != len(measured):
+            raise ValueError(f"{self.path} and its chunks have sources more than once")
+
+    @staticmethod
+    def _find_chunks(path: str) -> List[str]:
+        """Return the paths of the chunks of a catalog, in written order."""
+        chunk_paths = glob.glob(f"{glob.escape(path)}.chunk-*")
+        return sorted(chunk_path for chunk_path in chunk_paths if not chunk_path.endswith(".partial"))
+
+    def _read_indices(self, path: str) -> np.ndarray:
+        """Return the indices in a Parquet file, checking its columns."""
+        import pyarrow.parquet as pq
+
+        if tuple(pq.read_schema(path).names) != self.dtype.names:
+            raise ValueError(f"The columns in {path} do not match the records to be written")
+        return pq.read_table(path, columns=["index"]).column("index").to_numpy().astype(np.int64)
+
+    def measured_indices(self) -> np.ndarray:
+        """Return the indices of the sources already in the catalog."""
+        return np.intersect1d(self.indices, np.concatenate(self._measured))
+
+    def write(self, records: np.ndarray):
+        """Write a chunk of records into a file of its own."""
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        self._rows(records)
+        table = pa.Table.from_arrays([records[name] for name in self.dtype.names], schema=self._schema)
+        number = int(self._chunk_paths[-1].rsplit("-", 1)[1]) + 1 if self._chunk_paths else 0
+        chunk_path = f"{self.path}.chunk-{number:06d}"
+        # The chunk is renamed once complete, so that it is never read
+        # half-written.
+        pq.write_table(table, f"{chunk_path}.partial", compression=self.compression)
+        os.replace(f"{chunk_path}.partial", chunk_path)
+        self._chunk_paths.append(chunk_path)
+        self._measured.append(np.asarray(records["index"], dtype=np.int64))
+
+    def close(self):
+        """Combine the catalog and the chunks into the catalog, by index."""
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        if self._has_catalog and not self._chunk_paths:
+            return
+        paths = [self.path] * self._has_catalog + self._chunk_paths
+        tables = [pq.read_table(path).cast(self._schema) for path in paths]
+        table = pa.concat_tables(tables) if tables else self._schema.empty_table()
+        tmp_path = f"{self.path}.partial"
+        pq.write_table(table.sort_by("index"), tmp_path, compression=self.compression)
+        os.replace(tmp_path, self.path)
+        for chunk_path in self._chunk_paths:
+            os.remove(chunk_path)
+        self._has_catalog, self._chunk_paths = True, []
+
+    @classmethod
+    def read(cls, path: str) -> np.ndarray:
+        """Return the records written into a catalog, ordered by index."""
+        import pyarrow.parquet as pq
+
+        table = pq.read_table(path)
+        records = np.zeros(
+            table.num_rows,
+            dtype=[(name, table.column(name).type.to_pandas_dtype()) for name in table.column_names],
+        )
+        for name in table.column_names:
+            records[name] = table.column(name).to_numpy()
+        return records[np.argsort(records["index"], kind="stable")]
+
+    @classmethod
+    def update(cls, path: str, records: np.ndarray, names: Sequence[str]):
+        """Overwrite the columns ``names`` of the records in a new file."""
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        table = pq.read_table(path)
+        rows = _written_rows(table.column("index").to_numpy(), records)
+        if len(np.unique(rows)) != table.num_rows:
+            raise ValueError("All the records of a Parquet catalog must be updated at once")
+        for name in names:
+            column = table.column(name).to_numpy().copy()
+            column[rows] = records[name]
+            table = table.set_column(table.column_names.index(name), name, pa.array(column))
+        tmp_path = f"{path}.partial"
+        pq.write_table(table, tmp_path, compression="zstd")
+        os.replace(tmp_path, path)
+
+
+# The writers of each format, and the format of each file extension.
+WRITERS: Dict[str, Type[CatalogWriter]] = {
+    "fits": FitsCatalogWriter,
+    "hdf5": Hdf5CatalogWriter,
+    "parquet": ParquetCatalogWriter,
+}
+EXTENSIONS = {
+    ".fits": "fits",
+    ".fit": "fits",
+    ".h5": "hdf5",
+    ".hdf5": "hdf5",
+    ".parquet": "parquet",
+    ".pq": "parquet",
+}
+
+
+def get_writer(path: str, format: Optional[str] = None) -> Type[CatalogWriter]:
+    """
+    Return the writer class of a catalog.
+
+    Parameters
+    ----------
+    path : str
+        The path to the catalog. The format is guessed from its extension,
+        and defaults to FITS for unknown extensions.
+    format : str, optional
+        The format of the catalog, one of ``fits``, ``hdf5`` and ``parquet``,
+        which overrides the extension.
+
+    Raises
+    ------
+    ValueError
+        If the format is unknown.
+    """
+    if format is None:
+        format = EXTENSIONS.get(os.path.splitext(path)[1].lower(), "fits")
+    try:
+        return WRITERS[format.lower()]
+    except KeyError:
+        raise ValueError(f"Unknown catalog format {format}, expected one of {sorted(WRITERS)}") from None
+
+
+def read_catalog(path: str, format: Optional[str] = None) -> np.ndarray:
+    """Return the records written into a catalog, ordered by index."""
+    return get_writer(path, format).read(path)
+
+
+def part_path(path: str, tag: str) -> str:
+    """Return the path of a part of the catalog, e.g., catalog.tile-3.fits."""
+    root, ext = os.path.splitext(path)
+    return f"{root}.{tag}{ext}"
+
+
+def merge_catalogs(
+    part_paths: Sequence[str], path: str, dtypes: list, indices: Sequence[int], format: Optional[str] = None
+):
+    """
+    Merge parts of a catalog into a single catalog ordered by index.
+
+    Parameters
+    ----------
+    part_paths : Sequence[str]
+        The paths to the parts, written by any of the writers.
+    path : str
+        The path to the merged catalog.
+    dtypes : list
+        The dtype of the records.
+    indices : Sequence[int]
+        The sorted indices of all the sources that the merged catalog must
+        contain, exactly once each.
+    format : str, optional
+        The format of the parts and of the merged catalog, see `get_writer`.
+
+    Raises
+    ------
+    ValueError
+        If a source is missing from all the parts, or appears more than once.
+    """
+    indices = np.asarray(indices, dtype=np.int64)
+    parts = []
+    for part in part_paths:
+        data = read_catalog(part, format)
+        records = np.zeros(len(data), dtype=dtypes)
+        for name in records.dtype.names:
+            records[name] = data[name]
+        parts.append(records)
+        logger.info("Read %d records from %s", len(parts[-1]), part)
+    records = np.concatenate(parts) if parts else np.zeros(0, dtype=dtypes)
+
+    unique, counts = np.unique(records["index"], return_counts=True)
+    if np.any(counts > 1):
+        raise ValueError(f"Sources {unique[counts > 1]} appear more than once in the parts")
+    missing = np.setdiff1d(indices, unique)
+    if len(missing):
+        raise ValueError(f"{len(missing)} sources are missing from the parts, e.g., {missing[:10]}")
+    extra = np.setdiff1d(unique, indices)
+    if len(extra):
+        raise ValueError(f"Sources {extra[:10]} in the parts are not expected in the catalog")
+
+    with get_writer(path, format)(path, dtypes, indices) as writer:
+        writer.write(records[np.argsort(records["index"])])
@@ -0,0 +1,50 @@
+import os
+import time
+
+import numpy as np
+
+from nirwl_metacal.cache import ResultCache
+from nirwl_metacal.metacal_record import MetacalRecord
+
+
+def test_result_cache(tmp_path):
+    cache = ResultCache(str(tmp_path / "cache"), context="seed=1")
+    rng = np.random.default_rng(0)
+    image, psf = rng.normal(size=(32, 32)), rng.normal(size=(25, 25))
+    key = cache.key(7, (1, 32, 1, 32), [image, None, psf])
+    # The key depends on the pixels, the ID, the bounds and the context.
+    assert key == cache.key(7, (1, 32, 1, 32), [image.copy(), None, psf])
+    assert key != cache.key(8, (1, 32, 1, 32), [image, None, psf])
+    assert key != cache.key(7, (2, 33, 1, 32), [image, None, psf])
+    assert key != cache.key(7, (1, 32, 1, 32), [image, np.zeros((32, 32), dtype=bool), psf])
+    assert key != cache.key(7, (1, 32, 1, 32), [image.astype("f4"), None, psf])
+    assert key != ResultCache(str(tmp_path / "cache"), context="seed=2").key(
+        7, (1, 32, 1, 32), [image, None, psf]
+    )
+
+    records = MetacalRecord.empty(1)
+    assert cache.get(key, records.dtype) is None
+    records["index"], records["e1"] = 3, 0.25
+    cache.put(key, records[0])
+    cached = cache.get(key, records.dtype)
+    assert cached["index"] == 3 and cached["e1"] == np.float32(0.25)
+    assert cache.usage()[0] == 1
+
+
+def test_result_cache_eviction(tmp_path):
+    cache = ResultCache(str(tmp_path / "cache"))
+    records = MetacalRecord.empty(4)
+    keys = [cache.key(n, (1, 2, 1, 2), []) for n in range(4)]
+    for n, key in enumerate(keys):
+        cache.put(key, records[n])
+        # Make the records successively more recent, but older than now.
+        os.utime(cache._path(key), (time.time() - 100 + n,) * 2)
+    num_records, num_bytes = cache.usage()
+    assert num_records == 4
+
+    # Reading a record makes it the most recently used.
+    assert cache.get(keys[0], records.dtype) is not None
+    cache.max_bytes = num_bytes // 2
+    assert cache.evict() == (2, num_bytes // 2)
+    assert [cache.get(key, records.dtype) is not None for key in keys] == [True, False, False, True]
+    assert cache.evict() == (0, 0)
@@ -0,0 +1,58 @@
+import galsim
+import numpy as np
+import pytest
+from astropy.io import fits
+
+from nirwl_metacal.loaders import MosaicImage, PSFCube, read_image
+
+
+@pytest.fixture
+def image_path(tmp_path):
+    path = str(tmp_path / "image.fits")
+    # FITS files are big-endian, which GalSim does not use natively.
+    array = np.arange(30 * 40, dtype=">f4").reshape(30, 40)
+    fits.PrimaryHDU(array).writeto(path)
+    return path
+
+
+@pytest.mark.parametrize(
+    "bounds",
+    [
+        galsim.BoundsI(xmin=1, xmax=8, ymin=1, ymax=8),
+        galsim.BoundsI(xmin=9, xmax=40, ymin=3, ymax=18),
+        galsim.BoundsI(xmin=40, xmax=40, ymin=30, ymax=30),
+    ],
+)
+def test_memmap_stamps_match_galsim(image_path: str, bounds: galsim.BoundsI):
+    image = read_image(image_path)
+    mosaic = read_image(image_path, memmap=True)
+    assert isinstance(mosaic, MosaicImage)
+    assert mosaic.bounds == image.bounds
+    assert mosaic.array.shape == image.array.shape
+
+    stamp = mosaic[bounds]
+    assert stamp.bounds == image[bounds].bounds
+    np.testing.assert_array_equal(stamp.array, image[bounds].array)
+    assert stamp.array.dtype.isnative
+
+
+def test_memmap_stamp_outside_mosaic(image_path: str):
+    mosaic = read_image(image_path, memmap=True)
+    with pytest.raises(galsim.GalSimBoundsError):
+        mosaic[galsim.BoundsI(xmin=35, xmax=42, ymin=1, ymax=8)]
+
+
+def test_psf_cube(tmp_path):
+    path = str(tmp_path / "psf.fits")
+    cube = np.random.default_rng(42).normal(size=(5, 21, 21)).astype(">f4")
+    fits.HDUList([fits.PrimaryHDU(), fits.ImageHDU(cube)]).writeto(path)
+
+    psf_images = PSFCube(path)
+    expected = galsim.fits.readCube(path, hdu=1)
+    assert len(psf_images) == len(expected)
+    for n in (0, 3, 4):
+        np.testing.assert_array_equal(psf_images[n].array, expected[n].array)
+        assert psf_images[n].bounds == expected[n].bounds
+
+    with pytest.raises(ValueError):
+        PSFCube(path, hdu=0)
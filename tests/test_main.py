@@ -0,0 +1,76 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+pytest.importorskip("ngmix")
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# The pipeline modules import each other as top-level modules.
+sys.path.insert(0, os.path.join(ROOT, "nirwl_metacal"))
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+
+import synthetic  # noqa: E402
+from main import MetacalCatalogGenerator  # noqa: E402
+from writers import part_path, read_catalog  # noqa: E402
+
+
+@pytest.fixture(scope="module")
+def mosaic(tmp_path_factory):
+    outdir = str(tmp_path_factory.mktemp("mosaic"))
+    synthetic.make_synthetic_mosaic(outdir, size=512)
+    return os.path.join(outdir, "config.yaml")
+
+
+@pytest.fixture
+def fake_measurement(monkeypatch):
+    """Replace the measurement of a source by writing its index."""
+
+    def measure_source(self, n, out, stamp=None, psf_image=None):
+        out["index"] = n
+        out["e1"] = 0.01 * n
+        return out
+
+    monkeypatch.setattr(MetacalCatalogGenerator, "_measure_source", measure_source)
+
+
+@pytest.mark.parametrize("selection", [{"where": "X_IMAGE < 300"}, {"region": [1, 300, 100, 512]}])
+def test_run_tile_with_selection(mosaic, tmp_path, fake_measurement, selection):
+    output_cat = str(tmp_path / "metacal.fits")
+    catalog_generator = MetacalCatalogGenerator(
+        config=mosaic, output_cat=output_cat, tile_size=200, overwrite=True, **selection
+    )
+    catalog_generator.run(tile=0)
+
+    selected = catalog_generator._selected_indices()
+    assert 0 < len(selected) < len(catalog_generator.sep_cat)
+    _, assignment = catalog_generator._plan_tiles()
+    records = read_catalog(part_path(output_cat, "tile-0"))
+    np.testing.assert_array_equal(records["index"], selected[assignment[selected] == 0])
+
+
+def test_run_shard_with_selection(mosaic, tmp_path, fake_measurement):
+    output_cat = str(tmp_path / "metacal.fits")
+    for shard in ("0/2", "1/2"):
+        MetacalCatalogGenerator(config=mosaic, output_cat=output_cat, where="FLUX_RADIUS > 2").run(
+            shard=shard
+        )
+    catalog_generator = MetacalCatalogGenerator(config=mosaic, output_cat=output_cat, where="FLUX_RADIUS > 2")
+    catalog_generator.merge()
+
+    records = read_catalog(output_cat)
+    selected = catalog_generator._selected_indices()
+    assert 0 < len(selected) < len(catalog_generator.sep_cat)
+    np.testing.assert_array_equal(records["index"], selected)
+
+
+def test_run_parallel_parquet_in_catalog_order(mosaic, tmp_path, fake_measurement):
+    pq = pytest.importorskip("pyarrow.parquet")
+    output_cat = str(tmp_path / "metacal.parquet")
+    catalog_generator = MetacalCatalogGenerator(config=mosaic, output_cat=output_cat, nproc=2, overwrite=True)
+    catalog_generator.run()
+
+    # The sources are measured largest stamps first, but written by index.
+    indices = pq.read_table(output_cat).column("index").to_numpy()
+    np.testing.assert_array_equal(indices, np.arange(len(catalog_generator.sep_cat)))
@@ -0,0 +1,34 @@
+import numpy as np
+
+from nirwl_metacal.metacal_record import FAILED, FAILED_TIMEOUT, MetacalRecord
+
+
+def test_empty():
+    """Test that the empty records have the dtype of the catalog."""
+    records = MetacalRecord.empty(5)
+    assert records.dtype == np.dtype(MetacalRecord.dtypes())
+    assert records.dtype.names == MetacalRecord._fields
+    np.testing.assert_array_equal(records["index"], -1)
+
+
+def test_fill_rows_in_place():
+    """Test that the fields written into a row end up in the array."""
+    records = MetacalRecord.empty(3)
+    row = records[1]
+    row["index"] = 7
+    row["e1"] = 0.25
+    row["flag_1p"] = 2
+    assert records["index"].tolist() == [-1, 7, -1]
+    assert records["e1"][1] == 0.25
+    assert records["flag_1p"][1] == 2
+
+
+def test_fill_failed():
+    """Test that the records of failed sources are never selected."""
+    records = MetacalRecord.empty(3)
+    MetacalRecord.fill_failed(records[2], 5, FAILED_TIMEOUT)
+    assert records["index"].tolist() == [-1, -1, 5]
+    assert records["flag_failure"].tolist() == [0, 0, FAILED_TIMEOUT]
+    assert records["flag_noshear"][2] == records["flag_2m"][2] == FAILED
+    assert np.isnan(records["e1"][2]) and np.isnan(records["snr_1p"][2])
+    assert records["e1"][1] == 0
@@ -0,0 +1,127 @@
+import galsim
+import numpy as np
+import pytest
+
+ngmix = pytest.importorskip("ngmix")
+
+from nirwl_metacal import moments  # noqa: E402
+from nirwl_metacal.moments import (  # noqa: E402
+    NONPOSITIVE_FLUX,
+    NONPOSITIVE_T,
+    fwhm_to_T,
+    gauss_moments,
+    warm_up,
+    weighted_moment_sums,
+)
+
+
+def _stamps(shears, sigma=2.0, size=32):
+    images = [
+        galsim.Gaussian(sigma=sigma)
+        .shear(g1=g1, g2=g2)
+        .drawImage(nx=size, ny=size, scale=1.0, method="no_pixel")
+        .array
+        for g1, g2 in shears
+    ]
+    jacobians = np.tile([(size - 1) / 2, (size - 1) / 2, 1.0, 0.0, 0.0, 1.0], (len(shears), 1))
+    return np.array(images), np.ones((len(shears), size, size)), jacobians
+
+
+def test_fwhm_to_T():
+    assert fwhm_to_T(2 * np.sqrt(2 * np.log(2))) == pytest.approx(2.0)
+
+
+@pytest.mark.parametrize("g1,g2", [(0.0, 0.0), (0.2, -0.1), (-0.3, 0.05)])
+def test_unweighted_ellipticity(g1: float, g2: float):
+    """Test that a very wide weight recovers the distortion of a Gaussian."""
+    images, weights, jacobians = _stamps([(g1, g2)])
+    results = gauss_moments(images, weights, jacobians, fwhm=1e6)
+    g = np.array([g1, g2])
+    e = 2 * g / (1 + g @ g)
+    assert results["flags"][0] == 0
+    np.testing.assert_allclose([results["e1"][0], results["e2"][0]], e, atol=1e-6)
+    assert results["T"][0] == pytest.approx(2 * 2.0**2 * (1 + g @ g) / (1 - g @ g), rel=1e-4)
+
+
+def test_batch_matches_single_stamps():
+    """Test that the stamps of a batch are measured independently."""
+    shears = [(0.1, 0.0), (0.0, 0.2), (-0.1, -0.1)]
+    images, weights, jacobians = _stamps(shears)
+    weights[1, :4] = 0.0
+    batch = gauss_moments(images, weights, jacobians, fwhm=4.0)
+    for n in range(len(shears)):
+        single = gauss_moments(images[[n]], weights[[n]], jacobians[[n]], fwhm=4.0)
+        for name, values in single.items():
+            assert values[0] == pytest.approx(batch[name][n])
+
+
+def test_errors():
+    images, weights, jacobians = _stamps([(0.1, 0.0)])
+    results = gauss_moments(images, 100 * weights, jacobians, fwhm=4.0)
+    noisier = gauss_moments(images, weights, jacobians, fwhm=4.0)
+    assert noisier["s2n"][0] == pytest.approx(0.1 * results["s2n"][0])
+    assert noisier["e1err"][0] == pytest.approx(10 * results["e1err"][0])
+
+
+def test_flags():
+    images, weights, jacobians = _stamps([(0.1, 0.0), (0.1, 0.0)])
+    images[1] *= -1
+    results = gauss_moments(images, weights, jacobians, fwhm=4.0)
+    assert results["flags"][0] == 0
+    assert results["flags"][1] & NONPOSITIVE_FLUX
+    assert np.isnan(results["e1"][1])
+
+
+def test_flags_match_ngmix():
+    """Test that the failures are flagged as in ngmix's GaussMomFitter."""
+    images, weights, jacobians = _stamps([(0.1, 0.0), (0.1, 0.0)])
+    images[0] *= -1
+    # A positive core in a negative ring, with a positive flux but a
+    # negative size.
+    images[1] -= 2 * _stamps([(0.0, 0.0)], sigma=6.0)[0][0]
+    results = gauss_moments(images, weights, jacobians, fwhm=8.0)
+    assert results["flags"][0] == NONPOSITIVE_FLUX | NONPOSITIVE_T
+    assert results["flags"][1] == NONPOSITIVE_T
+    assert results["flux"][1] > 0
+
+    fitter = ngmix.gaussmom.GaussMomFitter(weight_fwhm=8.0)
+    for n in range(len(images)):
+        expected = fitter.go(ngmix.Observation(images[n], weights[n]))
+        assert results["flags"][n] == expected["flags"]
+
+
+def test_warm_up():
+    warm_up()
+    signatures = list(moments._weighted_moment_sums.signatures)
+    assert signatures
+    # The measurements use the compiled kernel, without compiling another.
+    images, weights, jacobians = _stamps([(0.1, 0.0)])
+    gauss_moments(images, weights, jacobians, fwhm=4.0)
+    assert moments._weighted_moment_sums.signatures == signatures
+
+
+def test_shape_mismatch():
+    images, weights, jacobians = _stamps([(0.1, 0.0)])
+    with pytest.raises(ValueError):
+        weighted_moment_sums(images, weights[:, :-1], jacobians, 1.0)
+
+
+def test_matches_ngmix():
+    """Test the moments against those of ngmix.gaussmom.GaussMomFitter."""
+    shears = [(0.0, 0.0), (0.2, -0.1), (-0.05, 0.3)]
+    images, weights, jacobians = _stamps(shears, sigma=2.5)
+    weights *= np.random.default_rng(1).uniform(0.5, 2.0, size=weights.shape)
+    results = gauss_moments(images, weights, jacobians, fwhm=4.0)
+
+    fitter = ngmix.gaussmom.GaussMomFitter(weight_fwhm=4.0)
+    flux_ratios = []
+    for n in range(len(shears)):
+        # The default Jacobian of ngmix has a unit scale, and is centered on
+        # the stamp, like those of the stamps.
+        expected = fitter.go(ngmix.Observation(images[n], weights[n]))
+        assert expected["flags"] == results["flags"][n] == 0
+        for name in ("T", "e1", "e2", "s2n"):
+            assert results[name][n] == pytest.approx(expected[name], rel=1e-6, abs=1e-9)
+        flux_ratios.append(expected["flux"] / results["flux"][n])
+    # The flux only differs by the normalization of the weight.
+    np.testing.assert_allclose(flux_ratios, flux_ratios[0], rtol=1e-6)
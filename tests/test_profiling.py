@@ -0,0 +1,45 @@
+import json
+import time
+
+import pytest
+
+from nirwl_metacal.profiling import Profile, StageTimer
+
+
+def test_disabled_timer():
+    timer = StageTimer()
+    with timer.stage("noise"):
+        pass
+    assert timer.pop() is None
+
+
+def test_profile(tmp_path):
+    timer = StageTimer(enabled=True)
+    profile = Profile()
+    for n in range(4):
+        with timer.stage("total"):
+            with timer.stage("metacal"):
+                time.sleep(0.002)
+            with timer.stage("record"):
+                pass
+        timings = timer.pop()
+        assert set(timings) == {"total", "metacal", "record"}
+        profile.add(n, timings, stamp_size=64)
+    # The timings are reset once popped.
+    assert timer.pop() == {}
+
+    summary = profile.summary()
+    assert summary["metacal"]["count"] == 4
+    assert summary["metacal"]["wall_p50"] >= 0.002
+    assert summary["total"]["wall_total"] >= summary["metacal"]["wall_total"]
+    assert sum(summary["record"]["wall_histogram"]["counts"]) == 4
+    assert "metacal" in profile.table()
+
+    path = str(tmp_path / "profile.json")
+    profile.write(path)
+    with open(path) as f:
+        written = json.load(f)
+    assert written["stages"]["metacal"]["count"] == 4
+    assert [source["index"] for source in written["sources"]] == [0, 1, 2, 3]
+    assert written["sources"][0]["stamp_size"] == 64
+    assert written["sources"][0]["timings"]["metacal"][0] == pytest.approx(0.002, abs=0.05)
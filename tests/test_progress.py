@@ -0,0 +1,52 @@
+import json
+import logging
+
+import numpy as np
+
+from nirwl_metacal.progress import Progress, format_duration
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_format_duration():
+    assert format_duration(5.4) == "5s"
+    assert format_duration(125) == "2m05s"
+    assert format_duration(3723) == "1h02m03s"
+    assert format_duration(None) == "?"
+
+
+def test_progress(tmp_path, caplog):
+    clock = FakeClock()
+    heartbeat = str(tmp_path / "heartbeat.json")
+    progress = Progress(100, interval=10.0, heartbeat=heartbeat, name="field", clock=clock)
+
+    with caplog.at_level(logging.INFO):
+        clock.now = 5.0
+        progress.update(np.array([32, 32, 64]), np.array([0.1, 0.1, 0.4]), np.array([False, True, False]))
+        # Nothing is reported before the interval is over.
+        assert not caplog.records
+        clock.now = 20.0
+        progress.update(np.array([64] * 17), np.full(17, 0.4), np.zeros(17, dtype=bool))
+    assert "field: 20/100 sources measured (20.0%)" in caplog.text
+
+    with open(heartbeat) as f:
+        status = json.load(f)
+    assert status["state"] == "running"
+    assert (status["done"], status["failed"]) == (20, 1)
+    assert status["sources_per_s"] == 1.0
+    assert status["eta_s"] == 80.0
+    assert status["stamp_sizes"]["32"] == {"count": 2, "sources_per_s": 10.0}
+    assert status["stamp_sizes"]["64"]["count"] == 18
+    assert np.isclose(status["stamp_sizes"]["64"]["sources_per_s"], 2.5)
+
+    progress.finish()
+    with open(heartbeat) as f:
+        status = json.load(f)
+    assert status["state"] == "done"
+    assert status["eta_s"] is None
@@ -0,0 +1,61 @@
+import numpy as np
+import pytest
+
+from nirwl_metacal.metacal_record import MetacalRecord
+from nirwl_metacal.responses import compute_responses, mean_response, selection_response, shear_field
+
+
+@pytest.fixture
+def records():
+    rng = np.random.default_rng(1357)
+    records = MetacalRecord.empty(100)
+    records["index"] = np.arange(100)
+    records["e1"] = rng.normal(0.0, 0.3, 100)
+    records["e2"] = rng.normal(0.0, 0.3, 100)
+    records["snr"] = rng.uniform(5, 50, 100)
+    response = np.array([[0.8, 0.01], [-0.02, 0.7]])
+    for b in (1, 2):
+        for sign, suffix in ((1, "p"), (-1, "m")):
+            for a in (1, 2):
+                records[f"e{a}_{b}{suffix}"] = records[f"e{a}"] + sign * 0.01 * response[a - 1, b - 1]
+            records[f"snr_{b}{suffix}"] = records["snr"] + sign * rng.uniform(0, 2, 100)
+    return records
+
+
+def test_compute_responses(records):
+    """Test the vectorized responses against the per-source formula."""
+    compute_responses(records, step=0.01)
+    for record in records[:5]:
+        r12_p = (float(record["e1_2p"]) - float(record["e1"])) / 0.01
+        r12_m = (float(record["e1"]) - float(record["e1_2m"])) / 0.01
+        assert record["R12_p"] == pytest.approx(r12_p, rel=1e-5)
+        assert record["R12_m"] == pytest.approx(r12_m, rel=1e-5)
+        assert record["R12"] == pytest.approx(0.5 * (r12_p + r12_m), rel=1e-5)
+    np.testing.assert_allclose(records["R11"], 0.8, rtol=1e-3)
+    np.testing.assert_allclose(records["R22"], 0.7, rtol=1e-3)
+
+
+def test_compute_responses_step(records):
+    """Test that the responses scale inversely with the step."""
+    r11 = compute_responses(records, step=0.01)["R11"].copy()
+    np.testing.assert_allclose(compute_responses(records, step=0.02)["R11"], 0.5 * r11, rtol=1e-6)
+
+
+def test_mean_response(records):
+    response = mean_response(records, step=0.01)
+    np.testing.assert_allclose(response, [[0.8, 0.01], [-0.02, 0.7]], rtol=1e-3, atol=1e-4)
+    mask = records["snr"] > 20
+    np.testing.assert_allclose(
+        compute_responses(records)["R11"][mask].mean(), mean_response(records, mask=mask)[0, 0]
+    )
+
+
+def test_selection_response(records):
+    def select(records, shear_type):
+        return shear_field(records, "snr", shear_type) > 20
+
+    # A selection that does not depend on the shear has no response.
+    np.testing.assert_allclose(selection_response(records, lambda r, t: r["snr"] > 20), 0.0)
+    # Selecting on the sheared measurements generally does.
+    assert selection_response(records, select).shape == (2, 2)
+    assert np.any(selection_response(records, select) != 0)
@@ -0,0 +1,56 @@
+import numpy as np
+import pytest
+
+from nirwl_metacal.selection import evaluate, select_sources
+
+
+def _catalog():
+    catalog = np.zeros(
+        5,
+        dtype=[
+            ("ID", "i4"),
+            ("X_IMAGE", "f8"),
+            ("Y_IMAGE", "f8"),
+            ("MAG_AUTO", "f8"),
+            ("FLUX_RADIUS", "f8"),
+            ("ALPHA_J2000", "f8"),
+            ("DELTA_J2000", "f8"),
+        ],
+    )
+    catalog["ID"] = np.arange(1, 6)
+    catalog["X_IMAGE"] = [10.0, 50.0, 90.0, 130.0, 170.0]
+    catalog["Y_IMAGE"] = [10.0, 20.0, 30.0, 40.0, 50.0]
+    catalog["MAG_AUTO"] = [22.0, 23.5, 24.5, 25.0, np.nan]
+    catalog["FLUX_RADIUS"] = [3.0, 1.0, 2.0, 2.5, 1.5]
+    catalog["ALPHA_J2000"] = [359.99, 0.005, 0.02, 10.0, 0.0]
+    catalog["DELTA_J2000"] = [0.0, 0.0, 0.0, 0.0, -0.015]
+    return catalog
+
+
+def test_evaluate():
+    catalog = _catalog()
+    np.testing.assert_array_equal(
+        evaluate("(MAG_AUTO < 24) & (FLUX_RADIUS > 1.5)", catalog), [True, False, False, False, False]
+    )
+    np.testing.assert_array_equal(
+        evaluate("23 < mag_auto <= 25 and not FLUX_RADIUS > 2.2", catalog), [False, True, True, False, False]
+    )
+    np.testing.assert_array_equal(evaluate("~isfinite(MAG_AUTO) | (ID == 1)", catalog), [1, 0, 0, 0, 1])
+    np.testing.assert_array_equal(evaluate("True", catalog), np.ones(5, dtype=bool))
+
+    for expression in ("MAG_AUTO", "MAG_AUTO < ", "FLUX < 1", "__import__('os')", "MAG_AUTO.sum() > 1"):
+        with pytest.raises(ValueError):
+            evaluate(expression, catalog)
+
+
+def test_select_sources():
+    catalog = _catalog()
+    np.testing.assert_array_equal(select_sources(catalog), np.arange(5))
+    np.testing.assert_array_equal(select_sources(catalog, region=[40, 140, 0, 35]), [1, 2])
+    np.testing.assert_array_equal(
+        select_sources(catalog, where="FLUX_RADIUS > 1.5", region=[40, 140, 0, 35]), [2]
+    )
+    # The circle wraps around RA = 0.
+    np.testing.assert_array_equal(select_sources(catalog, sky_region=[0.0, 0.0, 0.012]), [0, 1])
+    with pytest.raises(ValueError):
+        select_sources(catalog, region=[0, 1])
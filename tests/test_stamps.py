@@ -0,0 +1,72 @@
+import galsim
+import numpy as np
+import pytest
+from photutils.segmentation import SegmentationImage
+
+from nirwl_metacal.loaders import MosaicImage
+from nirwl_metacal.stamps import Footprints, cut_stamp, find_segments
+
+
+def _seg_map(size=200, num_segments=60, seed=1):
+    rng = np.random.default_rng(seed)
+    data = np.zeros((size, size), dtype=np.int32)
+    for label in range(1, num_segments + 1):
+        x, y = rng.integers(0, size - 8, 2)
+        w, h = rng.integers(2, 8, 2)
+        data[slice(y, y + h), slice(x, x + w)] = label
+    return SegmentationImage(data)
+
+
+def test_footprints_neighbors():
+    """Test the neighbors against the labels found in the stamp pixels."""
+    seg_map = _seg_map()
+    rng = np.random.default_rng(2)
+    labels = seg_map.labels
+    xmin, ymin = rng.integers(1, 170, (2, len(labels)))
+    stamp_bounds = np.stack([xmin, xmin + 31, ymin, ymin + 31], axis=1)
+    footprints = Footprints.from_segmentation(seg_map.data, labels, stamp_bounds)
+    assert len(footprints) == len(labels)
+
+    for n, label in enumerate(labels):
+        x0, x1, y0, y1 = stamp_bounds[n]
+        in_stamp = set(np.unique(seg_map.data[slice(y0 - 1, y1), slice(x0 - 1, x1)])) - {0, label}
+        # The bounding boxes may overlap the stamp without any of their
+        # pixels being in it, but every neighbor in it must be found.
+        assert in_stamp <= set(footprints.neighbors[n])
+        assert label not in footprints.neighbors[n]
+        assert footprints.has_neighbors(n) == (len(footprints.neighbors[n]) > 0)
+        assert footprints.bounds(n) == galsim.BoundsI(*map(int, stamp_bounds[n]))
+
+
+@pytest.mark.parametrize("block_pixels", [200, 7 * 200, 2**20])
+def test_find_segments(block_pixels):
+    """Test the segments found in blocks of rows against photutils."""
+    seg_map = _seg_map()
+    labels, bounds = find_segments(seg_map.data, block_pixels=block_pixels)
+    np.testing.assert_array_equal(labels, seg_map.labels)
+    expected = [(bbox.ixmin + 1, bbox.ixmax, bbox.iymin + 1, bbox.iymax) for bbox in seg_map.bbox]
+    np.testing.assert_array_equal(bounds, expected)
+
+
+def test_cut_stamp():
+    rng = np.random.default_rng(3)
+    image = galsim.Image(rng.normal(size=(64, 64)))
+    weight = MosaicImage(np.full((64, 64), 4.0, dtype=">f4"))
+    noise_rms = galsim.Image(np.full((64, 64), 0.5))
+    seg = np.zeros((64, 64), dtype=np.int32)
+    seg[10:20, 10:20] = 1
+    seg[15:25, 18:30] = 2
+    seg_map = galsim.Image(seg)
+
+    bounds = galsim.BoundsI(9, 24, 9, 24)
+    stamp = cut_stamp(bounds, image, weight, noise_rms, seg_map, label=1)
+    np.testing.assert_array_equal(stamp.image.array, image[bounds].array)
+    assert stamp.image.bounds == stamp.weight.bounds == bounds
+    assert not np.shares_memory(stamp.image.array, image.array)
+    assert np.shares_memory(stamp.noise_rms, noise_rms.array)
+    # The big-endian weight is converted to the native byte order.
+    assert stamp.weight.array.dtype == np.dtype("f4")
+    np.testing.assert_array_equal(stamp.mask, seg[8:24, 8:24] == 2)
+
+    stamp = cut_stamp(bounds, image, weight, noise_rms, seg_map, label=1, has_neighbors=False)
+    assert stamp.mask is None
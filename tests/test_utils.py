@@ -1,10 +1,21 @@
+import time
 from typing import Tuple
 
 import galsim
 import numpy as np
 import pytest
 
-from nirwl_metacal.utils import expand_bbox
+from nirwl_metacal.utils import (
+    TimeLimitExceeded,
+    assign_tile,
+    expand_bbox,
+    expand_bboxes,
+    fill_noise,
+    make_tiles,
+    parse_shard,
+    philox_state,
+    time_limit,
+)
 
 
 @pytest.mark.parametrize(
@@ -68,3 +79,104 @@ def test_expand_bbox_corner_cases(bbox: galsim.BoundsI):
     # Check that the bbox  <- expanded bbox <- mosaic_bbox.
     assert expanded_bbox.includes(bbox)
     assert mosaic_bbox.includes(expanded_bbox)
+
+
+@pytest.mark.parametrize("min_size", [16, 32, 40])
+def test_expand_bboxes(min_size: int):
+    """Test that the batch version agrees with expand_bbox."""
+    rng = np.random.default_rng(1357)
+    mosaic_bbox = galsim.BoundsI(1, 300, 1, 200)
+    xmin, ymin = rng.integers(1, 280, 500), rng.integers(1, 180, 500)
+    xmax = np.minimum(xmin + rng.integers(0, 70, 500), 300)
+    ymax = np.minimum(ymin + rng.integers(0, 70, 500), 200)
+    expanded = expand_bboxes(xmin, xmax, ymin, ymax, mosaic_bbox, min_size=min_size)
+    for i in range(len(xmin)):
+        bbox = galsim.BoundsI(int(xmin[i]), int(xmax[i]), int(ymin[i]), int(ymax[i]))
+        expanded_bbox = expand_bbox(bbox, mosaic_bbox, min_size=min_size)
+        assert tuple(corner[i] for corner in expanded) == (
+            expanded_bbox.xmin,
+            expanded_bbox.xmax,
+            expanded_bbox.ymin,
+            expanded_bbox.ymax,
+        )
+        assert expanded_bbox.includes(bbox)
+        assert mosaic_bbox.includes(expanded_bbox)
+
+
+@pytest.mark.parametrize("tile_size,overlap", [(32, 0), (40, 8), (100, 16), (500, 50)])
+def test_make_tiles(tile_size: int, overlap: int):
+    mosaic_bbox = galsim.BoundsI(1, 200, 1, 150)
+    tiles = make_tiles(mosaic_bbox, tile_size, overlap)
+    # Check that the cores cover the mosaic exactly once.
+    assert sum(core.area() for core, _ in tiles) == mosaic_bbox.area()
+    for core, tile in tiles:
+        assert tile.includes(core)
+        assert mosaic_bbox.includes(tile)
+        assert tile == core.withBorder(overlap) & mosaic_bbox
+
+
+def test_assign_tile():
+    mosaic_bbox = galsim.BoundsI(1, 200, 1, 200)
+    tiles = make_tiles(mosaic_bbox, tile_size=100, overlap=32)
+    # A stamp well inside the first core.
+    assert assign_tile(galsim.BoundsI(11, 42, 11, 42), tiles) == 0
+    # A stamp straddling the cores, but centered in the last one.
+    assert assign_tile(galsim.BoundsI(85, 116, 85, 116), tiles) == 3
+    # A stamp larger than the overlap goes to a tile that contains it fully.
+    n = assign_tile(galsim.BoundsI(1, 128, 1, 64), tiles)
+    assert tiles[n][1].includes(galsim.BoundsI(1, 128, 1, 64))
+    with pytest.raises(ValueError):
+        assign_tile(galsim.BoundsI(1, 200, 1, 200), tiles)
+
+
+def test_fill_noise():
+    rng = np.random.default_rng(42)
+    images = rng.normal(size=(3, 32, 32))
+    noise_rms = rng.uniform(1.0, 2.0, size=(3, 32, 32))
+    masks = rng.uniform(size=(3, 32, 32)) < 0.3
+    masks[1] = False  # A stamp without neighbors.
+
+    filled = images.copy()
+    fill_noise(filled, noise_rms, masks, [np.random.default_rng(n) for n in range(3)])
+    # Check that only the masked pixels are replaced.
+    np.testing.assert_array_equal(filled[~masks], images[~masks])
+    assert np.all(filled[masks] != images[masks])
+    # Check that the noise has the right amplitude.
+    assert np.std(filled[masks] / noise_rms[masks]) == pytest.approx(1.0, abs=0.1)
+
+    # Check that filling a stamp alone gives the same noise as in the stack.
+    single = images[2].copy()
+    fill_noise(single, noise_rms[2], masks[2], np.random.default_rng(2))
+    np.testing.assert_array_equal(single, filled[2])
+
+
+def test_philox_state():
+    rng = np.random.Generator(np.random.Philox(key=[1, 0]))
+    rng.bit_generator.state = philox_state((1, 7))
+    first = rng.normal(size=8)
+    rng.bit_generator.state = philox_state((1, 7))
+    # Resetting the state restarts the stream.
+    np.testing.assert_array_equal(rng.normal(size=8), first)
+    rng.bit_generator.state = philox_state((1, 7), stream=1)
+    assert not np.any(rng.normal(size=8) == first)
+    rng.bit_generator.state = philox_state((1, 8))
+    assert not np.any(rng.normal(size=8) == first)
+
+
+def test_parse_shard():
+    assert parse_shard("0/1") == (0, 1)
+    assert parse_shard("3/8") == (3, 8)
+    for shard in ("8/8", "-1/8", "1", "a/b", "1/0"):
+        with pytest.raises(ValueError):
+            parse_shard(shard)
+
+
+def test_time_limit():
+    with time_limit(1.0):
+        pass
+    with pytest.raises(TimeLimitExceeded):
+        with time_limit(0.05):
+            time.sleep(1.0)
+    # No limit is set without a number of seconds.
+    with time_limit(None):
+        time.sleep(0.01)
@@ -0,0 +1,177 @@
+import numpy as np
+import pytest
+from astropy.io import fits
+
+from nirwl_metacal.writers import (
+    CatalogWriter,
+    FitsCatalogWriter,
+    Hdf5CatalogWriter,
+    ParquetCatalogWriter,
+    get_writer,
+    merge_catalogs,
+    part_path,
+    read_catalog,
+)
+
+DTYPES = [("index", "i4"), ("e1", "f4")]
+
+
+def _records(indices):
+    records = np.zeros(len(indices), dtype=DTYPES)
+    records["index"] = indices
+    records["e1"] = 0.1 * np.asarray(indices)
+    return records
+
+
+def test_fits_writer_in_chunks(tmp_path):
+    path = str(tmp_path / "catalog.fits")
+    indices = np.arange(10)
+    with FitsCatalogWriter(path, DTYPES, indices) as writer:
+        writer.write(_records([0, 1, 2, 3]))
+        # The partial catalog on disk is readable, with unwritten rows flagged.
+        partial = fits.getdata(path)
+        np.testing.assert_array_equal(partial["index"], [0, 1, 2, 3] + [-1] * 6)
+        writer.write(_records([4, 5, 6, 7, 8, 9]))
+
+    data = fits.getdata(path)
+    np.testing.assert_array_equal(data["index"], indices)
+    np.testing.assert_allclose(data["e1"], 0.1 * indices, rtol=1e-6)
+
+
+def test_fits_writer_resume(tmp_path):
+    path = str(tmp_path / "catalog.fits")
+    indices = np.arange(3, 9)
+    with FitsCatalogWriter(path, DTYPES, indices) as writer:
+        writer.write(_records([3, 5, 6]))
+
+    with FitsCatalogWriter(path, DTYPES, indices, resume=True) as writer:
+        measured = writer.measured_indices()
+        np.testing.assert_array_equal(measured, [3, 5, 6])
+        writer.write(_records(np.setdiff1d(indices, measured)))
+
+    np.testing.assert_array_equal(fits.getdata(path)["index"], indices)
+
+    # Resuming with a different set of sources is an error.
+    with pytest.raises(ValueError):
+        FitsCatalogWriter(path, DTYPES, np.arange(10), resume=True)
+
+
+def test_fits_writer_rejects_foreign_records(tmp_path):
+    path = str(tmp_path / "catalog.fits")
+    with FitsCatalogWriter(path, DTYPES, np.arange(5)) as writer:
+        with pytest.raises(ValueError):
+            writer.write(_records([2, 7]))
+
+
+def test_merge_catalogs(tmp_path):
+    path = str(tmp_path / "catalog.fits")
+    parts = []
+    for tile, indices in enumerate(([0, 4, 5], [1, 2], [3, 6])):
+        parts.append(part_path(path, f"tile-{tile}"))
+        with FitsCatalogWriter(parts[-1], DTYPES, indices) as writer:
+            writer.write(_records(indices))
+    assert parts[0] == str(tmp_path / "catalog.tile-0.fits")
+
+    merge_catalogs(parts, path, DTYPES, np.arange(7))
+    np.testing.assert_array_equal(fits.getdata(path)["index"], np.arange(7))
+
+    # Missing and duplicated sources are errors.
+    with pytest.raises(ValueError):
+        merge_catalogs(parts[:2], path, DTYPES, np.arange(7))
+    with pytest.raises(ValueError):
+        merge_catalogs(parts + parts[:1], path, DTYPES, np.arange(7))
+
+
+def test_get_writer():
+    assert get_writer("catalog.fits") is FitsCatalogWriter
+    assert get_writer("catalog.h5") is Hdf5CatalogWriter
+    assert get_writer("catalog.parquet") is ParquetCatalogWriter
+    # Unknown extensions are FITS, unless the format is given.
+    assert get_writer("catalog.cat") is FitsCatalogWriter
+    assert get_writer("catalog.cat", format="hdf5") is Hdf5CatalogWriter
+    with pytest.raises(ValueError):
+        get_writer("catalog.fits", format="csv")
+
+
+def test_incomplete_writer():
+    """Test that a writer without some of the methods cannot be created."""
+
+    class IncompleteWriter(CatalogWriter):
+        def __init__(self, path, dtypes, indices, resume=False):
+            pass
+
+    with pytest.raises(TypeError):
+        IncompleteWriter("catalog.fits", DTYPES, [0])
+
+
+@pytest.mark.parametrize("ext", [".fits", ".h5", ".parquet"])
+def test_writers_resume_and_update(tmp_path, ext):
+    if ext == ".h5":
+        pytest.importorskip("h5py")
+    if ext == ".parquet":
+        pytest.importorskip("pyarrow")
+    path = str(tmp_path / f"catalog{ext}")
+    writer_class = get_writer(path)
+    indices = np.arange(3, 9)
+    with writer_class(path, DTYPES, indices) as writer:
+        writer.write(_records([6, 3]))
+        writer.write(_records([5]))
+    np.testing.assert_array_equal(read_catalog(path)["index"], [3, 5, 6])
+
+    with writer_class(path, DTYPES, indices, resume=True) as writer:
+        measured = writer.measured_indices()
+        np.testing.assert_array_equal(measured, [3, 5, 6])
+        writer.write(_records(np.setdiff1d(indices, measured)))
+
+    records = read_catalog(path)
+    np.testing.assert_array_equal(records["index"], indices)
+    np.testing.assert_allclose(records["e1"], 0.1 * indices, rtol=1e-6)
+
+    records["e1"] = -1.0
+    writer_class.update(path, records, ["e1"])
+    np.testing.assert_array_equal(read_catalog(path)["e1"], -1.0)
+
+
+def test_parquet_resume_after_kill(tmp_path):
+    pq = pytest.importorskip("pyarrow.parquet")
+    path = str(tmp_path / "catalog.parquet")
+    indices = np.arange(6)
+    with ParquetCatalogWriter(path, DTYPES, indices) as writer:
+        writer.write(_records([0, 1]))
+    # A run that is killed leaves its chunks, without closing the writer.
+    writer = ParquetCatalogWriter(path, DTYPES, indices, resume=True)
+    writer.write(_records([4]))
+    writer.write(_records([2]))
+    del writer
+
+    with ParquetCatalogWriter(path, DTYPES, indices, resume=True) as writer:
+        np.testing.assert_array_equal(writer.measured_indices(), [0, 1, 2, 4])
+        writer.write(_records([3, 5]))
+    np.testing.assert_array_equal(read_catalog(path)["index"], indices)
+    assert not ParquetCatalogWriter._find_chunks(path)
+    # The rows on disk are in catalog order, not in measurement order.
+    np.testing.assert_array_equal(pq.read_table(path).column("index").to_numpy(), indices)
+
+    # Without resume, the chunks of a killed run are dropped.
+    writer = ParquetCatalogWriter(path, DTYPES, indices, resume=True)
+    writer.write(_records([0]))
+    with ParquetCatalogWriter(path, DTYPES, indices) as writer:
+        assert len(writer.measured_indices()) == 0
+        writer.write(_records([1]))
+    np.testing.assert_array_equal(read_catalog(path)["index"], [1])
+
+
+def test_merge_catalogs_hdf5(tmp_path):
+    h5py = pytest.importorskip("h5py")
+    path = str(tmp_path / "catalog.h5")
+    parts = []
+    for shard, indices in enumerate(([0, 2, 4], [1, 3])):
+        parts.append(part_path(path, f"shard-{shard}-of-2"))
+        with Hdf5CatalogWriter(parts[-1], DTYPES, indices) as writer:
+            writer.write(_records(indices))
+
+    merge_catalogs(parts, path, DTYPES, np.arange(5))
+    # The columns can be read one by one.
+    with h5py.File(path, "r") as f:
+        np.testing.assert_array_equal(f["index"][:], np.arange(5))
+        np.testing.assert_allclose(f["e1"][:], 0.1 * np.arange(5), rtol=1e-6)